@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+bpe_apply.py（zh-id / zh-en 兩份）對 subword-nmt apply_bpe.py 的逐位元組 parity 測試。
+
+fixtures/bpe/ 內容：
+  corpus.txt  測試語料（Zipf 分布的拉丁 / 漢字詞、標點與 escape、空行、連續空白、行首 tab）
+  codes / voc learn_joint_bpe_and_vocab.py --input corpus.txt -s 120 -o codes --write-vocabulary voc
+
+參考輸出直接執行已安裝的 subword-nmt 取得；沒有安裝 subword-nmt 時略過。
+"""
+
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('subword_nmt')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures', 'bpe')
+CORPUS = os.path.join(FIXTURES, 'corpus.txt')
+CODES = os.path.join(FIXTURES, 'codes')
+VOC = os.path.join(FIXTURES, 'voc')
+COPIES = ('zh-id', 'zh-en')
+# (名稱, subword-nmt 參數, bpe_apply.py 參數)
+VOCAB_CASES = (
+    ('plain', [], []),
+    ('vocab', ['--vocabulary', VOC, '--vocabulary-threshold', '2'], ['--vocabulary', VOC, '--vocabulary_threshold', '2']),
+)
+# 很小的區段讓 -w 2 真的切成多塊
+BLOCK_MB = '0.002'
+
+
+def subword_nmt_script(name: str) -> str:
+    spec = importlib.util.find_spec('subword_nmt')
+    return os.path.join(list(spec.submodule_search_locations)[0], name)
+
+
+@pytest.fixture(scope='module')
+def reference():
+    with open(CORPUS, 'rb') as f:
+        data = f.read()
+    out = {}
+    for name, ref_args, _ in VOCAB_CASES:
+        cmd = [sys.executable, subword_nmt_script('apply_bpe.py'), '-c', CODES] + ref_args
+        out[name] = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, check=True).stdout
+    return out
+
+
+def bpe_apply(copy: str, args, data: bytes = None) -> bytes:
+    cmd = [sys.executable, os.path.join(ROOT, copy, 'utils', 'bpe_apply.py'), '-c', CODES] + args
+    return subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+
+@pytest.mark.parametrize('copy', COPIES)
+@pytest.mark.parametrize('name,ref_args,our_args', VOCAB_CASES)
+@pytest.mark.parametrize('workers', (1, 2))
+def test_file_parity(copy, name, ref_args, our_args, workers, reference, tmp_path):
+    dst = tmp_path / 'out.bpe'
+    bpe_apply(copy, our_args + ['-i', CORPUS, '-o', str(dst), '-w', str(workers), '--block_mb', BLOCK_MB])
+    assert dst.read_bytes() == reference[name]
+
+
+@pytest.mark.parametrize('copy', COPIES)
+@pytest.mark.parametrize('name,ref_args,our_args', VOCAB_CASES)
+def test_stdin_parity(copy, name, ref_args, our_args, reference):
+    with open(CORPUS, 'rb') as f:
+        data = f.read()
+    assert bpe_apply(copy, our_args + ['--block_mb', BLOCK_MB], data) == reference[name]
+
+
+@pytest.mark.parametrize('copy', COPIES)
+@pytest.mark.parametrize('workers', (1, 2))
+def test_missing_codes_fails_fast(copy, workers):
+    cmd = [sys.executable, os.path.join(ROOT, copy, 'utils', 'bpe_apply.py'), '-c', os.path.join(FIXTURES, 'nope'),
+           '-i', CORPUS, '-w', str(workers)]
+    r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+    assert r.returncode == 2
+    assert b'[ERROR]' in r.stderr
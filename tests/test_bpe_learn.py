@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+bpe_learn.py（zh-id / zh-en 兩份）對 subword-nmt learn_joint_bpe_and_vocab.py 的逐位元組 parity 測試。
+
+期望輸出是 fixtures/bpe/ 內以 subword-nmt 錄製的 codes / voc（錄製方式見 test_bpe_apply.py），
+不需安裝 subword-nmt 也會執行：
+  learn_joint_bpe_and_vocab.py --input corpus.txt -s 120 -o codes --write-vocabulary voc
+"""
+
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures', 'bpe')
+CORPUS = os.path.join(FIXTURES, 'corpus.txt')
+SYMBOLS = 120
+COPIES = ('zh-id', 'zh-en')
+
+
+def load_copy(copy: str):
+    """
+    以不同模組名載入各份 bpe_learn.py；它以 `from bpe_apply import ...` 取用同目錄的 bpe_apply，
+    載入時暫時把該份的 utils 放到 sys.path 最前面並清掉已快取的 bpe_apply。
+    """
+    utils = os.path.join(ROOT, copy, 'utils')
+    name = 'bpe_learn_' + copy.replace('-', '_')
+    saved = sys.modules.pop('bpe_apply', None)
+    sys.path.insert(0, utils)
+    try:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(utils, 'bpe_learn.py'))
+        mod = importlib.util.module_from_spec(spec)
+        sys.modules[name] = mod
+        spec.loader.exec_module(mod)
+    finally:
+        sys.path.remove(utils)
+        sys.modules.pop('bpe_apply', None)
+        if saved is not None:
+            sys.modules['bpe_apply'] = saved
+    return mod
+
+
+MODULES = {copy: load_copy(copy) for copy in COPIES}
+
+
+def expected(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('copy', COPIES)
+def test_learn_from_counts(copy, tmp_path):
+    """preprocess_stream.py 的路徑：先累計詞頻，再直接呼叫 learn_from_counts。"""
+    mod = MODULES[copy]
+    codes, voc = tmp_path / 'codes', tmp_path / 'voc'
+    counts = mod.count_words(CORPUS)
+    with open(os.devnull, 'w') as log:
+        mod.learn_from_counts(counts, str(codes), str(voc), SYMBOLS, log=log)
+    assert codes.read_bytes() == expected('codes')
+    assert voc.read_bytes() == expected('voc')
+
+
+@pytest.mark.parametrize('copy', COPIES)
+@pytest.mark.parametrize('workers', (1, 2))
+def test_cli_parity(copy, workers, tmp_path):
+    """preprocess_pipeline.py 的路徑：bpe_learn.py -w N --sample 0（很小的區段讓 -w 2 真的分塊計數）。"""
+    codes, voc = tmp_path / 'codes', tmp_path / 'voc'
+    cmd = [sys.executable, os.path.join(ROOT, copy, 'utils', 'bpe_learn.py'), '-i', CORPUS, '-s', str(SYMBOLS),
+           '-o', str(codes), '--write_vocabulary', str(voc), '-w', str(workers), '--sample', '0',
+           '--block_mb', '0.002']
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    assert codes.read_bytes() == expected('codes')
+    assert voc.read_bytes() == expected('voc')
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+split.py（zh-id / zh-en 兩份）的切分行為：同 seed 結果固定、重複句對不跨份、句數模式、-w N 與 -w 1 輸出相同。
+
+測試語料在 tmp_path 內產生：固定亂數抽出的句對，含完全重複、只差空白的重複、同一中文句的不同譯文。
+"""
+
+import importlib.util
+import os
+import random
+import sys
+from collections import defaultdict
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COPIES = ('zh-id', 'zh-en')
+PARTS = ('train', 'test', 'valid')
+LANGS = ('zh', 'xx')
+
+
+def load_copy(copy: str):
+    """以不同模組名載入各份 split.py（註冊後 worker 才能 pickle）。"""
+    path = os.path.join(ROOT, copy, 'utils', 'split.py')
+    name = 'split_' + copy.replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, path)
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+
+MODULES = {copy: load_copy(copy) for copy in COPIES}
+
+
+@pytest.fixture(scope='module')
+def corpus(tmp_path_factory):
+    rng = random.Random(20261017)
+    base = [(f'中文 句子 {i}', f'kalimat {i} terjemahan') for i in range(300)]
+    src, tgt = [], []
+    for _ in range(1200):
+        s, t = rng.choice(base)
+        r = rng.random()
+        if r < 0.1:
+            s, t = '  ' + s.replace(' ', '   ') + ' ', t + '\t'  # 只差空白
+        elif r < 0.2:
+            t = t + ' lain'  # 同一中文句的另一個譯文
+        src.append(s + '\n')
+        tgt.append(t + '\n')
+    d = tmp_path_factory.mktemp('corpus')
+    paths = (str(d / 'clean.zh'), str(d / 'clean.xx'))
+    for p, lines in zip(paths, (src, tgt)):
+        with open(p, 'w', encoding='utf-8', newline='') as f:
+            f.writelines(lines)
+    return paths
+
+
+def run_split(copy, corpus, out_dir, **kw):
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = str(out_dir) + os.sep
+    counts = MODULES[copy].split_files(corpus[0], corpus[1], prefix, langs=LANGS, **kw)
+    out = {}
+    for part in PARTS:
+        for lang in LANGS:
+            with open(f'{prefix}{part}.{lang}', 'rb') as f:
+                out[part, lang] = f.read()
+    return counts, out
+
+
+def parts_by_key(out, group_by='pair'):
+    """正規化後的 key → 出現的 split 集合。"""
+    seen = defaultdict(set)
+    for part in PARTS:
+        src = out[part, 'zh'].decode('utf-8').splitlines()
+        tgt = out[part, 'xx'].decode('utf-8').splitlines()
+        assert len(src) == len(tgt)
+        for s, t in zip(src, tgt):
+            key = ' '.join(s.split()) + ('\t' + ' '.join(t.split()) if group_by == 'pair' else '')
+            seen[key].add(part)
+    return seen
+
+
+@pytest.mark.parametrize('copy', COPIES)
+def test_seeded_determinism(copy, corpus, tmp_path):
+    n1, a = run_split(copy, corpus, tmp_path / 'a', test=0.1, valid=0.1, seed=7)
+    n2, b = run_split(copy, corpus, tmp_path / 'b', test=0.1, valid=0.1, seed=7)
+    _, c = run_split(copy, corpus, tmp_path / 'c', test=0.1, valid=0.1, seed=8)
+    assert n1 == n2 and a == b
+    assert a != c
+    assert sum(n1) == 1200
+
+
+@pytest.mark.parametrize('copy', COPIES)
+@pytest.mark.parametrize('group_by', ('pair', 'src'))
+def test_duplicates_stay_together(copy, group_by, corpus, tmp_path):
+    _, out = run_split(copy, corpus, tmp_path, test=0.2, valid=0.2, group_by=group_by)
+    seen = parts_by_key(out, group_by)
+    assert all(len(parts) == 1 for parts in seen.values())
+    assert {p for parts in seen.values() for p in parts} == set(PARTS)
+
+
+@pytest.mark.parametrize('copy', COPIES)
+def test_output_keeps_input_order(copy, corpus, tmp_path):
+    _, out = run_split(copy, corpus, tmp_path, test=0.2, valid=0.2)
+    with open(corpus[0], 'rb') as f:
+        src = f.read().splitlines(keepends=True)
+    for part in PARTS:
+        it = iter(src)
+        assert all(any(line == x for x in it) for line in out[part, 'zh'].splitlines(keepends=True))
+
+
+@pytest.mark.parametrize('copy', COPIES)
+def test_count_mode(copy, corpus, tmp_path):
+    n, out = run_split(copy, corpus, tmp_path, test=40, valid=25)
+    # 重複句對整組移動，可能略多於目標，但不會少
+    assert n[1] >= 40 and n[2] >= 25
+    assert n[1] + n[2] < 40 + 25 + 30
+    assert sum(n) == 1200
+    assert all(len(parts) == 1 for parts in parts_by_key(out).values())
+
+
+@pytest.mark.parametrize('copy', COPIES)
+@pytest.mark.parametrize('mode', ({'test': 0.1, 'valid': 0.15}, {'test': 40, 'valid': 25}))
+@pytest.mark.parametrize('workers', (2, 3))
+def test_workers_match_single(copy, mode, workers, corpus, tmp_path):
+    n1, one = run_split(copy, corpus, tmp_path / 'w1', seed=3, workers=1, **mode)
+    nw, many = run_split(copy, corpus, tmp_path / f'w{workers}', seed=3, workers=workers, **mode)
+    assert n1 == nw
+    assert one == many
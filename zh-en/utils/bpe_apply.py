@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+bpe_apply.py
+- 行程內套用 BPE（bpecode.<lang> + voc.<lang>），輸出與 subword-nmt 的
+  `apply_bpe.py -c CODES --vocabulary VOC < in > out` 逐 byte 相同（preprocess.sh 的用法）
+- 合併表載入一次成 rank 表：(左, 右) -> rank 與合併後的字串放在同一個 dict，
+  每輪用 map / min 在 C 層找出最小 rank，不再每輪重建 (rank, i, pair) 清單
+- 每個詞的切分結果（已接好 @@ 的字串）放進有上限的 LRU 快取（--cache_words），
+  高頻詞只切一次，記憶體不隨語料無限成長；結束時印出命中率
+- 檔案依 byte 區段（對齊換行）交給 process pool，每個 worker 載入一次合併表，結果依區段順序寫出
+- 換行同 apply_bpe.py 讀 stdin：\\r\\n 與單獨的 \\r 都視為換行並輸出成 \\n
+- 不支援 --glossaries 與 --dropout（preprocess.sh / word_seg.py 都沒有用到）
+
+用法：
+  python bpe_apply.py -c bpecode.id --vocabulary voc.id -i norm.tok.true.id -o norm.tok.true.bpe.id [-w 8]
+  python bpe_apply.py -c bpecode.id --vocabulary voc.id -i sample.txt --check [-w 8]
+      與 subword-nmt apply_bpe.py 比對輸出（parity）並比較 lines/s
+"""
+
+import os
+import re
+import sys
+import time
+import codecs
+import argparse
+import itertools
+import subprocess
+import multiprocessing as mp
+from functools import lru_cache
+from typing import List, Optional, Set
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.abspath(os.path.join(BASE_DIR, '..'))
+BPE_ROOT = os.path.join(REPO, '../subword-nmt')
+
+# 找不到合併規則時的 rank（比任何實際 rank 都大）
+_NO_MERGE = (1 << 62, None)
+
+
+def read_codes(path: str, merges: int = -1):
+    """同 subword-nmt BPE.__init__ 讀合併表：回傳 (version, [(左, 右), ...])，依檔案順序、可含重複。"""
+    with codecs.open(path, encoding='utf-8') as f:
+        offset = 1
+        first = f.readline()
+        if first.startswith('#version:'):
+            version = tuple(int(x) for x in re.sub(r'(\.0+)*$', '', first.split()[-1]).split('.'))
+            offset += 1
+        else:
+            version = (0, 1)
+            f.seek(0)
+        codes = [tuple(item.strip('\r\n ').split(' ')) for n, item in enumerate(f.read().rstrip('\n').split('\n'))
+                 if n < merges or merges == -1]
+    for i, item in enumerate(codes):
+        if len(item) != 2:
+            raise ValueError(f'invalid line {i + offset} in BPE codes file {path}: {" ".join(item)}')
+    if version not in ((0, 1), (0, 2)):
+        raise ValueError(f'unsupported BPE codes version {version} in {path}')
+    return version, codes
+
+
+def read_vocabulary(path: str, threshold: Optional[int] = None) -> Set[str]:
+    """同 subword-nmt read_vocabulary：每行 "詞 次數"，次數 < threshold 的不算在詞表內。"""
+    vocab = set()
+    with codecs.open(path, encoding='utf-8') as f:
+        for line in f:
+            word, freq = line.strip('\r\n ').split(' ')
+            if threshold is None or int(freq) >= threshold:
+                vocab.add(word)
+    return vocab
+
+
+class BPEApplier:
+    """
+    與 subword_nmt.apply_bpe.BPE 相同的切分結果（process_line / segment 介面相同）。
+
+    用法：
+        bpe = BPEApplier('bpecode.id', 'voc.id')
+        bpe.process_line('saya makan nasi\\n')   # -> 'saya makan na@@ si\\n'
+    """
+
+    def __init__(self, codes_path: str, vocab_path: Optional[str] = None, merges: int = -1,
+                 separator: str = '@@', vocab_threshold: Optional[int] = None, cache_words: int = 1 << 18):
+        self.version, codes = read_codes(codes_path, merges)
+        # 重複的合併規則只算第一次出現的 rank；bpe_codes_reverse 的建法與迭代順序照抄 subword-nmt，
+        # 兩條規則合併出同一字串時（'a'+'bc' / 'ab'+'c'）拆回去的結果才會一致
+        first = dict((code, i) for i, code in reversed(list(enumerate(codes))))
+        self.ranks = {pair: (i, pair[0] + pair[1]) for pair, i in first.items()}
+        self.reverse = {a + b: (a, b) for a, b in first}
+        self.vocab = read_vocabulary(vocab_path, vocab_threshold) if vocab_path else None
+        self.separator = separator
+        self._join = separator + ' '
+        self.cache_words = cache_words
+        self.segment_word = lru_cache(maxsize=cache_words)(self._segment_word) if cache_words > 0 \
+            else self._segment_word
+
+    # ------------------------------------------------------------------
+    # 單詞
+    # ------------------------------------------------------------------
+
+    def _merge(self, orig: str) -> List[str]:
+        """依 rank 由小到大套用合併規則（同 subword-nmt encode，不含詞表檢查）。"""
+        if self.version == (0, 1):
+            word = list(orig) + ['</w>']
+        else:
+            word = list(orig[:-1]) + [orig[-1] + '</w>']
+        get = self.ranks.get
+        no_merge = itertools.repeat(_NO_MERGE)
+        while len(word) > 1:
+            found = list(map(get, zip(word, word[1:]), no_merge))
+            best = min(found)
+            if best is _NO_MERGE:
+                break
+            merged = best[1]
+            j = found.index(best)
+            if found.count(best) == 1:
+                word[j:j + 2] = [merged]
+                continue
+            # 同一 pair 出現多次：由左到右合併，重疊的（x x x -> xx x）跳過
+            new_word = []
+            i = 0
+            while j >= 0:
+                new_word.extend(word[i:j])
+                new_word.append(merged)
+                i = j + 2
+                j = found.index(best, i) if best in found[i:] else -1
+            new_word.extend(word[i:])
+            word = new_word
+        if word[-1] == '</w>':
+            word.pop()
+        elif word[-1].endswith('</w>'):
+            word[-1] = word[-1][:-4]
+        return word
+
+    def _recursive_split(self, segment: str, final: bool = False):
+        """同 subword-nmt recursive_split：把 OOV 片段沿合併規則拆回去，直到在詞表內或無法再拆。"""
+        pair = self.reverse.get(segment + '</w>' if final else segment)
+        if pair is None:
+            yield segment
+            return
+        left, right = pair
+        if final:
+            right = right[:-4]
+        vocab, sep = self.vocab, self.separator
+        if left + sep in vocab:
+            yield left
+        else:
+            yield from self._recursive_split(left, False)
+        if (final and right in vocab) or (not final and right + sep in vocab):
+            yield right
+        else:
+            yield from self._recursive_split(right, final)
+
+    def _check_vocab(self, word: List[str]) -> List[str]:
+        vocab, sep = self.vocab, self.separator
+        out = []
+        for segment in word[:-1]:
+            if segment + sep in vocab:
+                out.append(segment)
+            else:
+                out.extend(self._recursive_split(segment, False))
+        if word[-1] in vocab:
+            out.append(word[-1])
+        else:
+            out.extend(self._recursive_split(word[-1], True))
+        return out
+
+    def _segment_word(self, word: str) -> str:
+        """一個詞切成以空白分隔、非最後一段接上 separator 的字串。"""
+        if len(word) == 1:
+            return word  # subword-nmt 對單一字元不做合併也不檢查詞表
+        parts = self._merge(word)
+        if self.vocab:
+            parts = self._check_vocab(parts)
+        return self._join.join(parts)
+
+    # ------------------------------------------------------------------
+    # 句子 / 行
+    # ------------------------------------------------------------------
+
+    def segment(self, sentence: str) -> str:
+        seg = self.segment_word
+        return ' '.join([seg(w) for w in sentence.strip('\r\n ').split(' ') if w])
+
+    def process_line(self, line: str) -> str:
+        """保留行首 / 行尾的空白與換行（同 subword-nmt BPE.process_line）。"""
+        body = line.strip('\r\n ')
+        if len(body) == len(line):
+            return self.segment(body)
+        lead = len(line) - len(line.lstrip('\r\n '))
+        trail = len(line) - len(line.rstrip('\r\n '))
+        out = line[:lead] + self.segment(body)
+        if trail and trail != len(line):
+            out += line[-trail:]
+        return out
+
+    def cache_info(self):
+        return self.segment_word.cache_info() if self.cache_words > 0 else None
+
+
+# ---------------------------------------------------------------------------
+# 檔案：byte 區段平行處理
+# ---------------------------------------------------------------------------
+
+_WORKER = None
+
+
+def _init_worker(args) -> None:
+    global _WORKER
+    codes, vocab, merges, separator, threshold, cache_words = args
+    _WORKER = BPEApplier(codes, vocab, merges, separator, threshold, cache_words)
+
+
+def _split_lines(text: str) -> List[str]:
+    # 同 apply_bpe.py 的 stdin（TextIOWrapper 通用換行）：\r\n、\r 都轉成 \n
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [s + '\n' for s in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def _process_block(src):
+    """worker：src 為 bytes 或 (path, start, end)；回傳 (輸出 bytes, 行數, 快取命中, 快取未命中)。"""
+    if isinstance(src, tuple):
+        path, a, b = src
+        with open(path, 'rb') as f:
+            f.seek(a)
+            src = f.read(b - a)
+    before = _WORKER.cache_info()
+    lines = _split_lines(src.decode('utf-8'))
+    out = ''.join([_WORKER.process_line(s) for s in lines]).encode('utf-8')
+    after = _WORKER.cache_info()
+    if after is None:
+        return out, len(lines), 0, 0
+    return out, len(lines), after.hits - before.hits, after.misses - before.misses
+
+
+def file_blocks(path: str, block: int):
+    """每約 block bytes 切一段，終點對齊到下一個換行之後（同 export_laser.plain_blocks）。"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        a = 0
+        while a < size:
+            b = min(a + block, size)
+            if b < size:
+                f.seek(b)
+                b += len(f.readline())
+            yield (path, a, b)
+            a = b
+
+
+def stream_blocks(f, block: int):
+    while True:
+        data = f.read(block)
+        if not data:
+            return
+        if not data.endswith(b'\n'):
+            data += f.readline()
+        yield data
+
+
+def apply_file(src: str, dst: str, codes: str, vocab: Optional[str] = None, workers: int = 1,
+               block_mb: float = 4.0, merges: int = -1, separator: str = '@@',
+               vocab_threshold: Optional[int] = None, cache_words: int = 1 << 18):
+    """src / dst 可為 '-'（stdin / stdout）；回傳 (行數, 快取命中, 快取未命中)。"""
+    args = (codes, vocab, merges, separator, vocab_threshold, cache_words)
+    # 先在父行程建一次：codes / vocabulary 路徑錯誤或格式不對時直接拋出，
+    # 否則 Pool 的 initializer 每次失敗都會重開 worker，永遠卡住
+    _init_worker(args)
+    block = max(1, int(block_mb * (1 << 20)))
+    fin = None
+    if src == '-':
+        blocks = stream_blocks(sys.stdin.buffer, block)
+    elif workers > 1:
+        blocks = file_blocks(src, block)  # worker 自行讀取區段，不經 pipe 傳輸入
+    else:
+        fin = open(src, 'rb')
+        blocks = stream_blocks(fin, block)
+    fout = sys.stdout.buffer if dst == '-' else open(dst, 'wb')
+    total = [0, 0, 0]
+    try:
+        if workers > 1:
+            with mp.Pool(workers, initializer=_init_worker, initargs=(args,)) as pool:
+                results = pool.imap(_process_block, blocks)  # imap 保持區段順序
+                for out, *counts in results:
+                    fout.write(out)
+                    total = [x + y for x, y in zip(total, counts)]
+        else:
+            for b in blocks:
+                out, *counts = _process_block(b)
+                fout.write(out)
+                total = [x + y for x, y in zip(total, counts)]
+    finally:
+        if fin is not None:
+            fin.close()
+        if fout is not sys.stdout.buffer:
+            fout.close()
+    return tuple(total)
+
+
+def cache_report(hits: int, misses: int) -> str:
+    looked = hits + misses
+    return f'[BPE] word cache hits={hits} ({hits / looked if looked else 0.0:.1%}) misses={misses}'
+
+
+# ---------------------------------------------------------------------------
+# parity / throughput
+# ---------------------------------------------------------------------------
+
+def subword_nmt_script(bpe_root: str, name: str) -> str:
+    """
+    subword-nmt 腳本的檔案路徑：優先用倉庫旁的 checkout，否則取已安裝 subword_nmt 套件目錄內的同名檔。
+    一律以檔案路徑執行而不用 -m：learn_joint_bpe_and_vocab.py 當 __main__ 時是 import learn_bpe（非相對 import），
+    -m 執行會 ModuleNotFoundError。
+    """
+    script = os.path.join(bpe_root, 'subword_nmt', name)
+    if os.path.isfile(script):
+        return script
+    import importlib.util
+    spec = importlib.util.find_spec('subword_nmt')
+    if spec is None or not spec.submodule_search_locations:
+        raise FileNotFoundError(f'subword-nmt not found: no {script} and no installed subword_nmt package')
+    return os.path.join(list(spec.submodule_search_locations)[0], name)
+
+
+def subword_nmt_cmd(bpe_root: str, codes: str, vocab: Optional[str], merges: int, separator: str,
+                    vocab_threshold: Optional[int]) -> List[str]:
+    """subword-nmt apply_bpe.py 的命令列（stdin → stdout）。"""
+    cmd = [sys.executable, subword_nmt_script(bpe_root, 'apply_bpe.py')]
+    cmd += ['-c', codes, '-m', str(merges), '-s', separator]
+    if vocab:
+        cmd += ['--vocabulary', vocab]
+        if vocab_threshold is not None:
+            cmd += ['--vocabulary-threshold', str(vocab_threshold)]
+    return cmd
+
+
+def check(src: str, codes: str, vocab: Optional[str], workers: int, bpe_root: str = BPE_ROOT, merges: int = -1,
+          separator: str = '@@', vocab_threshold: Optional[int] = None, cache_words: int = 1 << 18,
+          block_mb: float = 4.0, show: int = 10) -> int:
+    """subword-nmt apply_bpe.py（stdin → stdout）與本模組（單行程、workers 個行程）逐行比對並計時，回傳不一致行數。"""
+    with open(src, 'rb') as f:
+        data = f.read()
+    n = len(_split_lines(data.decode('utf-8')))
+    t0 = time.time()
+    ref = subprocess.run(subword_nmt_cmd(bpe_root, codes, vocab, merges, separator, vocab_threshold), input=data,
+                         stdout=subprocess.PIPE, check=True).stdout
+    timings = [('subword-nmt', time.time() - t0)]
+    runs = [1] + ([workers] if workers > 1 else [])
+    bad = 0
+    for w in runs:
+        tmp = f'{src}.bpe_check.{os.getpid()}'
+        t0 = time.time()
+        _, hits, misses = apply_file(src, tmp, codes, vocab, w, block_mb, merges, separator, vocab_threshold,
+                                     cache_words)
+        timings.append((f'bpe_apply -w {w}', time.time() - t0))
+        with open(tmp, 'rb') as f:
+            out = f.read()
+        os.remove(tmp)
+        diff = 0
+        for i, (a, b) in enumerate(itertools.zip_longest(ref.split(b'\n'), out.split(b'\n'))):
+            if a != b:
+                diff += 1
+                if diff <= show:
+                    print(f'[DIFF] -w {w} line {i + 1}\n  subword-nmt: {a!r}\n  bpe_apply  : {b!r}')
+        print(f'[CHECK] -w {w}: {n} lines, {diff} mismatches' + ('' if diff or out == ref else ' (bytes differ)'))
+        if w == 1:
+            print(cache_report(hits, misses))
+        bad += diff or (out != ref)
+    base = timings[0][1]
+    for name, dt in timings:
+        print(f'  {name:<16} {dt:7.2f}s  {n / dt if dt > 0 else 0:10.0f} lines/s  x{base / dt if dt > 0 else 0:.1f}')
+    return bad
+
+
+def main():
+    ap = argparse.ArgumentParser(description='In-process BPE application (subword-nmt apply_bpe.py compatible)')
+    ap.add_argument('-c', '--codes', required=True, help='BPE codes file (learn_bpe.py output)')
+    ap.add_argument('--vocabulary', default=None, help='Vocabulary file; merges producing OOV units are reverted')
+    ap.add_argument('--vocabulary_threshold', type=int, default=None, help='Words with frequency < threshold are OOV')
+    ap.add_argument('-m', '--merges', type=int, default=-1, help='Use only the first N merge operations')
+    ap.add_argument('-s', '--separator', default='@@')
+    ap.add_argument('-i', '--input', default='-', help="Input file ('-' = stdin)")
+    ap.add_argument('-o', '--output', default='-', help="Output file ('-' = stdout)")
+    ap.add_argument('-w', '--workers', type=int, default=1, help='Worker processes (0 = cpu_count)')
+    ap.add_argument('--block_mb', type=float, default=4.0, help='Bytes per work unit in MiB')
+    ap.add_argument('--cache_words', type=int, default=1 << 18, help='LRU bound of the per-word cache (0 = off)')
+    ap.add_argument('--check', action='store_true', help='Compare against subword-nmt apply_bpe.py and time both')
+    ap.add_argument('--bpe_root', default=BPE_ROOT, help='subword-nmt checkout used by --check')
+    args = ap.parse_args()
+
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    try:
+        if args.check:
+            if args.input == '-':
+                ap.error('--check needs -i FILE')
+            bad = check(args.input, args.codes, args.vocabulary, workers, args.bpe_root, args.merges, args.separator,
+                        args.vocabulary_threshold, args.cache_words, args.block_mb)
+            sys.exit(1 if bad else 0)
+        t0 = time.time()
+        n, hits, misses = apply_file(args.input, args.output, args.codes, args.vocabulary, workers, args.block_mb,
+                                     args.merges, args.separator, args.vocabulary_threshold, args.cache_words)
+    except (OSError, ValueError) as e:
+        print(f'[ERROR] {e}', file=sys.stderr)
+        sys.exit(2)
+    dt = time.time() - t0
+    print(f'[BPE] {n} lines in {dt:.1f}s ({n / dt if dt > 0 else 0:.0f} lines/s, workers={workers})', file=sys.stderr)
+    if args.cache_words > 0:
+        print(cache_report(hits, misses) + (' (summed over workers)' if workers > 1 else ''), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+bpe_learn.py
+- 取代 `learn_joint_bpe_and_vocab.py --input IN -s N -o bpecode.<lang> --write-vocabulary voc.<lang>`，
+  bpecode / voc 與 subword-nmt 逐 byte 相同（#version: 0.2、同頻 pair 取字串較大者、--min_frequency 預設 2）
+- 詞頻表以 map / reduce 建立：檔案依 byte 區段（對齊換行）交給 process pool，各區段的 Counter
+  依檔案順序合併（保留詞第一次出現的順序，voc 同頻詞的先後由此決定）
+- 合併在詞頻表上進行：pair → 出現的詞 的索引 + 頻率，每次合併只重算含該 pair 的詞，
+  最高頻 pair 由 heap（lazy 刪除）取出，不再每輪掃過整個 pair 統計表
+- voc 以 bpe_apply 切分詞頻表後累計，不再把整份語料套一次 BPE 再數一次
+- --sample R：詞頻表按 token 做 binomial thinning（高頻詞保留原次數），抽中的詞頻除以 R 還原尺度，
+  只在較小的詞表上學合併；voc 仍以完整詞頻計。合併表會與完整語料的結果略有不同（--seed 固定結果）
+- 詞與行的切法同 learn_bpe.get_vocabulary（行依 str.splitlines、詞以單一空白分隔）；
+  voc 與 learn_joint_bpe_and_vocab.py 的差異只可能出現在含 \\x0b、\\x1c、\\x85、\\u2028 這類行分隔字元
+  或非空白的 whitespace 的語料，tokenizer.perl 的輸出不會有
+
+用法：
+  python bpe_learn.py -i norm.tok.true.id -s 32000 -o bpecode.id --write_vocabulary voc.id [-w 8] [--sample 0.2]
+  python bpe_learn.py -i sample.txt -s 8000 -o /tmp/codes --write_vocabulary /tmp/voc --check [-w 8]
+      與 subword-nmt learn_joint_bpe_and_vocab.py 比對輸出並比較耗時
+"""
+
+import os
+import sys
+import time
+import heapq
+import random
+import argparse
+import tempfile
+import subprocess
+import multiprocessing as mp
+from collections import Counter, defaultdict
+from typing import List, Tuple
+
+from bpe_apply import BPE_ROOT, BPEApplier, file_blocks, subword_nmt_script
+
+# tokens * rate 超過這個數的詞不抽樣，直接保留原次數
+_THIN_EXACT = 64
+# 每幾個合併印一次進度
+_LOG_EVERY = 2000
+
+
+def words_of(text: str) -> List[str]:
+    """
+    同 learn_bpe.get_vocabulary 讀 codecs 檔案：行依 str.splitlines 切（含 \\r、\\x1c、\\x85 ...），
+    每行 strip('\\r\\n ') 後以單一空白切詞；回傳值含空字串，由呼叫端刪掉。
+    """
+    return ' '.join(text.splitlines(True)).replace('\r', ' ').replace('\n', ' ').split(' ')
+
+
+def _count_block(src) -> Counter:
+    """worker：src 為 (path, start, end)。"""
+    path, a, b = src
+    with open(path, 'rb') as f:
+        f.seek(a)
+        counts = Counter(words_of(f.read(b - a).decode('utf-8')))
+    counts.pop('', None)
+    return counts
+
+
+def count_words(path: str, workers: int = 1, block_mb: float = 32.0, pool=None) -> Counter:
+    """map：各區段各自計數；reduce：依區段順序合併。"""
+    blocks = file_blocks(path, max(1, int(block_mb * (1 << 20))))
+    counts = Counter()
+    parts = pool.imap(_count_block, blocks) if pool is not None and workers > 1 else map(_count_block, blocks)
+    for part in parts:
+        counts.update(part)
+    return counts
+
+
+def subsample(counts: Counter, rate: float, seed: int = 0) -> Counter:
+    """每個 token 以機率 rate 保留，保留次數除以 rate 還原尺度；保留的詞維持原本的順序。"""
+    rng = random.Random(seed)
+    out = Counter()
+    for w, c in counts.items():
+        if c * rate >= _THIN_EXACT:
+            out[w] = c
+            continue
+        kept = sum(rng.random() < rate for _ in range(c))
+        if kept:
+            out[w] = max(1, round(kept / rate))
+    return out
+
+
+class _Desc:
+    """heap 內同頻的 pair 依字串由大到小出列，等同 max(stats, key=lambda x: (stats[x], x))。"""
+    __slots__ = ('pair',)
+
+    def __init__(self, pair: Tuple[str, str]):
+        self.pair = pair
+
+    def __lt__(self, other: '_Desc') -> bool:
+        return self.pair > other.pair
+
+
+def _merge_symbols(word: tuple, first: str, second: str, new: str) -> tuple:
+    """由左到右、不重疊地把 (first, second) 換成 new（同 learn_bpe.replace_pair 的 regex 替換）。"""
+    out = []
+    i, n = 0, len(word) - 1
+    while i <= n:
+        if i < n and word[i] == first and word[i + 1] == second:
+            out.append(new)
+            i += 2
+        else:
+            out.append(word[i])
+            i += 1
+    return tuple(out)
+
+
+def learn_merges(counts: Counter, num_symbols: int, min_frequency: int = 2, log=sys.stderr) -> List[Tuple[str, str]]:
+    """在詞頻表上學 num_symbols 個合併；最高頻 pair 低於 min_frequency 時提前停止（同 learn_bpe）。"""
+    words = [tuple(w[:-1]) + (w[-1] + '</w>',) for w in counts]
+    freqs = list(counts.values())
+    stats = defaultdict(int)
+    where = defaultdict(set)  # pair -> 含這個 pair 的詞的 index
+    for j, (word, f) in enumerate(zip(words, freqs)):
+        for pair in zip(word, word[1:]):
+            stats[pair] += f
+            where[pair].add(j)
+    # heap 內每個 pair 的頻率 >= 目前的實際頻率；出列時不一致就以實際頻率重新放回
+    heap = [(-c, _Desc(pair)) for pair, c in stats.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    t0 = time.time()
+    while len(merges) < num_symbols:
+        best = None
+        while heap:
+            neg, item = heap[0]
+            c = stats.get(item.pair, 0)
+            if -neg == c:
+                best = item.pair
+                break
+            if c > 0:
+                heapq.heapreplace(heap, (-c, item))
+            else:
+                heapq.heappop(heap)
+        if best is None or stats[best] < min_frequency:
+            print(f'no pair has frequency >= {min_frequency}. Stopping', file=log)
+            break
+        merges.append(best)
+
+        first, second = best
+        new = first + second
+        delta = defaultdict(int)
+        for j in where.pop(best):
+            old = words[j]
+            word = _merge_symbols(old, first, second, new)
+            words[j] = word
+            f = freqs[j]
+            old_pairs, new_pairs = list(zip(old, old[1:])), list(zip(word, word[1:]))
+            for pair in old_pairs:
+                delta[pair] -= f
+            for pair in new_pairs:
+                delta[pair] += f
+            for pair in set(old_pairs).difference(new_pairs):
+                s = where.get(pair)
+                if s is not None:
+                    s.discard(j)
+                    if not s:
+                        del where[pair]
+            for pair in set(new_pairs).difference(old_pairs):
+                where[pair].add(j)
+        for pair, d in delta.items():
+            if not d:
+                continue
+            c = stats[pair] + d
+            if c > 0:
+                stats[pair] = c
+                if d > 0:
+                    heapq.heappush(heap, (-c, _Desc(pair)))
+            else:
+                del stats[pair]
+        if len(merges) % _LOG_EVERY == 0:
+            print(f'[BPE] {len(merges)}/{num_symbols} merges ({time.time() - t0:.1f}s)', file=log, flush=True)
+    return merges
+
+
+def write_codes(merges: List[Tuple[str, str]], path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n')
+        f.write(''.join(f'{a} {b}\n' for a, b in merges))
+
+
+_APPLIER = None
+
+
+def _init_worker(codes: str, separator: str) -> None:
+    global _APPLIER
+    _APPLIER = BPEApplier(codes, separator=separator, cache_words=0)
+
+
+def _count_pieces(items) -> Counter:
+    voc = Counter()
+    for w, c in items:
+        for piece in _APPLIER.segment_word(w).split(' '):
+            voc[piece] += c
+    return voc
+
+
+def _chunks(items, size: int):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def vocabulary(counts: Counter, codes: str, separator: str = '@@', workers: int = 1) -> Counter:
+    """
+    詞頻表每個詞切一次、乘上詞頻累計，等同 learn_joint_bpe_and_vocab.py 把語料套 BPE 後再數一次；
+    依詞的順序累計，同頻 subword 的先後與它相同。
+    """
+    items = counts.items()
+    if workers <= 1:
+        _init_worker(codes, separator)
+        return _count_pieces(items)
+    voc = Counter()
+    with mp.Pool(workers, initializer=_init_worker, initargs=(codes, separator)) as pool:
+        for part in pool.imap(_count_pieces, _chunks(items, 50000)):
+            voc.update(part)
+    return voc
+
+
+def write_vocabulary(voc: Counter, path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(''.join(f'{k} {c}\n' for k, c in sorted(voc.items(), key=lambda x: x[1], reverse=True)))
+
+
+def learn_from_counts(counts: Counter, codes: str, vocab: str, symbols: int, min_frequency: int = 2,
+                      separator: str = '@@', workers: int = 1, sample: float = 0.0, seed: int = 0,
+                      log=sys.stderr) -> dict:
+    """詞頻表 → bpecode + voc；回傳各段耗時（秒）。preprocess_stream.py 在串流時累計詞頻後直接呼叫。"""
+    timings = {}
+    t0 = time.time()
+    table = subsample(counts, sample, seed) if 0 < sample < 1 else counts
+    if table is not counts:
+        print(f'[BPE] sample {sample}: {len(table)}/{len(counts)} word types', file=log)
+    write_codes(learn_merges(table, symbols, min_frequency, log), codes)
+    timings['merges'] = time.time() - t0
+    t0 = time.time()
+    write_vocabulary(vocabulary(counts, codes, separator, workers), vocab)
+    timings['vocabulary'] = time.time() - t0
+    return timings
+
+
+def learn_file(src: str, codes: str, vocab: str, symbols: int, min_frequency: int = 2, separator: str = '@@',
+               workers: int = 1, block_mb: float = 32.0, sample: float = 0.0, seed: int = 0,
+               log=sys.stderr) -> dict:
+    t0 = time.time()
+    if workers > 1:
+        with mp.Pool(workers) as pool:
+            counts = count_words(src, workers, block_mb, pool)
+    else:
+        counts = count_words(src, 1, block_mb)
+    timings = {'count': time.time() - t0}
+    print(f'[BPE] {len(counts)} word types, {sum(counts.values())} tokens ({timings["count"]:.1f}s)', file=log)
+    timings.update(learn_from_counts(counts, codes, vocab, symbols, min_frequency, separator, workers, sample, seed,
+                                     log))
+    return timings
+
+
+# ---------------------------------------------------------------------------
+# parity / 耗時
+# ---------------------------------------------------------------------------
+
+def subword_nmt_cmd(bpe_root: str, src: str, codes: str, vocab: str, symbols: int, min_frequency: int,
+                    separator: str) -> List[str]:
+    """subword-nmt learn_joint_bpe_and_vocab.py 的命令列。"""
+    cmd = [sys.executable, subword_nmt_script(bpe_root, 'learn_joint_bpe_and_vocab.py')]
+    return cmd + ['--input', src, '-s', str(symbols), '-o', codes, '--write-vocabulary', vocab,
+                  '--min-frequency', str(min_frequency), '--separator', separator]
+
+
+def check(src: str, symbols: int, min_frequency: int = 2, separator: str = '@@', workers: int = 1,
+          block_mb: float = 32.0, bpe_root: str = BPE_ROOT) -> int:
+    """subword-nmt learn_joint_bpe_and_vocab.py 與本模組各跑一次，比對 bpecode / voc 並計時；回傳不一致的檔案數。"""
+    with tempfile.TemporaryDirectory() as tmp:
+        ref_codes, ref_voc = os.path.join(tmp, 'ref.codes'), os.path.join(tmp, 'ref.voc')
+        out_codes, out_voc = os.path.join(tmp, 'out.codes'), os.path.join(tmp, 'out.voc')
+        t0 = time.time()
+        subprocess.run(subword_nmt_cmd(bpe_root, src, ref_codes, ref_voc, symbols, min_frequency, separator),
+                       check=True, stderr=subprocess.DEVNULL)
+        base = time.time() - t0
+        t0 = time.time()
+        timings = learn_file(src, out_codes, out_voc, symbols, min_frequency, separator, workers, block_mb)
+        ours = time.time() - t0
+        bad = 0
+        for name, a, b in (('bpecode', ref_codes, out_codes), ('voc', ref_voc, out_voc)):
+            with open(a, 'rb') as f:
+                ref = f.read().split(b'\n')
+            with open(b, 'rb') as f:
+                out = f.read().split(b'\n')
+            diff = next((i for i, (x, y) in enumerate(zip(ref, out)) if x != y), None)
+            if diff is None and len(ref) == len(out):
+                print(f'[CHECK] {name}: {len(ref) - 1} lines, identical')
+                continue
+            bad += 1
+            where = diff if diff is not None else min(len(ref), len(out))
+            print(f'[CHECK] {name}: differs at line {where + 1} ({len(ref) - 1} vs {len(out) - 1} lines)')
+            if diff is not None:
+                print(f'  subword-nmt: {ref[diff]!r}\n  bpe_learn  : {out[diff]!r}')
+    print(f'  subword-nmt  {base:8.2f}s')
+    print(f'  bpe_learn    {ours:8.2f}s  x{base / ours if ours > 0 else 0:.1f}  (-w {workers}: '
+          + ', '.join(f'{k} {v:.1f}s' for k, v in timings.items()) + ')')
+    return bad
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Learn BPE codes + vocabulary (learn_joint_bpe_and_vocab.py compatible)')
+    ap.add_argument('-i', '--input', required=True, help='Tokenized training text')
+    ap.add_argument('-o', '--output', default='', help='BPE codes file')
+    ap.add_argument('--write_vocabulary', default='', help='Vocabulary file ("subword freq" per line)')
+    ap.add_argument('-s', '--symbols', type=int, default=10000, help='Number of merge operations')
+    ap.add_argument('--min_frequency', type=int, default=2, help='Stop if no pair has frequency >= FREQ')
+    ap.add_argument('--separator', default='@@')
+    ap.add_argument('-w', '--workers', type=int, default=1, help='Worker processes (0 = cpu_count)')
+    ap.add_argument('--block_mb', type=float, default=32.0, help='Bytes per counting work unit in MiB')
+    ap.add_argument('--sample', type=float, default=0.0,
+                    help='Learn merges on a token subsample of this rate (0 = off); vocabulary still uses full counts')
+    ap.add_argument('--seed', type=int, default=0, help='Seed for --sample')
+    ap.add_argument('--check', action='store_true', help='Compare against subword-nmt learn_joint_bpe_and_vocab.py')
+    ap.add_argument('--bpe_root', default=BPE_ROOT, help='subword-nmt checkout used by --check')
+    args = ap.parse_args()
+
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    if args.check:
+        sys.exit(1 if check(args.input, args.symbols, args.min_frequency, args.separator, workers, args.block_mb,
+                            args.bpe_root) else 0)
+    if not args.output or not args.write_vocabulary:
+        ap.error('-o and --write_vocabulary are required')
+    t0 = time.time()
+    try:
+        timings = learn_file(args.input, args.output, args.write_vocabulary, args.symbols, args.min_frequency,
+                             args.separator, workers, args.block_mb, args.sample, args.seed)
+    except ValueError as e:
+        print(f'[ERROR] {e}', file=sys.stderr)
+        sys.exit(2)
+    print(f'[BPE] {args.output}, {args.write_vocabulary} in {time.time() - t0:.1f}s ('
+          + ', '.join(f'{k} {v:.1f}s' for k, v in timings.items()) + f', workers={workers})', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+preprocess_pipeline.py
+- 取代 preprocess.sh 的循序流程：normalize → HanLP → tokenize → truecase → BPE → clean-corpus-n.perl → split.py
+  宣告成 DAG，中文與目標語言兩條分支在 clean 之前互不相依，同時執行（--jobs 個步驟並行）
+- 每個步驟在快取目錄 <cache_dir>/<步驟>/<key>/ 內執行，key = md5(指令 + 參數 + 程式檔內容 + 輸入檔內容)：
+    檔案內容的 md5 依 path / size / mtime 記在 file_digests.json，不重複讀；
+    輸入以內容計，改一個參數只重跑受影響的步驟，上游重跑但輸出不變時下游仍直接沿用快取
+  完成後原子寫入 .done，已有 .done 的步驟直接略過；失敗時工作目錄保留 stage.log 供檢查
+- 只影響速度的參數（-w、HanLP 快取目錄）不列入 key
+- 最後把 train/valid/test、truecase / BPE 模型（KEEP_HANLP 時另有 keep/ 斷詞成果）hard link（不行時複製）
+  到 data/ 與 models/；中間檔只留在快取，不再寫進 data 目錄再刪除。快取內的檔案視為唯讀
+- 每次執行印出各步驟的狀態與 wall time，並寫入 <data_dir>/preprocess_report.json；
+  每個步驟只保留最近 --cache_keep 份快取
+
+用法：
+  python preprocess_pipeline.py my_corpus [--jobs 2] [--moses python] [--hanlp_workers 4] [--dry_run]
+  python preprocess_pipeline.py my_corpus --force hanlp_zh          # 強制重跑指定步驟（all = 全部）
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import subprocess
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List
+
+SRC = 'zh'
+TGT = 'en'
+INPUT_PREFIX = 'raw'
+# 保留 HanLP 斷詞成果（斷詞原文 + 斷詞後 tokenized）到 data/<model>/keep/
+KEEP_HANLP = False
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.abspath(os.path.join(BASE_DIR, '..'))
+MOSES_SCRIPTS = os.path.join(REPO, '../mosesdecoder/scripts')
+CACHE_DIR = os.path.join(REPO, '.stage_cache')
+
+NORM_PUNC = os.path.join(MOSES_SCRIPTS, 'tokenizer/normalize-punctuation.perl')
+TOKENIZER = os.path.join(MOSES_SCRIPTS, 'tokenizer/tokenizer.perl')
+TRAIN_TC = os.path.join(MOSES_SCRIPTS, 'recaser/train-truecaser.perl')
+TC = os.path.join(MOSES_SCRIPTS, 'recaser/truecase.perl')
+CLEAN = os.path.join(MOSES_SCRIPTS, 'training/clean-corpus-n.perl')
+
+
+def util(name: str) -> str:
+    return os.path.join(BASE_DIR, name)
+
+
+def prefix_file(lang: str) -> str:
+    return os.path.join(MOSES_SCRIPTS, 'share/nonbreaking_prefixes', f'nonbreaking_prefix.{lang}')
+
+
+# 步驟輸入：stage 非空時為上游步驟的輸出檔名 name，否則為外部檔案 path
+Ref = namedtuple('Ref', 'stage name path')
+
+
+def output_of(stage: str, name: str) -> Ref:
+    return Ref(stage, name, None)
+
+
+def external(path: str) -> Ref:
+    return Ref(None, None, os.path.abspath(os.path.expanduser(path)))
+
+
+class Stage:
+    """
+    一個步驟：cwd = 自己的工作目錄，inputs 以 key（檔名）symlink 進工作目錄，
+    執行 argv（stdin / stdout 可接工作目錄內的檔案），結束時 outputs 必須都存在。
+    """
+
+    def __init__(self, name: str, argv: List[str], inputs: Dict[str, Ref], outputs: List[str], code=(),
+                 stdin: str = None, stdout: str = None, perf_args=()):
+        self.name = name
+        self.argv = list(argv)
+        self.inputs = dict(inputs)
+        self.outputs = list(outputs)
+        self.code = list(code)
+        self.stdin = stdin
+        self.stdout = stdout
+        self.perf_args = list(perf_args)  # 只影響速度、不影響輸出，不列入 key
+
+    @property
+    def deps(self) -> List[str]:
+        return sorted({r.stage for r in self.inputs.values() if r.stage})
+
+
+class StageError(RuntimeError):
+    pass
+
+
+# ---------------------------------------------------------------------------
+# key / 快取
+# ---------------------------------------------------------------------------
+
+class FileDigests:
+    """檔案內容 md5，依 (realpath, size, mtime_ns) 記在 cache_dir/file_digests.json，檔案沒變就不重讀。"""
+
+    def __init__(self, cache_dir: Path):
+        self.path = cache_dir / 'file_digests.json'
+        try:
+            self.memo = json.loads(self.path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self.memo = {}
+        self.dirty = False
+
+    def get(self, path: str) -> str:
+        real = os.path.realpath(path)
+        try:
+            st = os.stat(real)
+        except FileNotFoundError:
+            return 'missing'
+        stamp = [st.st_size, st.st_mtime_ns]
+        hit = self.memo.get(real)
+        if hit and hit[:2] == stamp:
+            return hit[2]
+        h = hashlib.md5()
+        with open(real, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        self.memo[real] = stamp + [h.hexdigest()]
+        self.dirty = True
+        return h.hexdigest()
+
+    def save(self) -> None:
+        if self.dirty:
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            tmp.write_text(json.dumps(self.memo, ensure_ascii=False, indent=1), encoding='utf-8')
+            os.replace(tmp, self.path)
+            self.dirty = False
+
+
+def stage_key(stage: Stage, resolved: Dict[str, str], digests: FileDigests) -> str:
+    payload = {
+        'stage': stage.name,
+        'argv': stage.argv,
+        'stdin': stage.stdin,
+        'stdout': stage.stdout,
+        'outputs': stage.outputs,
+        'code': {os.path.basename(p): digests.get(p) for p in stage.code},
+        'inputs': {label: digests.get(path) for label, path in sorted(resolved.items())},
+    }
+    return hashlib.md5(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def read_done(stage_dir: Path) -> dict:
+    try:
+        return json.loads((stage_dir / '.done').read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+
+
+def write_done(stage_dir: Path, info: dict) -> None:
+    tmp = stage_dir / '.done.tmp'
+    tmp.write_text(json.dumps(info, ensure_ascii=False) + '\n', encoding='utf-8')
+    os.replace(tmp, stage_dir / '.done')
+
+
+def prune(cache_dir: Path, stage: str, keep: int, used: str) -> int:
+    """每個步驟只保留最近 keep 份完成的快取（本次用到的一定保留），以及一天內的未完成工作目錄。"""
+    root = cache_dir / stage
+    if not root.is_dir():
+        return 0
+    done, removed = [], 0
+    for d in root.iterdir():
+        if not d.is_dir() or d.name == used:
+            continue
+        if (d / '.done').exists():
+            done.append(d)
+        elif time.time() - d.stat().st_mtime > 86400:
+            shutil.rmtree(d, ignore_errors=True)
+            removed += 1
+    done.sort(key=lambda d: (d / '.done').stat().st_mtime, reverse=True)
+    for d in done[max(0, keep - 1):]:
+        shutil.rmtree(d, ignore_errors=True)
+        removed += 1
+    return removed
+
+
+# ---------------------------------------------------------------------------
+# 執行
+# ---------------------------------------------------------------------------
+
+def run_stage(stage: Stage, key: str, cache_dir: Path, resolved: Dict[str, str]) -> float:
+    """在 <cache_dir>/<stage>/<key>.tmp<pid> 執行，成功後改名成 <key>/；回傳秒數。"""
+    final = cache_dir / stage.name / key
+    work = cache_dir / stage.name / f'{key}.tmp{os.getpid()}'
+    shutil.rmtree(work, ignore_errors=True)
+    work.mkdir(parents=True)
+    for label, path in resolved.items():
+        os.symlink(path, work / label)
+    t0 = time.time()
+    with open(work / 'stage.log', 'wb') as log:
+        fin = open(work / stage.stdin, 'rb') if stage.stdin else subprocess.DEVNULL
+        fout = open(work / stage.stdout, 'wb') if stage.stdout else log
+        try:
+            rc = subprocess.run(stage.argv + stage.perf_args, cwd=str(work), stdin=fin, stdout=fout,
+                                stderr=log).returncode
+        finally:
+            if stage.stdin:
+                fin.close()
+            if stage.stdout:
+                fout.close()
+    dt = time.time() - t0
+    missing = [o for o in stage.outputs if not (work / o).is_file()]
+    if rc != 0 or missing:
+        raise StageError(f'{stage.name} failed (exit {rc}, missing {missing or "none"}); log: {work / "stage.log"}')
+    for label in resolved:
+        (work / label).unlink()  # 輸入連結不留在快取
+    write_done(work, {'stage': stage.name, 'key': key, 'seconds': round(dt, 3), 'finished_at': time.time()})
+    if final.exists():
+        shutil.rmtree(final)  # 另一個執行同時完成了同一個 key
+    os.rename(work, final)
+    return dt
+
+
+def log_tail(msg: str, n: int = 20) -> str:
+    path = msg.rsplit('log: ', 1)[-1]
+    try:
+        with open(path, 'rb') as f:
+            lines = f.read().decode('utf-8', 'replace').splitlines()
+    except OSError:
+        return ''
+    return '\n'.join('    ' + s for s in lines[-n:])
+
+
+def run_dag(stages: List[Stage], cache_dir: Path, jobs: int, force=(), dry_run: bool = False):
+    """依相依關係排程，最多 jobs 個步驟同時執行；回傳 (各步驟的 key, 報表列, 是否全部成功, wall 秒數)。"""
+    by_name = {s.name: s for s in stages}
+    for s in stages:
+        for d in s.deps:
+            if d not in by_name:
+                raise ValueError(f'{s.name}: unknown upstream stage {d}')
+    digests = FileDigests(cache_dir)
+    keys, rows = {}, {}
+    pending = [s.name for s in stages]
+    running = {}
+    failed = False
+    t_start = time.time()
+
+    def finish(name: str, status: str, seconds: float = 0.0, **extra) -> None:
+        rows[name] = dict({'stage': name, 'status': status, 'seconds': round(seconds, 3), 'key': keys.get(name, '')},
+                          **extra)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while pending or running:
+            changed = not failed
+            while changed:
+                changed = False
+                for name in list(pending):
+                    s = by_name[name]
+                    up = [rows.get(d, {}).get('status') for d in s.deps]
+                    if any(u in ('failed', 'skipped') for u in up):
+                        pending.remove(name)
+                        finish(name, 'skipped')
+                        changed = True
+                        continue
+                    if None in up:
+                        continue  # 上游還沒完成
+                    if 'stale' in up:  # --dry_run：上游沒有輸出可算 key，下游一律要重跑
+                        pending.remove(name)
+                        finish(name, 'stale')
+                        print(f'[STALE] {name}', flush=True)
+                        changed = True
+                        continue
+                    resolved = {label: str(cache_dir / r.stage / keys[r.stage] / r.name) if r.stage else r.path
+                                for label, r in s.inputs.items()}
+                    keys[name] = key = stage_key(s, resolved, digests)
+                    done = read_done(cache_dir / name / key)
+                    if done and name not in force and 'all' not in force:
+                        finish(name, 'cached', original_seconds=done.get('seconds'))
+                        print(f'[CACHED] {name} ({key[:8]})', flush=True)
+                    elif dry_run:
+                        finish(name, 'stale')
+                        print(f'[STALE] {name} ({key[:8]})', flush=True)
+                    elif len(running) < max(1, jobs):
+                        print(f'[RUN] {name} ({key[:8]})', flush=True)
+                        running[pool.submit(run_stage, s, key, cache_dir, resolved)] = name
+                    else:
+                        continue
+                    pending.remove(name)
+                    changed = True
+            if not running:
+                for name in pending:
+                    finish(name, 'skipped')
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                try:
+                    dt = fut.result()
+                    finish(name, 'ran', dt)
+                    print(f'[DONE] {name} {dt:.1f}s', flush=True)
+                except (StageError, OSError) as e:
+                    failed = True
+                    finish(name, 'failed')
+                    print(f'[ERROR] {e}\n{log_tail(str(e))}', flush=True)
+    digests.save()
+    return keys, [rows[s.name] for s in stages], not failed, time.time() - t_start
+
+
+# ---------------------------------------------------------------------------
+# preprocess.sh 的 DAG
+# ---------------------------------------------------------------------------
+
+def build_stages(args) -> List[Stage]:
+    src, tgt = SRC, args.tgt
+    py = sys.executable
+    w = ['-w', str(args.workers)]
+
+    def normalize(lang: str, inp: Ref) -> Stage:
+        if args.moses == 'python':
+            return Stage(f'norm_{lang}', [py, util('moses_text.py'), 'norm', '-l', lang, '-i', f'in.{lang}',
+                                          '-o', f'norm.{lang}'], {f'in.{lang}': inp}, [f'norm.{lang}'],
+                         code=[util('moses_text.py')], perf_args=w)
+        return Stage(f'norm_{lang}', ['perl', NORM_PUNC, '-l', lang], {f'in.{lang}': inp}, [f'norm.{lang}'],
+                     code=[NORM_PUNC], stdin=f'in.{lang}', stdout=f'norm.{lang}')
+
+    def tokenize(lang: str, name: str, inp: Ref, out: str) -> Stage:
+        code = [prefix_file(lang), prefix_file('en')]
+        if args.moses == 'python':
+            return Stage(name, [py, util('moses_text.py'), 'tok', '-l', lang, '-i', 'in', '-o', out],
+                         {'in': inp}, [out], code=code + [util('moses_text.py')], perf_args=w)
+        return Stage(name, ['perl', TOKENIZER, '-l', lang], {'in': inp}, [out], code=code + [TOKENIZER],
+                     stdin='in', stdout=out)
+
+    def learn_bpe(lang: str, inp: Ref) -> Stage:
+        sample = ['--sample', str(args.bpe_sample), '--seed', str(args.seed)] if args.bpe_sample else []
+        return Stage(f'learn_bpe_{lang}', [py, util('bpe_learn.py'), '-i', 'in', '-s', str(args.bpe_ops),
+                                           '-o', f'bpecode.{lang}', '--write_vocabulary', f'voc.{lang}'] + sample,
+                     {'in': inp}, [f'bpecode.{lang}', f'voc.{lang}'],
+                     code=[util('bpe_learn.py'), util('bpe_apply.py')], perf_args=w)
+
+    def apply_bpe(lang: str, inp: Ref, out: str) -> Stage:
+        return Stage(f'apply_bpe_{lang}', [py, util('bpe_apply.py'), '-c', f'bpecode.{lang}', '--vocabulary',
+                                           f'voc.{lang}', '-i', 'in', '-o', out],
+                     {'in': inp, f'bpecode.{lang}': output_of(f'learn_bpe_{lang}', f'bpecode.{lang}'),
+                      f'voc.{lang}': output_of(f'learn_bpe_{lang}', f'voc.{lang}')},
+                     [out], code=[util('bpe_apply.py')], perf_args=w)
+
+    hanlp_perf = ['-w', str(args.hanlp_workers)]
+    if args.hanlp_cache_dir:
+        hanlp_perf += ['--cache_dir', args.hanlp_cache_dir]
+    stages = [
+        # 目標語言分支
+        normalize(tgt, external(os.path.join(args.data_dir, f'{args.input_prefix}.{tgt}'))),
+        tokenize(tgt, f'tok_{tgt}', output_of(f'norm_{tgt}', f'norm.{tgt}'), f'norm.tok.{tgt}'),
+        Stage(f'train_tc_{tgt}', ['perl', TRAIN_TC, '--model', f'truecase-model.{tgt}', '--corpus', 'in'],
+              {'in': output_of(f'tok_{tgt}', f'norm.tok.{tgt}')}, [f'truecase-model.{tgt}'], code=[TRAIN_TC]),
+        Stage(f'tc_{tgt}', ['perl', TC, '--model', f'truecase-model.{tgt}'],
+              {'in': output_of(f'tok_{tgt}', f'norm.tok.{tgt}'),
+               f'truecase-model.{tgt}': output_of(f'train_tc_{tgt}', f'truecase-model.{tgt}')},
+              [f'norm.tok.true.{tgt}'], code=[TC], stdin='in', stdout=f'norm.tok.true.{tgt}'),
+        learn_bpe(tgt, output_of(f'tc_{tgt}', f'norm.tok.true.{tgt}')),
+        apply_bpe(tgt, output_of(f'tc_{tgt}', f'norm.tok.true.{tgt}'), f'norm.tok.true.bpe.{tgt}'),
+        # 中文分支
+        normalize(src, external(os.path.join(args.data_dir, f'{args.input_prefix}.{src}'))),
+        Stage(f'hanlp_{src}', [py, util('hanlp_segment.py'), '-if', f'norm.{src}', '-of', f'norm.seg.{src}'],
+              {f'norm.{src}': output_of(f'norm_{src}', f'norm.{src}')}, [f'norm.seg.{src}'],
+              code=[util('hanlp_segment.py'), util('seg_cache.py')], perf_args=hanlp_perf),
+        tokenize(src, f'tok_{src}', output_of(f'hanlp_{src}', f'norm.seg.{src}'), f'norm.seg.tok.{src}'),
+        learn_bpe(src, output_of(f'tok_{src}', f'norm.seg.tok.{src}')),
+        apply_bpe(src, output_of(f'tok_{src}', f'norm.seg.tok.{src}'), f'norm.seg.tok.bpe.{src}'),
+        # 合流
+        Stage('clean', ['perl', CLEAN, 'toclean', src, tgt, 'clean', str(args.clean_min), str(args.clean_max)],
+              {f'toclean.{src}': output_of(f'apply_bpe_{src}', f'norm.seg.tok.bpe.{src}'),
+               f'toclean.{tgt}': output_of(f'apply_bpe_{tgt}', f'norm.tok.true.bpe.{tgt}')},
+              [f'clean.{src}', f'clean.{tgt}'], code=[CLEAN]),
+        Stage('split', [py, util('split.py'), f'clean.{src}', f'clean.{tgt}', './', '--src_lang', src, '--tgt_lang', tgt,
+                        '--test', str(args.split_test), '--valid', str(args.split_valid), '--seed', str(args.split_seed)],
+              {f'clean.{src}': output_of('clean', f'clean.{src}'), f'clean.{tgt}': output_of('clean', f'clean.{tgt}')},
+              [f'{part}.{lang}' for part in ('train', 'valid', 'test') for lang in (src, tgt)],
+              code=[util('split.py')], perf_args=w),
+    ]
+    return stages
+
+
+def published(args) -> List[tuple]:
+    """(步驟, 輸出檔名, 目的地)：最後放到 data/ 與 models/ 的檔案。"""
+    src, tgt = SRC, args.tgt
+    data, model = Path(args.data_dir), Path(args.model_dir)
+    out = [('split', f'{part}.{lang}', data / f'{part}.{lang}')
+           for part in ('train', 'valid', 'test') for lang in (src, tgt)]
+    out.append((f'train_tc_{tgt}', f'truecase-model.{tgt}', model / f'truecase-model.{tgt}'))
+    for lang in (tgt, src):
+        out += [(f'learn_bpe_{lang}', f'bpecode.{lang}', model / f'bpecode.{lang}'),
+                (f'learn_bpe_{lang}', f'voc.{lang}', model / f'voc.{lang}')]
+    if KEEP_HANLP:
+        out += [(f'hanlp_{src}', f'norm.seg.{src}', data / 'keep' / f'hanlp.seg.{src}'),
+                (f'tok_{src}', f'norm.seg.tok.{src}', data / 'keep' / f'hanlp.seg.tok.{src}')]
+    return out
+
+
+def publish(src: Path, dest: Path) -> None:
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(dest.name + '.tmp')
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+def report(rows: List[dict], wall: float) -> str:
+    lines = [f'[REPORT] {"stage":<16} {"status":<8} {"seconds":>9}  key']
+    for r in rows:
+        sec = f'{r["seconds"]:.1f}' if r['status'] == 'ran' else '-'
+        if r['status'] == 'cached' and r.get('original_seconds') is not None:
+            sec = f'({r["original_seconds"]:.1f})'
+        lines.append(f'         {r["stage"]:<16} {r["status"]:<8} {sec:>9}  {r["key"][:8]}')
+    ran = sum(r['seconds'] for r in rows if r['status'] == 'ran')
+    saved = sum(r.get('original_seconds') or 0.0 for r in rows if r['status'] == 'cached')
+    lines.append(f'         wall {wall:.1f}s, stage time {ran:.1f}s, skipped via cache ~{saved:.1f}s')
+    return '\n'.join(lines)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Stage-cached DAG runner for the preprocess.sh pipeline')
+    ap.add_argument('model_name', help='Folder under data/ and models/')
+    ap.add_argument('--data_dir', default='', help='Default: <repo>/data/<model_name>')
+    ap.add_argument('--model_dir', default='', help='Default: <repo>/models/<model_name>')
+    ap.add_argument('--tgt', default=TGT, help='Target-side language code')
+    ap.add_argument('--input_prefix', default=INPUT_PREFIX, help='Inputs are <data_dir>/<prefix>.{zh,tgt}')
+    ap.add_argument('--cache_dir', default=CACHE_DIR, help='Stage cache root (shared across corpora)')
+    ap.add_argument('--cache_keep', type=int, default=3, help='Completed cache entries kept per stage')
+    ap.add_argument('-j', '--jobs', type=int, default=2, help='Stages run concurrently')
+    ap.add_argument('--workers', type=int, default=0,
+                    help='Processes per moses_text / bpe_learn / bpe_apply / split stage (0 = cpu_count // jobs)')
+    ap.add_argument('--moses', choices=['perl', 'python'], default='perl',
+                    help='Moses normalize/tokenize: perl scripts, or moses_text.py (same output)')
+    ap.add_argument('--hanlp_workers', type=int, default=1, help='hanlp_segment.py -w')
+    ap.add_argument('--hanlp_cache_dir', default='', help='hanlp_segment.py --cache_dir')
+    ap.add_argument('--bpe_ops', type=int, default=32000, help='BPE merge operations (bpe_learn.py -s)')
+    ap.add_argument('--bpe_sample', type=float, default=0.0, help='bpe_learn.py --sample (0 = learn on full counts)')
+    ap.add_argument('--seed', type=int, default=0, help='bpe_learn.py --seed')
+    ap.add_argument('--split_test', type=float, default=0.025, help='split.py --test (ratio < 1, or pairs)')
+    ap.add_argument('--split_valid', type=float, default=0.025, help='split.py --valid (ratio < 1, or pairs)')
+    ap.add_argument('--split_seed', type=int, default=0, help='split.py --seed')
+    ap.add_argument('--clean_min', type=int, default=1)
+    ap.add_argument('--clean_max', type=int, default=256)
+    ap.add_argument('--force', default='', help="Comma-separated stages to rerun even if cached ('all' = every stage)")
+    ap.add_argument('--dry_run', action='store_true', help='Only report which stages are cached / stale')
+    args = ap.parse_args()
+
+    args.data_dir = args.data_dir or os.path.join(REPO, 'data', args.model_name)
+    args.model_dir = args.model_dir or os.path.join(REPO, 'models', args.model_name)
+    if args.workers <= 0:
+        args.workers = max(1, (os.cpu_count() or 1) // max(1, args.jobs))
+    cache_dir = Path(os.path.expanduser(args.cache_dir))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    stages = build_stages(args)
+    names = {s.name for s in stages}
+    force = {x.strip() for x in args.force.split(',') if x.strip()}
+    unknown = force - names - {'all'}
+    if unknown:
+        ap.error(f'--force: unknown stage(s) {sorted(unknown)}; stages: {", ".join(s.name for s in stages)}')
+    for lang in (SRC, args.tgt):
+        path = os.path.join(args.data_dir, f'{args.input_prefix}.{lang}')
+        if not os.path.isfile(path):
+            print(f'[ERROR] not found: {path}')
+            sys.exit(1)
+
+    print(f'[INFO] {args.model_name}: {len(stages)} stages, jobs={args.jobs}, workers={args.workers}, '
+          f'moses={args.moses}, cache={cache_dir}')
+    keys, rows, ok, wall = run_dag(stages, cache_dir, args.jobs, force, args.dry_run)
+    print(report(rows, wall))
+    if args.dry_run:
+        return
+    Path(args.data_dir).mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(args.data_dir, 'preprocess_report.json'), 'w', encoding='utf-8') as f:
+        json.dump({'model_name': args.model_name, 'ok': ok, 'wall_seconds': round(wall, 3), 'stages': rows}, f,
+                  ensure_ascii=False, indent=1)
+    if not ok:
+        sys.exit(1)
+    for stage, name, dest in published(args):
+        publish(cache_dir / stage / keys[stage] / name, dest)
+    removed = sum(prune(cache_dir, s.name, args.cache_keep, keys[s.name]) for s in stages)
+    print(f'[DONE] {args.data_dir} (train/valid/test), {args.model_dir} (truecase / BPE models)'
+          + (f'; pruned {removed} old cache entries' if removed else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+preprocess_stream.py
+- preprocess.sh 的串流版：逐行的步驟以 OS pipe 串成行程鏈（pipe 緩衝即有界緩衝區），
+  不再寫出 norm.* / norm.seg.* / norm.tok.* / norm.tok.true.* / toclean.* / clean.*
+- 每個語言只落地一份 tokenize 後的語料（spill，--spill_gzip 時以 pigz / gzip -1 壓縮），
+  給需要整份語料的 truecaser / BPE 模型與最後一趟使用，結束時刪除：
+    第 1 趟  <prefix>.<lang> → normalize → [HanLP] → tokenize → spill
+             目標語言同時餵給 train-truecaser.perl（--corpus /dev/stdin），中文同時累計詞頻
+    第 2 趟  （目標語言）spill → truecase → 累計詞頻
+    BPE      以累計的詞頻表直接學合併表與 voc（bpe_learn.learn_from_counts，各語言一個子行程），
+             與 learn_joint_bpe_and_vocab.py 對整份檔案的結果相同
+    第 3 趟  spill → [truecase] → bpe_apply.py → clean-corpus-n.perl → split（同 split.py 的 seeded hash）→ train / valid / test
+             clean-corpus-n.perl 的輸入輸出檔名 symlink 到 /dev/fd/N，直接讀寫 pipe
+- 兩個語言的第 1、2 趟與 BPE 學習同時進行；結束時印出各段耗時與 spill 大小
+- HanLP 經 stdin / stdout 串流（單一行程；需要 byte-offset 分片時改用 preprocess_pipeline.py）
+- 只在 Linux 上使用（/dev/fd 與 pipe）
+
+用法：
+  python preprocess_stream.py my_corpus [--moses python] [--workers 4] [--spill_gzip] [--hanlp_cache_dir DIR]
+"""
+
+import os
+import sys
+import json
+import queue
+import time
+import shutil
+import argparse
+import itertools
+import multiprocessing as mp
+import threading
+import subprocess
+from collections import Counter
+from pathlib import Path
+
+from bpe_learn import learn_from_counts, words_of
+from preprocess_pipeline import (CLEAN, INPUT_PREFIX, KEEP_HANLP, NORM_PUNC, REPO, SRC, TC, TGT, TOKENIZER,
+                                 TRAIN_TC, util)
+from split import PARTS, split_pairs
+
+_BLOCK = 1 << 20
+# split 前兩側各讀這麼多行成一批（兩側行數相同，批次邊界一致）
+_PAIR_BATCH = 4096
+# 每側最多預讀幾批（有界緩衝）
+_QUEUE_BATCHES = 16
+
+
+class StreamError(RuntimeError):
+    pass
+
+
+# ---------------------------------------------------------------------------
+# 行程鏈 / pipe
+# ---------------------------------------------------------------------------
+
+def start_chain(cmds, stdin, stdout=subprocess.PIPE):
+    """cmds 依序以 pipe 相接，回傳 Popen list；第一個讀 stdin，最後一個寫 stdout。"""
+    procs = []
+    for i, cmd in enumerate(cmds):
+        p = subprocess.Popen(cmd, stdin=stdin, stdout=stdout if i == len(cmds) - 1 else subprocess.PIPE)
+        if procs:
+            procs[-1].stdout.close()  # 讀端只留給下一個行程，上游結束時下游才會讀到 EOF
+        procs.append(p)
+        stdin = p.stdout
+    return procs
+
+
+def wait_chain(procs, name: str) -> None:
+    for p in procs:
+        if p.wait() != 0:
+            raise StreamError(f'{name}: {" ".join(map(str, p.args[:3]))} exited with {p.returncode}')
+
+
+def pump(src, sinks, closers=()) -> None:
+    """從 src 讀 block 依序交給每個 sink，結束後呼叫 closers（關閉下游的 stdin 等）。"""
+    try:
+        with src:
+            for block in iter(lambda: src.read(_BLOCK), b''):
+                for sink in sinks:
+                    sink(block)
+    finally:
+        for close in closers:
+            close()
+
+
+class Worker(threading.Thread):
+    """背景執行緒；例外保留到 check() 時在主執行緒重新拋出。"""
+
+    def __init__(self, target, name: str):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.error = None
+
+    def run(self) -> None:
+        try:
+            self.target()
+        except BaseException as e:  # noqa: B902 — 交給主執行緒處理
+            self.error = e
+
+    def check(self) -> None:
+        self.join()
+        if self.error is not None:
+            raise StreamError(f'{self.name}: {self.error}') from self.error
+
+
+class Spill:
+    """tokenize 後的語料：寫一次、讀兩三次；gzip 時以外部 pigz / gzip 壓縮與解壓。"""
+
+    def __init__(self, path: Path, gzip: bool):
+        self.gzip = gzip
+        self.path = path.with_name(path.name + '.gz') if gzip else path
+        self.tool = shutil.which('pigz') or 'gzip'
+
+    def writer(self):
+        """回傳 (write, close)。"""
+        if not self.gzip:
+            f = open(self.path, 'wb')
+            return f.write, f.close
+        out = open(self.path, 'wb')
+        p = subprocess.Popen([self.tool, '-1', '-c'], stdin=subprocess.PIPE, stdout=out)
+        out.close()
+
+        def close():
+            p.stdin.close()
+            if p.wait() != 0:
+                raise StreamError(f'{self.tool} exited with {p.returncode}')
+        return p.stdin.write, close
+
+    def reader(self):
+        """回傳 (stdin 檔案, 鏈開頭要加的指令)。"""
+        return open(self.path, 'rb'), ([[self.tool, '-dc']] if self.gzip else [])
+
+    def size(self) -> int:
+        return self.path.stat().st_size if self.path.exists() else 0
+
+
+class WordCounter:
+    """
+    詞的切法同 bpe_learn.count_words；Counter 保留第一次出現的順序（voc 同頻 subword 的先後由此決定）。
+    block 在換行之後切開，\r\n 不會被拆開。
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self._tail = b''
+
+    def feed(self, block: bytes) -> None:
+        data = self._tail + block
+        cut = data.rfind(b'\n') + 1
+        self._tail = data[cut:]
+        self._count(data[:cut])
+
+    def _count(self, data: bytes) -> None:
+        if data:
+            self.counts.update(words_of(data.decode('utf-8')))
+
+    def close(self) -> Counter:
+        self._count(self._tail)
+        self._tail = b''
+        self.counts.pop('', None)
+        return self.counts
+
+
+# ---------------------------------------------------------------------------
+# 各趟
+# ---------------------------------------------------------------------------
+
+def moses_cmd(args, stage: str, lang: str):
+    if args.moses == 'python':
+        return [sys.executable, util('moses_text.py'), stage, '-l', lang, '-w', str(args.workers)]
+    return ['perl', NORM_PUNC if stage == 'norm' else TOKENIZER, '-l', lang]
+
+
+def hanlp_cmd(args):
+    cmd = [sys.executable, util('hanlp_segment.py'), '-if', '-', '-of', '-']
+    if args.hanlp_cache_dir:
+        cmd += ['--cache_dir', args.hanlp_cache_dir]
+    return cmd
+
+
+def bpe_cmd(args, lang: str):
+    model = Path(args.model_dir)
+    return [sys.executable, util('bpe_apply.py'), '-c', str(model / f'bpecode.{lang}'),
+            '--vocabulary', str(model / f'voc.{lang}'), '-w', str(args.workers)]
+
+
+def first_pass(args, lang: str, spill: Spill, sinks=(), keep_seg: Path = None) -> None:
+    """<prefix>.<lang> → normalize → [HanLP] → tokenize → spill（與 sinks）。"""
+    head = [moses_cmd(args, 'norm', lang)]
+    if lang == SRC:
+        head.append(hanlp_cmd(args))
+    tok = [moses_cmd(args, 'tok', lang)]
+    tee = None
+    with open(os.path.join(args.data_dir, f'{args.input_prefix}.{lang}'), 'rb') as fin:
+        if keep_seg is None:
+            procs = start_chain(head + tok, fin)
+        else:
+            # HanLP 的輸出另外留一份到 keep/（zh-id 的 preprocess.sh 也保留）
+            a = start_chain(head, fin)
+            b = start_chain(tok, subprocess.PIPE)
+            keep = open(keep_seg, 'wb')
+            tee = Worker(lambda: pump(a[-1].stdout, [keep.write, b[0].stdin.write], [keep.close, b[0].stdin.close]),
+                         f'tee_{lang}')
+            tee.start()
+            procs = a + b
+    write, close = spill.writer()
+    pump(procs[-1].stdout, [write] + list(sinks), [close])
+    if tee is not None:
+        tee.check()
+    wait_chain(procs, f'pass1_{lang}')
+
+
+def learn_bpe(args, lang: str, counts: Counter) -> None:
+    """
+    bpecode.<lang> / voc.<lang>；在 fork 出的子行程裡學，counts 不用 pickle，
+    兩個語言的合併也不會因 GIL 互相等待。
+    """
+    model = Path(args.model_dir)
+    p = mp.get_context('fork').Process(
+        target=learn_from_counts, args=(counts, str(model / f'bpecode.{lang}'), str(model / f'voc.{lang}'),
+                                        args.bpe_ops),
+        kwargs=dict(workers=args.workers if args.workers > 0 else (os.cpu_count() or 1), sample=args.bpe_sample,
+                    seed=args.seed))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        raise StreamError(f'learn_bpe_{lang} exited with {p.exitcode}')
+
+
+def read_batches(fd: int, q: queue.Queue) -> None:
+    """clean 的一側輸出：每 _PAIR_BATCH 行一批放進有界 queue，None 表示結束。"""
+    try:
+        with os.fdopen(fd, 'rb') as f:
+            while True:
+                batch = list(itertools.islice(f, _PAIR_BATCH))
+                if not batch:
+                    return
+                q.put(batch)
+    finally:
+        q.put(None)
+
+
+def drain(q: queue.Queue):
+    for batch in iter(q.get, None):
+        yield batch
+
+
+def final_pass(args, spills, tmp: Path) -> int:
+    """spill → [truecase] → BPE → clean-corpus-n.perl → split；回傳寫出的句對數。"""
+    tgt = args.tgt
+    ends = {}
+    links = {}
+    for lang in (SRC, tgt):
+        r, w = os.pipe()  # BPE 鏈 → clean
+        links[f'toclean.{lang}'] = r
+        ends[lang] = [w]
+        r, w = os.pipe()  # clean → split
+        links[f'clean.{lang}'] = w
+        ends[lang].append(r)
+    for name, fd in links.items():
+        path = tmp / name
+        if path.exists() or path.is_symlink():
+            path.unlink()
+        os.symlink(f'/dev/fd/{fd}', path)
+    clean = subprocess.Popen(['perl', CLEAN, 'toclean', SRC, tgt, 'clean', str(args.clean_min), str(args.clean_max)],
+                             cwd=str(tmp), pass_fds=tuple(links.values()), stdout=subprocess.DEVNULL)
+    for fd in links.values():
+        os.close(fd)
+
+    chains = []
+    for lang in (SRC, tgt):
+        fin, pre = spills[lang].reader()
+        cmds = pre + ([['perl', TC, '--model', os.path.join(args.model_dir, f'truecase-model.{tgt}')]]
+                      if lang == tgt else []) + [bpe_cmd(args, lang)]
+        with fin:
+            chains.append((lang, start_chain(cmds, fin, stdout=ends[lang][0])))
+        os.close(ends[lang][0])
+
+    data = Path(args.data_dir)
+    outs = {lang: [open(data / f'{p}.{lang}', 'wb') for p in PARTS] for lang in (SRC, tgt)}
+    ratio = (1 - args.split_test - args.split_valid, args.split_test, args.split_valid)
+    # 兩側各由一個執行緒讀，避免一側 pipe 寫滿時 clean-corpus-n.perl 與這裡互等
+    queues = {lang: queue.Queue(maxsize=_QUEUE_BATCHES) for lang in (SRC, tgt)}
+    readers = [Worker(lambda lang=lang: read_batches(ends[lang][1], queues[lang]), f'read_clean_{lang}')
+               for lang in (SRC, tgt)]
+    for r in readers:
+        r.start()
+    n = 0
+    try:
+        for a, b in itertools.zip_longest(drain(queues[SRC]), drain(queues[tgt]), fillvalue=[]):
+            if len(a) != len(b):
+                raise StreamError(f'clean output out of sync ({len(a)} vs {len(b)} lines in a batch)')
+            split_pairs(zip(a, b), outs[SRC], outs[tgt], ratio, args.split_seed)
+            n += len(a)
+    finally:
+        for fs in outs.values():
+            for f in fs:
+                f.close()
+    for r in readers:
+        r.check()
+    if clean.wait() != 0:
+        raise StreamError(f'clean-corpus-n.perl exited with {clean.returncode}')
+    for lang, procs in chains:
+        wait_chain(procs, f'pass3_{lang}')
+    return n
+
+
+def run(args) -> dict:
+    tgt = args.tgt
+    data, model = Path(args.data_dir), Path(args.model_dir)
+    tmp = Path(args.tmp_dir or data / '.stream_tmp')
+    tmp.mkdir(parents=True, exist_ok=True)
+    model.mkdir(parents=True, exist_ok=True)
+    timings = {}
+
+    def timed(name, fn):
+        t0 = time.time()
+        fn()
+        timings[name] = round(time.time() - t0, 3)
+        print(f'[DONE] {name} {timings[name]:.1f}s', flush=True)
+
+    spills = {lang: Spill(tmp / f'spill.tok.{lang}', args.spill_gzip) for lang in (SRC, tgt)}
+    keep_seg = None
+    if KEEP_HANLP:
+        (data / 'keep').mkdir(parents=True, exist_ok=True)
+        keep_seg = data / 'keep' / f'hanlp.seg.{SRC}'
+        # 中文的 spill 就是 keep/hanlp.seg.tok.zh，直接寫在那裡、不刪除
+        spills[SRC] = Spill(data / 'keep' / f'hanlp.seg.tok.{SRC}', False)
+
+    def tgt_branch():
+        trainer = subprocess.Popen(['perl', TRAIN_TC, '--model', str(model / f'truecase-model.{tgt}'),
+                                    '--corpus', '/dev/stdin'], stdin=subprocess.PIPE)
+        timed(f'pass1_{tgt}', lambda: first_pass(args, tgt, spills[tgt], [trainer.stdin.write]))
+        trainer.stdin.close()
+        if trainer.wait() != 0:
+            raise StreamError(f'train-truecaser.perl exited with {trainer.returncode}')
+        counter = WordCounter()
+
+        def second_pass():
+            fin, pre = spills[tgt].reader()
+            with fin:
+                procs = start_chain(pre + [['perl', TC, '--model', str(model / f'truecase-model.{tgt}')]], fin)
+            pump(procs[-1].stdout, [counter.feed])
+            wait_chain(procs, f'pass2_{tgt}')
+        timed(f'pass2_{tgt}', second_pass)
+        timed(f'learn_bpe_{tgt}', lambda: learn_bpe(args, tgt, counter.close()))
+
+    def src_branch():
+        counter = WordCounter()
+        timed(f'pass1_{SRC}', lambda: first_pass(args, SRC, spills[SRC], [counter.feed], keep_seg))
+        timed(f'learn_bpe_{SRC}', lambda: learn_bpe(args, SRC, counter.close()))
+
+    t0 = time.time()
+    branches = [Worker(tgt_branch, f'branch_{tgt}'), Worker(src_branch, f'branch_{SRC}')]
+    for b in branches:
+        b.start()
+    for b in branches:
+        b.check()
+    spill_bytes = {lang: s.size() for lang, s in spills.items()}
+    pairs = []
+    timed('pass3', lambda: pairs.append(final_pass(args, spills, tmp)))
+    timings['wall'] = round(time.time() - t0, 3)
+    if not args.keep_tmp:
+        for lang, s in spills.items():
+            if not (KEEP_HANLP and lang == SRC):
+                s.path.unlink()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {'pairs': pairs[0], 'seconds': timings, 'spill_bytes': spill_bytes}
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Fused streaming preprocess (no intermediate norm/tok/true/clean files)')
+    ap.add_argument('model_name', help='Folder under data/ and models/')
+    ap.add_argument('--data_dir', default='', help='Default: <repo>/data/<model_name>')
+    ap.add_argument('--model_dir', default='', help='Default: <repo>/models/<model_name>')
+    ap.add_argument('--tgt', default=TGT, help='Target-side language code')
+    ap.add_argument('--input_prefix', default=INPUT_PREFIX, help='Inputs are <data_dir>/<prefix>.{zh,tgt}')
+    ap.add_argument('--tmp_dir', default='', help='Where the tokenized spills go (default: <data_dir>/.stream_tmp)')
+    ap.add_argument('--spill_gzip', action='store_true', help='Compress spills with pigz/gzip -1')
+    ap.add_argument('--keep_tmp', action='store_true', help='Keep spills after the run')
+    ap.add_argument('--workers', type=int, default=1, help='Processes per moses_text / bpe_learn / bpe_apply stage')
+    ap.add_argument('--moses', choices=['perl', 'python'], default='perl',
+                    help='Moses normalize/tokenize: perl scripts, or moses_text.py (same output)')
+    ap.add_argument('--hanlp_cache_dir', default='', help='hanlp_segment.py --cache_dir')
+    ap.add_argument('--bpe_ops', type=int, default=32000, help='BPE merge operations (bpe_learn.py -s)')
+    ap.add_argument('--bpe_sample', type=float, default=0.0, help='bpe_learn.py --sample (0 = learn on full counts)')
+    ap.add_argument('--seed', type=int, default=0, help='bpe_learn.py --seed')
+    ap.add_argument('--split_test', type=float, default=0.025, help='split.py --test (ratio only in stream mode)')
+    ap.add_argument('--split_valid', type=float, default=0.025, help='split.py --valid (ratio only in stream mode)')
+    ap.add_argument('--split_seed', type=int, default=0, help='split.py --seed')
+    ap.add_argument('--clean_min', type=int, default=1)
+    ap.add_argument('--clean_max', type=int, default=256)
+    args = ap.parse_args()
+
+    if args.split_test >= 1 or args.split_valid >= 1 or args.split_test + args.split_valid >= 1:
+        ap.error('stream mode splits by ratio only; use preprocess_pipeline.py for --split_test / --split_valid counts')
+    args.data_dir = args.data_dir or os.path.join(REPO, 'data', args.model_name)
+    args.model_dir = args.model_dir or os.path.join(REPO, 'models', args.model_name)
+    for lang in (SRC, args.tgt):
+        path = os.path.join(args.data_dir, f'{args.input_prefix}.{lang}')
+        if not os.path.isfile(path):
+            print(f'[ERROR] not found: {path}')
+            sys.exit(1)
+    try:
+        res = run(args)
+    except (StreamError, subprocess.CalledProcessError, OSError) as e:
+        print(f'[ERROR] {e}')
+        sys.exit(1)
+    print('[REPORT] ' + '  '.join(f'{k}={v:.1f}s' for k, v in res['seconds'].items()))
+    print('[REPORT] spill: ' + ', '.join(f'{k} {v / (1 << 20):.1f} MiB' for k, v in res['spill_bytes'].items())
+          + f'; {res["pairs"]} pairs -> {args.data_dir} (train/valid/test), {args.model_dir} (truecase / BPE)')
+    with open(os.path.join(args.data_dir, 'preprocess_report.json'), 'w', encoding='utf-8') as f:
+        json.dump(dict(res, model_name=args.model_name, mode='stream'), f, ensure_ascii=False, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,289 @@
-import random
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+split.py
+- 把平行語料切成 train / valid / test，逐行串流、記憶體不隨語料成長
+- 每個句對依「正規化後內容（空白壓成單一空白）」的 seeded hash（blake2b，--seed）決定去處：
+  同一份語料、同一個 seed 每次切法都相同；重複的句對一定落在同一份，不會同時出現在 train 與 test
+  （--group_by src：只看中文側，同一句的不同譯文也放在一起）
+- --valid / --test 可給比例（< 1）或句數（>= 1）：
+    比例：hash 直接對應到 [0, 1) 的區間，一趟完成
+    句數：第一趟找出 hash 最小的 valid + test 個不同句對（每個區段只留這麼多），算出門檻後第二趟寫出；
+          重複句對整組移動，實際句數可能略多於目標
+- -w N：兩個檔案依行號對齊切成 N 個區段（先以 bytes.count 數行），各 worker 算 hash、寫各自的分段檔，
+  最後依區段順序串接，輸出順序與輸入相同
+
+用法：
+  python split.py clean.zh clean.id new_data_dir/ [--valid 0.025 --test 0.025] [--seed 0] [-w 4]
+  python split.py clean.zh clean.id new_data_dir/ --valid 3000 --test 3000
+"""
+
+import os
 import sys
+import heapq
+import shutil
+import hashlib
+import argparse
+import itertools
+import multiprocessing as mp
+from collections import Counter
+from typing import Dict, List, Tuple
+
+SRC_LANG = 'zh'
+TGT_LANG = 'en'
+# preprocess.sh 用的 train / test / valid 比例
+RATIO = (0.95, 0.025, 0.025)
+# 輸出順序與 split_pairs 的 k（0 / 1 / 2）
+PARTS = ('train', 'test', 'valid')
+
+_SPAN = 1 << 64
+_CHUNK = 16 << 20
+
+
+def pair_key(s, t, group_by: str = 'pair') -> bytes:
+    """去掉首尾空白、內部空白壓成一個；str 先轉 UTF-8。"""
+    if isinstance(s, str):
+        s, t = s.encode('utf-8'), t.encode('utf-8')
+    key = b' '.join(s.split())
+    if group_by == 'pair':
+        key += b'\t' + b' '.join(t.split())
+    return key
+
+
+def pair_hash(s, t, seed: int = 0, group_by: str = 'pair') -> int:
+    """0 ~ 2^64 - 1"""
+    digest = hashlib.blake2b(pair_key(s, t, group_by), digest_size=8, key=str(seed).encode()).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def ratio_cuts(ratio=RATIO) -> Tuple[int, int]:
+    """(train, test, valid) 比例 → hash 門檻：h < cut_test 為 test，h < cut_valid 為 valid，其餘 train。"""
+    cut_test = int(ratio[1] * _SPAN)
+    return cut_test, min(_SPAN, cut_test + int(ratio[2] * _SPAN))
+
+
+def route(h: int, cuts: Tuple[int, int]) -> int:
+    if h < cuts[0]:
+        return 1
+    if h < cuts[1]:
+        return 2
+    return 0
+
+
+def split_pairs(pairs, src_fps, tgt_fps, ratio=RATIO, seed: int = 0, group_by: str = 'pair', cuts=None) -> List[int]:
+    """
+    pairs 為 (src 行, tgt 行) 的 iterable；src_fps / tgt_fps 依序為 (train, test, valid) 的輸出檔。
+    cuts 未給時由 ratio 換算；回傳各份的句數。
+    """
+    cuts = cuts or ratio_cuts(ratio)
+    n = [0, 0, 0]
+    for s, t in pairs:
+        k = route(pair_hash(s, t, seed, group_by), cuts)
+        src_fps[k].write(s)
+        tgt_fps[k].write(t)
+        n[k] += 1
+    return n
+
+
+# ---------------------------------------------------------------------------
+# 依行號對齊的區段
+# ---------------------------------------------------------------------------
+
+def _count_lines(f, a: int, b: int) -> int:
+    f.seek(a)
+    n, left = 0, b - a
+    while left > 0:
+        chunk = f.read(min(_CHUNK, left))
+        if not chunk:
+            break
+        n += chunk.count(b'\n')
+        left -= len(chunk)
+    return n
+
+
+def _skip_lines(f, pos: int, n: int) -> int:
+    """從 pos 往後跳過 n 行，回傳新的 offset（不足 n 行時回傳檔尾）。"""
+    f.seek(pos)
+    while n > 0:
+        chunk = f.read(_CHUNK)
+        if not chunk:
+            return pos
+        c = chunk.count(b'\n')
+        if c < n:
+            n -= c
+            pos += len(chunk)
+            continue
+        i = -1
+        for _ in range(n):
+            i = chunk.index(b'\n', i + 1)
+        return pos + i + 1
+    return pos
+
+
+def aligned_ranges(src: str, tgt: str, shards: int) -> List[Tuple[int, int, int, int]]:
+    """src 依 byte 切 shards 段（對齊換行），tgt 依相同行數對齊；回傳 [(src 起, src 迄, tgt 起, tgt 迄), ...]。"""
+    size = os.path.getsize(src)
+    block = max(1, -(-size // shards))
+    ranges = []
+    with open(src, 'rb') as fs, open(tgt, 'rb') as ft:
+        a = ta = 0
+        while a < size:
+            b = min(a + block, size)
+            if b < size:
+                fs.seek(b)
+                b += len(fs.readline())
+            if b >= size:
+                tb = os.path.getsize(tgt)
+            else:
+                tb = _skip_lines(ft, ta, _count_lines(fs, a, b))
+            ranges.append((a, b, ta, tb))
+            a, ta = b, tb
+    return ranges or [(0, 0, 0, os.path.getsize(tgt))]
+
+
+def _read_range(path: str, a: int, b: int):
+    with open(path, 'rb') as f:
+        f.seek(a)
+        left = b - a
+        for line in f:
+            if left <= 0:
+                return
+            left -= len(line)
+            yield line
+
+
+def _pairs(job):
+    src, tgt, (a, b, ta, tb) = job[:3]
+    for s, t in itertools.zip_longest(_read_range(src, a, b), _read_range(tgt, ta, tb)):
+        if s is None or t is None:
+            raise ValueError(f'{src} and {tgt} have different numbers of lines')
+        yield s, t
+
+
+# ---------------------------------------------------------------------------
+# worker
+# ---------------------------------------------------------------------------
+
+def _smallest(job) -> Dict[int, int]:
+    """區段內 hash 最小的 k 個不同句對：{hash: 行數}。"""
+    src, tgt, rng, seed, group_by, k = job
+    counts = {}
+    heap = []  # -hash，堆頂為目前留下的最大 hash
+    for s, t in _pairs(job):
+        h = pair_hash(s, t, seed, group_by)
+        if h in counts:
+            counts[h] += 1
+        elif len(counts) < k:
+            counts[h] = 1
+            heapq.heappush(heap, -h)
+        elif heap and h < -heap[0]:
+            del counts[-heapq.heapreplace(heap, -h)]
+            counts[h] = 1
+    return counts
+
+
+def _route_range(job) -> List[int]:
+    """區段內的句對寫到 <prefix>.<train|test|valid>.<src|tgt>。"""
+    src, tgt, rng, seed, group_by, cuts, prefix, langs = job
+    fps = [[open(f'{prefix}{part}.{lang}', 'wb') for part in PARTS] for lang in langs]
+    try:
+        return split_pairs(_pairs(job), fps[0], fps[1], seed=seed, group_by=group_by, cuts=cuts)
+    finally:
+        for f in fps[0] + fps[1]:
+            f.close()
+
+
+def count_cuts(src: str, tgt: str, n_test: int, n_valid: int, ranges, seed: int = 0, group_by: str = 'pair',
+               pool=None) -> Tuple[int, int]:
+    """句數 → hash 門檻：hash 最小的約 n_test 行為 test、接下來約 n_valid 行為 valid（重複句對整組算）。"""
+    k = n_test + n_valid
+    jobs = [(src, tgt, r, seed, group_by, k) for r in ranges]
+    merged = Counter()
+    for part in (pool.imap(_smallest, jobs) if pool is not None else map(_smallest, jobs)):
+        merged.update(part)
+    # 全域最小的 k 個 hash 在每個區段也都在最小的 k 個內，行數是完整的
+    smallest = iter(sorted(merged.items())[:k])
+    cuts, total, cut = [], 0, 0
+    for part, want in (('test', n_test), ('valid', n_valid)):
+        goal = total + want
+        while total < goal:
+            item = next(smallest, None)
+            if item is None:
+                print(f'[WARN] corpus too small: {part} gets {want - (goal - total)} of {want} pairs')
+                break
+            total, cut = total + item[1], item[0] + 1
+        cuts.append(cut)
+    return cuts[0], cuts[1]
+
+
+def split_files(src: str, tgt: str, new_data_dir: str = '', test=RATIO[1], valid=RATIO[2], seed: int = 0,
+                group_by: str = 'pair', workers: int = 1, langs=(SRC_LANG, TGT_LANG)) -> List[int]:
+    """test / valid < 1 為比例，>= 1 為句數；回傳 (train, test, valid) 的句數。輸出為 <new_data_dir><part>.<lang>。"""
+    if (test >= 1) != (valid >= 1):
+        raise ValueError('--test and --valid must both be ratios or both be counts')
+    ranges = aligned_ranges(src, tgt, workers) if workers > 1 else [(0, os.path.getsize(src), 0, os.path.getsize(tgt))]
+    pool = mp.Pool(min(workers, len(ranges))) if len(ranges) > 1 else None
+    tmp = None
+    try:
+        if test >= 1:
+            cuts = count_cuts(src, tgt, int(test), int(valid), ranges, seed, group_by, pool)
+        else:
+            cuts = ratio_cuts((1 - test - valid, test, valid))
+        if pool is None:
+            return _route_range((src, tgt, ranges[0], seed, group_by, cuts, new_data_dir, langs))
+        # 各區段寫自己的分段檔，再依區段順序串接
+        tmp = os.path.join(new_data_dir or '.', f'.split_tmp.{os.getpid()}')
+        os.makedirs(tmp, exist_ok=True)
+        jobs = [(src, tgt, r, seed, group_by, cuts, os.path.join(tmp, f'{i:05d}.'), langs)
+                for i, r in enumerate(ranges)]
+        counts = [sum(x) for x in zip(*pool.imap(_route_range, jobs))]
+        for part in PARTS:
+            for lang in langs:
+                with open(f'{new_data_dir}{part}.{lang}', 'wb') as out:
+                    for job in jobs:
+                        with open(f'{job[6]}{part}.{lang}', 'rb') as f:
+                            shutil.copyfileobj(f, out, _CHUNK)
+        return counts
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def split(src_fpath, tgt_fpath, nsrc=SRC_LANG, ntgt=TGT_LANG, ratio=(0.9, 0.05, 0.05), new_data_dir='', seed=0):
+    return split_files(src_fpath, tgt_fpath, new_data_dir, ratio[1], ratio[2], seed, langs=(nsrc, ntgt))
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Deterministic, dedupe-aware train/valid/test split of a parallel corpus')
+    ap.add_argument('src_fpath')
+    ap.add_argument('tgt_fpath')
+    ap.add_argument('new_data_dir', help='Output prefix, e.g. ./ or data/my_corpus/')
+    ap.add_argument('--test', type=float, default=RATIO[1], help='Ratio (< 1) or number of pairs (>= 1)')
+    ap.add_argument('--valid', type=float, default=RATIO[2], help='Ratio (< 1) or number of pairs (>= 1)')
+    ap.add_argument('--seed', type=int, default=0, help='Hash seed; same seed + same content = same split')
+    ap.add_argument('--group_by', choices=['pair', 'src'], default='pair',
+                    help='Keep identical pairs (or identical source sentences) in the same split')
+    ap.add_argument('-w', '--workers', type=int, default=1, help='Worker processes (0 = cpu_count)')
+    ap.add_argument('--src_lang', default=SRC_LANG)
+    ap.add_argument('--tgt_lang', default=TGT_LANG)
+    args = ap.parse_args()
+
+    if (args.test >= 1) != (args.valid >= 1):
+        ap.error('--test and --valid must both be ratios or both be counts')
+    if args.test < 1 and args.test + args.valid >= 1:
+        ap.error('--test + --valid ratios must be < 1')
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    try:
+        n = split_files(args.src_fpath, args.tgt_fpath, args.new_data_dir, args.test, args.valid, args.seed,
+                        args.group_by, workers, (args.src_lang, args.tgt_lang))
+    except ValueError as e:
+        print(f'[ERROR] {e}')
+        sys.exit(1)
+    print('[DONE] ' + ', '.join(f'{part} {c}' for part, c in zip(PARTS, n)) + f' (seed {args.seed})')
+
 
-'''
-Usage:
-python split.py src_fpath tgt_fpath new_data_dir
-'''
-
-def split(src_fpath, tgt_fpath, nsrc='zh', ntgt='en', ratio=(0.9, 0.05, 0.05), new_data_dir=''):
-  src_fp = open(src_fpath, encoding='utf-8')
-  tgt_fp = open(tgt_fpath, encoding='utf-8')
-  
-  src_train, src_test, src_val = open(new_data_dir + 'train.' + nsrc, 'w', encoding='utf-8'), \
-    open(new_data_dir + 'test.' + nsrc, 'w', encoding='utf-8'), open(new_data_dir + 'valid.' + nsrc, 'w', encoding='utf-8')
-  tgt_train, tgt_test, tgt_val = open(new_data_dir + 'train.' + ntgt, 'w', encoding='utf-8'), \
-    open(new_data_dir + 'test.' + ntgt, 'w', encoding='utf-8'), open(new_data_dir + 'valid.' + ntgt, 'w', encoding='utf-8')
-  
-  src, tgt = src_fp.readlines(), tgt_fp.readlines()
-  for s, t in zip(src, tgt):
-      rand = random.random()
-      if 0 < rand <= ratio[0]:
-        src_train.write(s)
-        tgt_train.write(t)
-      elif ratio[0] < rand <= ratio[0] + ratio[1]:
-        src_test.write(s)
-        tgt_test.write(t)
-      else:
-        src_val.write(s)
-        tgt_val.write(t)
-  
-  src_fp.close()
-  tgt_fp.close()
-  src_train.close()
-  src_test.close()
-  src_val.close()
-  tgt_train.close()
-  tgt_test.close()
-  tgt_val.close()
-
-if __name__ == '__main__':      
-    split(src_fpath=sys.argv[1], tgt_fpath=sys.argv[2], nsrc='zh', ntgt='en', ratio=(0.95, 0.025, 0.025), new_data_dir=sys.argv[3])
\ No newline at end of file
+if __name__ == '__main__':
+    main()
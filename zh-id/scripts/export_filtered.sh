@@ -1,9 +1,12 @@
 #!/usr/bin/env bash
 # 只依 similarity.tsv 分流（自動讀表頭：idx, cosine, id_sentence, zh_sentence）
+# merged/ 有 scores.npy + scores_index.json 時改用 scores_store.py（mmap 向量化門檻，不解析 TSV）
 # 用法：
 #   ./export_filtered_from_sim.sh <folder_name> [--thr 0.6] [--prefix filtered] [--out_dir <path>]
 # 例：
 #   ./export_filtered_from_sim.sh zh2id_ner_v3 --thr 0.7 --prefix laser07
+#   ./export_filtered_from_sim.sh zh2id_ner_v3 --thrs 0.6,0.7,0.8,0.9 --prefix laser   # 多門檻單次分流
+#     （交給 export_laser.py：多行程、一次讀完，輸出 <prefix>_lt06 / _06-07 / ... / _ge09 與累積的 _geXX）
 
 set -euo pipefail
 
@@ -18,27 +21,47 @@ PREFIX="filtered"
 
 BASE="/home/mi2s/translation-corpus/zh-id"
 SIM="${BASE}/models/${FOLDER}/laser_out/merged/similarity.tsv"
+STORE_PY="${BASE}/utils/scores_store.py"
+EXPORT_PY="${BASE}/utils/export_laser.py"
+THRS=""
+WORKERS=0
 OUT_DIR="${BASE}/data/${FOLDER}"
 
 while [[ $# -gt 0 ]]; do
   case "$1" in
     --thr) THR="$2"; shift 2;;
+    --thrs) THRS="$2"; shift 2;;
+    --workers) WORKERS="$2"; shift 2;;
     --prefix) PREFIX="$2"; shift 2;;
     --out_dir) OUT_DIR="$2"; shift 2;;
     -h|--help)
-      echo "Usage: $0 <folder_name> [--thr 0.6] [--prefix filtered] [--out_dir <path>]"
+      echo "Usage: $0 <folder_name> [--thr 0.6 | --thrs 0.6,0.7,0.8] [--prefix filtered] [--out_dir <path>] [--workers N]"
       exit 0;;
     *) echo "[ERROR] Unknown option: $1"; exit 1;;
   esac
 done
 
+SIM_DIR="$(dirname -- "$SIM")"
+USE_STORE=0
+[[ -f "$SIM_DIR/scores_index.json" && -f "$SIM_DIR/scores.npy" ]] && USE_STORE=1
+
 # 支援 .tsv.gz
 if [[ ! -f "$SIM" && -f "${SIM}.gz" ]]; then
   SIM="${SIM}.gz"
 fi
-[[ -f "$SIM" ]] || { echo "[ERROR] not found: $SIM"; exit 1; }
+[[ "$USE_STORE" -eq 1 || -f "$SIM" ]] || { echo "[ERROR] not found: $SIM"; exit 1; }
 
 mkdir -p "$OUT_DIR"
+
+if [[ -n "$THRS" ]]; then
+  echo "[INFO] 多門檻分流：$THRS → $OUT_DIR"
+  if [[ "$USE_STORE" -eq 1 ]]; then SRC="$SIM_DIR"; else SRC="$SIM"; fi
+  python "$EXPORT_PY" --sim "$SRC" --thresholds "$THRS" --out_dir "$OUT_DIR" --prefix "$PREFIX" \
+    --cumulative --workers "$WORKERS"
+  echo "[OK] done."
+  exit 0
+fi
+
 thr_nodot="${THR//./}"
 
 OUT_ID_GE="${OUT_DIR}/${PREFIX}.id"
@@ -55,6 +78,14 @@ echo "[INFO] outputs :"
 echo "  >= thr → $OUT_ID_GE , $OUT_ZH_GE"
 echo "  <  thr → $OUT_ID_LT , $OUT_ZH_LT"
 
+if [[ "$USE_STORE" -eq 1 ]]; then
+  echo "[INFO] 使用 scores.npy：$SIM_DIR"
+  python "$STORE_PY" export --store "$SIM_DIR" --threshold "$THR" --op ">=" \
+    --out_id "$OUT_ID_GE" --out_zh "$OUT_ZH_GE" --lt_id "$OUT_ID_LT" --lt_zh "$OUT_ZH_LT"
+  echo "[OK] done."
+  exit 0
+fi
+
 read_cmd="cat"; [[ "$SIM" == *.gz ]] && read_cmd="zcat"
 
 # 只依 similarity.tsv 分流，會自動根據表頭找欄位：
@@ -1,70 +1,39 @@
 #!/bin/sh
 #src必須是中文
 
-src=zh
-tgt=id
 model_name=$1
+shift
 
-SCRIPTS=~/translation-corpus/mosesdecoder/scripts
-TOKENIZER=${SCRIPTS}/tokenizer/tokenizer.perl
-DETOKENIZER=${SCRIPTS}/tokenizer/detokenizer.perl
-LC=${SCRIPTS}/tokenizer/lowercase.perl
-TRAIN_TC=${SCRIPTS}/recaser/train-truecaser.perl
-TC=${SCRIPTS}/recaser/truecase.perl
-DETC=${SCRIPTS}/recaser/detruecase.perl
-NORM_PUNC=${SCRIPTS}/tokenizer/normalize-punctuation.perl
-CLEAN=${SCRIPTS}/training/clean-corpus-n.perl
-BPEROOT=~/translation-corpus/subword-nmt/subword_nmt
-MULTI_BLEU=${SCRIPTS}/generic/multi-bleu.perl
-MTEVAL_V14=${SCRIPTS}/generic/mteval-v14.pl
-
-data_dir=~/translation-corpus/zh-id/data/$model_name
-model_dir=~/translation-corpus/zh-id/models/$model_name
 utils=~/translation-corpus/zh-id/utils
 
-echo "===============init_success==============="
-
-perl ${NORM_PUNC} -l $tgt < ${data_dir}/filtered.$tgt > ${data_dir}/norm.$tgt
-perl ${NORM_PUNC} -l $src < ${data_dir}/filtered.$src > ${data_dir}/norm.$src
-
-echo "===============norm_success==============="
-
-python ${utils}/hanlp_segment.py -if ${data_dir}/norm.$src -of ${data_dir}/norm.seg.$src
-
-echo "===============hanlp_success==============="
-
-${TOKENIZER} -l $tgt < ${data_dir}/norm.$tgt > ${data_dir}/norm.tok.$tgt
-${TOKENIZER} -l $src < ${data_dir}/norm.seg.$src > ${data_dir}/norm.seg.tok.$src
-
-echo "===============TOKENIZER_success==============="
-
-${TRAIN_TC} --model ${model_dir}/truecase-model.$tgt --corpus ${data_dir}/norm.tok.$tgt
-${TC} --model ${model_dir}/truecase-model.$tgt < ${data_dir}/norm.tok.$tgt > ${data_dir}/norm.tok.true.$tgt
-
-echo "===============TC_success==============="
-
-python ${BPEROOT}/learn_joint_bpe_and_vocab.py --input ${data_dir}/norm.tok.true.$tgt  -s 32000 -o ${model_dir}/bpecode.$tgt --write-vocabulary ${model_dir}/voc.$tgt
-python ${BPEROOT}/apply_bpe.py -c ${model_dir}/bpecode.$tgt --vocabulary ${model_dir}/voc.$tgt < ${data_dir}/norm.tok.true.$tgt > ${data_dir}/norm.tok.true.bpe.$tgt
-python ${BPEROOT}/learn_joint_bpe_and_vocab.py --input ${data_dir}/norm.seg.tok.$src  -s 32000 -o ${model_dir}/bpecode.$src --write-vocabulary ${model_dir}/voc.$src
-python ${BPEROOT}/apply_bpe.py -c ${model_dir}/bpecode.$src --vocabulary ${model_dir}/voc.$src < ${data_dir}/norm.seg.tok.$src > ${data_dir}/norm.seg.tok.bpe.$src
-
-echo "===============BPE_success================="
-
-mv ${data_dir}/norm.seg.tok.bpe.$src ${data_dir}/toclean.$src
-mv ${data_dir}/norm.tok.true.bpe.$tgt ${data_dir}/toclean.$tgt 
-${CLEAN} ${data_dir}/toclean $src $tgt ${data_dir}/clean 1 256
-
-echo "===============CLEAN_success==============="
-
-
-python ${utils}/split.py ${data_dir}/clean.$src ${data_dir}/clean.$tgt ${data_dir}/
-
-
-# === 新增：保留 HanLP 斷詞成果（斷詞原文 + 斷詞後tokenized） ===
-mkdir -p "${data_dir}/keep"
-cp -f "${data_dir}/norm.seg.$src"        "${data_dir}/keep/hanlp.seg.$src"
-cp -f "${data_dir}/norm.seg.tok.$src"    "${data_dir}/keep/hanlp.seg.tok.$src"
-# 如只想留其中一個，就刪掉另一行 cp
-
-ls $data_dir | grep -Ev '^(raw|valid|test|train)\.(id|zh)$' | xargs -I {} rm -f $data_dir/{}
-echo "===============Preprocess_success==============="
\ No newline at end of file
+# 由 preprocess_pipeline.py 依 DAG 執行 normalize → HanLP → tokenize → truecase → BPE → clean → split：
+# 中文與目標語言分支同時跑，各步驟結果快取在 zh-id/.stage_cache，輸入 / 參數 / 程式沒變的步驟直接略過，
+# 最後印出各步驟耗時；其餘參數（--jobs、--force、--dry_run ...）直接接在 model_name 後面
+# MOSES_PY=1：Moses normalize / tokenize 改用 moses_text.py（輸出相同）
+# MOSES_WORKERS / BPE_WORKERS=N：moses_text.py / bpe_learn.py / bpe_apply.py 的行程數
+# HANLP_WORKERS=N：依 byte offset 切 N 段平行斷詞（預設 1）
+# HANLP_CACHE_DIR=DIR：跨語料共用的斷詞快取（未設定則不使用）
+# BPE_SAMPLE=R：bpe_learn.py 只在比例 R 的 token 抽樣上學合併（voc 仍用完整詞頻；預設不抽樣）
+# STREAM=1：改用 preprocess_stream.py，逐行步驟以 pipe 串接，只落地 tokenize 後的語料與最後的檔案 / 模型
+#           （不快取、HanLP 單一行程；SPILL_GZIP=1 時壓縮暫存語料）
+WORKERS=${BPE_WORKERS:-${MOSES_WORKERS:-0}}
+
+if [ -n "$STREAM" ]; then
+    python ${utils}/preprocess_stream.py $model_name \
+        ${MOSES_PY:+--moses python} \
+        --workers $WORKERS \
+        ${SPILL_GZIP:+--spill_gzip} \
+        ${BPE_SAMPLE:+--bpe_sample $BPE_SAMPLE} \
+        ${HANLP_CACHE_DIR:+--hanlp_cache_dir $HANLP_CACHE_DIR} \
+        "$@" || exit 1
+else
+    python ${utils}/preprocess_pipeline.py $model_name \
+        ${MOSES_PY:+--moses python} \
+        --workers $WORKERS \
+        --hanlp_workers ${HANLP_WORKERS:-1} \
+        ${BPE_SAMPLE:+--bpe_sample $BPE_SAMPLE} \
+        ${HANLP_CACHE_DIR:+--hanlp_cache_dir $HANLP_CACHE_DIR} \
+        "$@" || exit 1
+fi
+
+echo "===============Preprocess_success==============="
@@ -8,12 +8,22 @@
 #   ./run_laser.sh my_corpus --device cpu
 #   ./run_laser.sh my_corpus --device cuda
 #   ./run_laser.sh my_corpus --chunk 200000   # 每片 20 萬行
+#   ./run_laser.sh my_corpus --stream         # 不切片，laser_run.py 串流編碼整份語料
+#   ./run_laser.sh my_corpus --py_driver      # 改由 laser_driver.py 以 byte offset 分片、模型常駐、管線化處理
 #
 # 本版功能：
 # - 以每 CHUNK_SIZE 行切片（id/zh 對齊），逐片呼叫 laser_run.py
 # - 各片輸出到 OUT_DIR/chunk_XX，完成後合併 *.tsv/*.csv 到 OUT_DIR/merged/
-# - 支援 --overwrite：若 OUT_DIR 已存在則刪除重建；每片資料夾亦會先刪後建避免殘留
-# - 預設於每片完成後刪除 .npy/.npz 以節省磁碟（如需保留加 --keep_emb）
+#   並由各片 scores_sketch.npz 合併出全語料的 merged/scores_summary.json
+# - 支援 --overwrite：若 OUT_DIR 已存在則刪除重建
+# - 可續跑：每片完成後原子寫入 chunk_XX/.done（內容 = 輸入內容 + 參數的 md5），
+#   重跑時 hash 相同的分片直接略過；hash 不同才清掉該片重做。--stream 時 laser_run.py --resume
+#   會定期 checkpoint 編碼進度，中斷後從上次進度接續；切片模式沒有片內 checkpoint，
+#   中斷的那一片重跑時整片重新編碼（調小 --chunk_size 可縮小重做量）
+# - 預設於每片完成後刪除嵌入檔（*.emb.npy / *.emb.scale.npy）以節省磁碟（如需保留加 --keep_emb）
+# - 支援 --stream：不做 head/split，整份語料以單一 chunk_00 交給 laser_run.py --stream（記憶體固定）
+# - 支援 --py_driver：整個分片 / 合併流程交給 laser_driver.py（不複製語料、單一行程、讀寫與編碼重疊），
+#   輸出結構與 .done hash 與本腳本相同
 set -euo pipefail
 
 if [[ $# -lt 1 ]]; then
@@ -29,6 +39,9 @@ shift || true
 BASE_DATA_DIR="/home/mi2s/translation-corpus/zh-id/data"
 BASE_MODEL_DIR="/home/mi2s/translation-corpus/zh-id/models"
 PY_SCRIPT="/home/mi2s/translation-corpus/zh-id/utils/laser_run.py"
+ANN_SCRIPT="/home/mi2s/translation-corpus/zh-id/utils/ann_index.py"
+DRIVER_SCRIPT="/home/mi2s/translation-corpus/zh-id/utils/laser_driver.py"
+STORE_SCRIPT="/home/mi2s/translation-corpus/zh-id/utils/scores_store.py"
 
 DATA_DIR="${BASE_DATA_DIR}/${FOLDER_NAME}"
 OUT_DIR_DEFAULT="${BASE_MODEL_DIR}/${FOLDER_NAME}/laser_out"
@@ -43,12 +56,25 @@ BATCH=256
 REMOVE_TAGS=0
 WRITE_NN=0
 NN_CHUNK=0
+NN_K=4                # --nn 時每列保留的近鄰數（ratio margin 用）
 THRESHOLDS="0.6,0.7,0.8,0.9"
 MAX_LINES=0           # 若 >0，僅用前 N 行（會作用在切片前）
 ETA_ONLY=0
 OVERWRITE=0           # 1=清空 OUT_DIR 後重建
 CHUNK_SIZE=1000000     # 預設每片 200,000 行（較安全）
-KEEP_EMB=0            # 1=保留嵌入檔；0=每片完成即刪除 .npy/.npz
+KEEP_EMB=0            # 1=保留嵌入檔；0=每片完成即刪除 *.emb.npy / *.emb.scale.npy
+STREAM=0              # 1=不切片，laser_run.py --stream 一次處理整份語料
+TOKEN_BUDGET=0        # >0：依句長分桶，每批 padding 後 token 數上限（--batch 變成每批句數上限）
+DEDUP=0               # 1=同一次執行內相同句子只編碼一次
+CACHE_DIR=""          # 非空：跨語料 / 跨次執行共用的向量快取（隱含 --dedup）
+CACHE_MAX_GB=20       # 向量快取 LRU 容量上限
+EMB_DTYPE="float32"   # float32 | float16 | int8（嵌入存檔格式；int8 另存 .scale.npy）
+ANN=0                 # 1=全部 chunk 完成後建立跨 chunk 的 IVF-PQ 索引並查詢（隱含 --keep_emb）
+ANN_NPROBE=16
+WORKERS=0             # >0：CPU 多行程編碼（每個行程只載入一次模型）
+WORKER_THREADS=0      # 每個 worker 的 intra-op 執行緒數（0=核心數/WORKERS）
+PY_DRIVER=0           # 1=改用 laser_driver.py（byte-offset 分片、模型常駐、管線化）
+SIM_FORMAT="both"     # both | npy | tsv（npy=只寫 scores.npy + offsets，不寫整句重複的 similarity.tsv）
 
 # 解析可選參數
 while [[ $# -gt 0 ]]; do
@@ -62,6 +88,7 @@ while [[ $# -gt 0 ]]; do
     --remove_tags) REMOVE_TAGS=1; shift 1;;
     --nn) WRITE_NN=1; shift 1;;
     --nn_chunk) NN_CHUNK="$2"; shift 2;;
+    --nn_k) NN_K="$2"; shift 2;;
     --thresholds) THRESHOLDS="$2"; shift 2;;
     --max) MAX_LINES="$2"; shift 2;;
     --eta_only) ETA_ONLY=1; shift 1;;
@@ -69,6 +96,18 @@ while [[ $# -gt 0 ]]; do
     --chunk) CHUNK_SIZE="$2"; shift 2;;
     --chunk_size) CHUNK_SIZE="$2"; shift 2;;
     --keep_emb) KEEP_EMB=1; shift 1;;
+    --stream) STREAM=1; shift 1;;
+    --token_budget) TOKEN_BUDGET="$2"; shift 2;;
+    --dedup) DEDUP=1; shift 1;;
+    --cache_dir) CACHE_DIR="$2"; shift 2;;
+    --cache_max_gb) CACHE_MAX_GB="$2"; shift 2;;
+    --workers) WORKERS="$2"; shift 2;;
+    --emb_dtype) EMB_DTYPE="$2"; shift 2;;
+    --ann) ANN=1; KEEP_EMB=1; shift 1;;
+    --ann_nprobe) ANN_NPROBE="$2"; shift 2;;
+    --worker_threads) WORKER_THREADS="$2"; shift 2;;
+    --py_driver) PY_DRIVER=1; shift 1;;
+    --sim_format) SIM_FORMAT="$2"; shift 2;;
     -h|--help)
       cat <<'EOF'
 用法：run_laser.sh <folder_name> [選項...]
@@ -85,14 +124,28 @@ while [[ $# -gt 0 ]]; do
     --batch N
     --remove_tags
     --nn
-    --nn_chunk N
+    --nn_chunk N         NN 分塊 tile 大小（0=4096）
+    --nn_k K             每句保留 K 個近鄰，輸出 nn_topk.tsv（ratio margin + 互為最佳）
     --thresholds a,b,c
     --max N              僅處理前 N 行（在切片前截斷）
     --eta_only           只估時不產出檔案（仍會逐片跑，但 python 端不寫出）
     --overwrite          若 OUT_DIR 已存在則先刪除後重建（覆蓋）
     --chunk N            每個切片的行數（預設 200000）
     --chunk_size N       與 --chunk 相同
-    --keep_emb           不自動刪除每片輸出的 .npy/.npz（預設不保留會刪除）
+    --keep_emb           不自動刪除每片輸出的嵌入檔 *.emb.npy（預設不保留會刪除）
+    --stream             不切片；laser_run.py --stream 串流編碼整份語料（--max 直接交給 python 端）
+    --token_budget N     依句長分桶編碼，每批 padding 後 token 數上限（0=固定 batch，預設）
+    --dedup              相同句子只編碼一次
+    --cache_dir DIR      持久化向量快取（跨語料共用，隱含 --dedup）
+    --cache_max_gb G     向量快取 LRU 容量上限（預設 20）
+    --emb_dtype T        嵌入存檔格式 float32|float16|int8（緊湊格式可長期保留以便重算分數 / 重新 mining）
+    --ann                全部 chunk 完成後建立全語料 ANN 索引（ann_index.py），輸出 merged/nn_ann.tsv（隱含 --keep_emb）
+    --ann_nprobe N       ANN 查詢掃描的倒排串列數（預設 16）
+    --workers N          CPU 多行程編碼（N 個常駐 encoder 行程）
+    --worker_threads T   每個 worker 的 intra-op 執行緒數（預設 核心數/N）
+    --py_driver          改用 laser_driver.py：不 split 複製語料、模型跨分片常駐、讀寫與編碼重疊，
+                         merged/ 於每片完成時追加（與 --stream 互斥）
+    --sim_format F       逐行分數格式 both|npy|tsv（npy：scores.npy + raw.* offset，export 工具以 mmap 篩選）
 EOF
       exit 0;;
     *) echo "[ERROR] Unknown option: $1"; exit 1;;
@@ -188,6 +241,38 @@ for mod in ("laser_encoders","numpy","tqdm"):
 print("[OK] deps found")
 PY
 
+# === --py_driver：分片、續跑與合併全部交給 laser_driver.py ===
+if [[ "$PY_DRIVER" -eq 1 ]]; then
+  [[ "$STREAM" -eq 0 ]] || { echo "[ERROR] --py_driver 與 --stream 不可同時使用"; exit 1; }
+  [[ -f "$DRIVER_SCRIPT" ]] || { echo "[ERROR] 找不到 Python 腳本：$DRIVER_SCRIPT"; exit 1; }
+  MERGED_DIR="$OUT_DIR/merged"
+  python "$DRIVER_SCRIPT" \
+    --id "$ID_PATH" \
+    --zh "$ZH_PATH" \
+    --out_dir "$OUT_DIR" \
+    --chunk_size "$CHUNK_SIZE" \
+    $( [[ "$OVERWRITE" == "1" ]] && echo --overwrite ) \
+    $( [[ "$KEEP_EMB" == "1" ]] && echo --keep_emb ) \
+    --id_lang "$ID_LANG" \
+    --zh_lang "$ZH_LANG" \
+    --device "$DEVICE" \
+    --batch_size "$BATCH" \
+    --token_budget "$TOKEN_BUDGET" \
+    $( [[ "$DEDUP" == "1" ]] && echo --dedup ) \
+    --cache_dir "$CACHE_DIR" \
+    --cache_max_gb "$CACHE_MAX_GB" \
+    --workers "$WORKERS" \
+    --emb_dtype "$EMB_DTYPE" \
+    --worker_threads "$WORKER_THREADS" \
+    $( [[ "$REMOVE_TAGS" == "1" ]] && echo --remove_tags ) \
+    $( [[ "$WRITE_NN" == "1" ]] && echo --write_nn ) \
+    --nn_chunk "$NN_CHUNK" \
+    --nn_k "$NN_K" \
+    --thresholds "$THRESHOLDS" \
+    --sim_format "$SIM_FORMAT" \
+    --max_lines "$MAX_LINES" \
+    $( [[ "$ETA_ONLY" == "1" ]] && echo --eta_only )
+else
 # === 準備暫存與輸出結構（支援覆蓋） ===
 if [[ "$OVERWRITE" -eq 1 ]]; then
   if [[ -n "${OUT_DIR:-}" && "$OUT_DIR" != "/" ]]; then
@@ -209,7 +294,11 @@ rm -f -- "$CHUNK_DIR"/id.part* "$CHUNK_DIR"/zh.part* "$CHUNK_DIR"/raw.id.head "$
 # === 如 --max > 0，先各自截斷（確保行對齊） ===
 ID_SRC="$ID_PATH"
 ZH_SRC="$ZH_PATH"
-if [[ "$MAX_LINES" -gt 0 ]]; then
+PY_MAX_LINES=0
+if [[ "$STREAM" -eq 1 ]]; then
+  # 串流模式不複製來源檔，截斷交給 laser_run.py --max_lines
+  PY_MAX_LINES="$MAX_LINES"
+elif [[ "$MAX_LINES" -gt 0 ]]; then
   echo "[INFO] --max=$MAX_LINES 啟用，先截斷來源檔"
   ID_SRC="$CHUNK_DIR/raw.id.head"
   ZH_SRC="$CHUNK_DIR/raw.zh.head"
@@ -226,7 +315,13 @@ if [[ "$N_ID" -ne "$N_ZH" ]]; then
 fi
 echo "[INFO] 總行數：$N_ID"
 
-# === 切片（自訂大小） ===
+# === 切片（自訂大小）；--stream 時整份語料即為 chunk_00 ===
+if [[ "$STREAM" -eq 1 ]]; then
+  echo "[INFO] --stream 啟用：略過切片，整份語料交給 laser_run.py --stream"
+  ID_PARTS=("$ID_SRC")
+  ZH_PARTS=("$ZH_SRC")
+  CHUNK_SUFFIXES=("00")
+else
 LINES_PER_CHUNK="$CHUNK_SIZE"
 NUM_CHUNKS=$(( (N_ID + LINES_PER_CHUNK - 1) / LINES_PER_CHUNK ))
 
@@ -276,14 +371,42 @@ if [[ "${#ID_PARTS[@]}" -ne "${#ZH_PARTS[@]}" || "${#ID_PARTS[@]}" -eq 0 ]]; the
   echo "[ERROR] 分片數不一致或為 0：id=${#ID_PARTS[@]} zh=${#ZH_PARTS[@]}"
   exit 1
 fi
+CHUNK_SUFFIXES=()
+for f in "${ID_PARTS[@]}"; do CHUNK_SUFFIXES+=("${f##*id.part}"); done   # e.g., 00, 01, ...
+fi
 
 # === 逐片執行 laser_run.py ===
+# 分數目錄一律指向原始 ID_PATH / ZH_PATH（--max 的 raw.*.head 也是它們的前綴）：
+# chunks_src/ 每次執行都會重新切片，指向切片檔的 offsets 在下次執行後就會被 ScoreStore 判為過期。
+# split 不改動位元組，每片在原檔的起始 byte = 前面各片大小的累計。
+ID_BASE=0
+ZH_BASE=0
 for ((i=0; i<${#ID_PARTS[@]}; i++)); do
   ID_CHUNK="${ID_PARTS[$i]}"
   ZH_CHUNK="${ZH_PARTS[$i]}"
-  SUF="${ID_CHUNK##*id.part}"   # e.g., 00, 01, ...
+  SUF="${CHUNK_SUFFIXES[$i]}"
   OUT_CHUNK_DIR="$OUT_DIR/chunk_${SUF}"
-  rm -rf -- "$OUT_CHUNK_DIR"
+  DONE_FILE="$OUT_CHUNK_DIR/.done"
+  CHUNK_ID_BASE="$ID_BASE"
+  CHUNK_ZH_BASE="$ZH_BASE"
+  ID_BASE=$(( ID_BASE + $(wc -c < "$ID_CHUNK") ))
+  ZH_BASE=$(( ZH_BASE + $(wc -c < "$ZH_CHUNK") ))
+
+  # 完成標記：輸入內容 + 會影響輸出的參數（與 laser_driver.py 的 chunk_hash 相同；
+  # 倒數第二欄為 --no_norm，本腳本不傳所以固定 0；KEEP_EMB=0 時嵌入檔會被清掉，也要列入）
+  CHUNK_HASH="$(
+    { cat -- "$ID_CHUNK" "$ZH_CHUNK"
+      echo "$ID_LANG|$ZH_LANG|$REMOVE_TAGS|$WRITE_NN|$NN_K|$THRESHOLDS|$EMB_DTYPE|$PY_MAX_LINES|$SIM_FORMAT|0|$KEEP_EMB"
+    } | md5sum | cut -d' ' -f1
+  )"
+  if [[ -f "$DONE_FILE" && "$(cat "$DONE_FILE")" == "$CHUNK_HASH" ]]; then
+    echo "[INFO] === 分片 #$((i+1))/${#ID_PARTS[@]} (suffix=$SUF) 已完成（hash 相符），略過 ==="
+    continue
+  fi
+  if [[ -f "$DONE_FILE" ]]; then
+    echo "[INFO] chunk_${SUF} 的輸入或參數已變更，清除舊輸出重做"
+    rm -rf -- "$OUT_CHUNK_DIR"
+  fi
   mkdir -p "$OUT_CHUNK_DIR"
 
   echo "[INFO] === 處理分片 #$((i+1))/${#ID_PARTS[@]} (suffix=$SUF) ==="
@@ -299,21 +422,42 @@ for ((i=0; i<${#ID_PARTS[@]}; i++)); do
     --zh_lang "$ZH_LANG" \
     --device "$DEVICE" \
     --batch_size "$BATCH" \
+    --token_budget "$TOKEN_BUDGET" \
+    $( [[ "$DEDUP" == "1" ]] && echo --dedup ) \
+    --cache_dir "$CACHE_DIR" \
+    --cache_max_gb "$CACHE_MAX_GB" \
+    --workers "$WORKERS" \
+    --emb_dtype "$EMB_DTYPE" \
+    --worker_threads "$WORKER_THREADS" \
     $( [[ "$REMOVE_TAGS" == "1" ]] && echo --remove_tags ) \
     $( [[ "$WRITE_NN" == "1" ]] && echo --write_nn ) \
     --nn_chunk "$NN_CHUNK" \
+    --nn_k "$NN_K" \
     --thresholds "$THRESHOLDS" \
-    --max_lines 0 \
-    $( [[ "$ETA_ONLY" == "1" ]] && echo --eta_only )
+    --sim_format "$SIM_FORMAT" \
+    --max_lines "$PY_MAX_LINES" \
+    --store_id "$ID_PATH" \
+    --store_zh "$ZH_PATH" \
+    --store_id_base "$CHUNK_ID_BASE" \
+    --store_zh_base "$CHUNK_ZH_BASE" \
+    $( [[ "$ETA_ONLY" == "1" ]] && echo --eta_only ) \
+    $( [[ "$STREAM" == "1" ]] && echo --stream --resume )
+
+  # 原子寫入完成標記（eta_only 不算完成）
+  if [[ "$ETA_ONLY" -eq 0 ]]; then
+    echo "$CHUNK_HASH" > "$DONE_FILE.tmp"
+    mv -f -- "$DONE_FILE.tmp" "$DONE_FILE"
+  fi
 
   # === 清理本片的嵌入大檔，避免 / 爆空間 ===
+  # 只刪嵌入檔；scores.npy、*.offsets.npy、scores_sketch.npz 之後的 summary / merge 還要用
   if [[ "$KEEP_EMB" -eq 0 ]]; then
-    echo "[INFO]  清理 chunk_${SUF} 內的 .npy/.npz 以釋放空間"
+    echo "[INFO]  清理 chunk_${SUF} 內的嵌入檔（*.emb.npy / *.emb.scale.npy）以釋放空間"
     to_free_bytes=$(
-      find "$OUT_CHUNK_DIR" -maxdepth 1 -type f \( -name '*.npy' -o -name '*.npz' \) -printf '%s\n' 2>/dev/null \
+      find "$OUT_CHUNK_DIR" -maxdepth 1 -type f \( -name '*.emb.npy' -o -name '*.emb.scale.npy' \) -printf '%s\n' 2>/dev/null \
       | awk '{s+=$1} END{print s+0}'
     )
-    find "$OUT_CHUNK_DIR" -maxdepth 1 -type f \( -name '*.npy' -o -name '*.npz' \) -print -exec rm -f -- {} + 2>/dev/null || true
+    find "$OUT_CHUNK_DIR" -maxdepth 1 -type f \( -name '*.emb.npy' -o -name '*.emb.scale.npy' \) -print -exec rm -f -- {} + 2>/dev/null || true
     if [[ "${to_free_bytes:-0}" -gt 0 ]]; then
       if command -v numfmt >/dev/null 2>&1; then
         human="$(numfmt --to=iec "${to_free_bytes}")"
@@ -322,7 +466,7 @@ for ((i=0; i<${#ID_PARTS[@]}; i++)); do
         echo "[INFO]  已釋放：${to_free_bytes} bytes"
       fi
     else
-      echo "[INFO]  沒有需要清理的 .npy/.npz"
+      echo "[INFO]  沒有需要清理的嵌入檔"
     fi
   else
     echo "[INFO]  --keep_emb 啟用，保留 chunk_${SUF} 的嵌入檔"
@@ -390,6 +534,27 @@ else
   done
 fi
 
+# 全語料統計：合併各片 scores_sketch.npz（O(chunks)，不重讀 merged/similarity.tsv）
+if [[ "$ETA_ONLY" -eq 0 ]]; then
+  echo "[INFO]  合併 scores_sketch.npz → $MERGED_DIR/scores_summary.json"
+  python "$STORE_SCRIPT" summary --laser_out "$OUT_DIR" --out_dir "$MERGED_DIR"
+fi
+
+# 分數目錄：串接 chunk_XX/scores.npy，offset 改指向完整來源檔（--max 時也是原檔的前 N 行，不用 raw.*.head）
+if [[ "$SIM_FORMAT" != "tsv" && "$ETA_ONLY" -eq 0 ]]; then
+  echo "[INFO]  合併 scores.npy → $MERGED_DIR"
+  python "$STORE_SCRIPT" merge --laser_out "$OUT_DIR" --id "$ID_PATH" --zh "$ZH_PATH" --out_dir "$MERGED_DIR"
+fi
+
 echo "[INFO] 合併完成。"
+fi
+
+# === （可選）跨 chunk 的 ANN 最近鄰 ===
+if [[ "$ANN" -eq 1 && "$ETA_ONLY" -eq 0 ]]; then
+  echo "[INFO] 建立全語料 ANN 索引 → $OUT_DIR/ann"
+  python "$ANN_SCRIPT" build --laser_out "$OUT_DIR" --index "$OUT_DIR/ann"
+  python "$ANN_SCRIPT" query --laser_out "$OUT_DIR" --index "$OUT_DIR/ann" \
+    --k "$NN_K" --nprobe "$ANN_NPROBE" --out "$MERGED_DIR/nn_ann.tsv"
+fi
 echo "[INFO] chunk 個別輸出保留於：$OUT_DIR/chunk_XX/"
 echo "[INFO] 合併表格輸出位於：$MERGED_DIR/"
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ann_index.py
+- 以 run_laser.sh 各 chunk 的 raw.zh.emb.npy 建立全語料的近似最近鄰索引（IVF + Product Quantization）
+- build：一次建好索引（所有 chunk 共用一個全域行號空間）
+- query：以各 chunk 的 raw.id.emb.npy 分批查詢，輸出 nn_ann.tsv（全域行號），跨 chunk 也能找到對應句
+- bench：抽樣查詢，對照暴力法的 recall@1 / recall@k 與 QPS
+
+預設為純 NumPy 實作；裝有 faiss-cpu 時可用 --backend faiss。
+float16 / int8（laser_run.py --emb_dtype）嵌入可直接使用：向量一律先單位化，int8 的逐向量 scale 會被消去。
+用法：
+  python ann_index.py build --laser_out <OUT_DIR> --index <OUT_DIR>/ann
+  python ann_index.py query --laser_out <OUT_DIR> --index <OUT_DIR>/ann --k 4 --nprobe 16
+  python ann_index.py bench --laser_out <OUT_DIR> --index <OUT_DIR>/ann --sample 2000
+"""
+
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+# ---------------------------------------------------------------------------
+# chunk 嵌入檔：依 chunk 順序串成一個全域行號空間
+# ---------------------------------------------------------------------------
+
+class ChunkedEmbeddings:
+    """把 chunk_XX/<name> 的多個 .npy（memmap 開啟）當成一個連續矩陣使用。"""
+
+    def __init__(self, paths: List[Path]):
+        self.paths = list(paths)
+        self.arrays = [np.load(str(p), mmap_mode="r") for p in self.paths]
+        sizes = [len(a) for a in self.arrays]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.dim = self.arrays[0].shape[1] if self.arrays else 0
+
+    @classmethod
+    def from_laser_out(cls, laser_out: Path, name: str) -> "ChunkedEmbeddings":
+        paths = sorted(Path(laser_out).glob(f"chunk_*/{name}"))
+        if not paths and (Path(laser_out) / name).is_file():
+            paths = [Path(laser_out) / name]
+        if not paths:
+            raise FileNotFoundError(f"no {name} under {laser_out} (run_laser.sh 需加 --keep_emb)")
+        return cls(paths)
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def iter_blocks(self, block: int = 65536):
+        """依序產生 (global_start, float32 block)。"""
+        for a, base in zip(self.arrays, self.offsets[:-1]):
+            for i in range(0, len(a), block):
+                yield int(base + i), np.asarray(a[i:i + block], dtype=np.float32)
+
+    def take(self, ids: np.ndarray) -> np.ndarray:
+        """依全域行號取列（可亂序）。"""
+        ids = np.asarray(ids, dtype=np.int64)
+        out = np.empty((len(ids), self.dim), dtype=np.float32)
+        which = np.searchsorted(self.offsets, ids, side="right") - 1
+        for c in np.unique(which):
+            m = which == c
+            local = ids[m] - self.offsets[c]
+            o = np.argsort(local)
+            rows = np.asarray(self.arrays[c][local[o]], dtype=np.float32)
+            out[np.flatnonzero(m)[o]] = rows
+        return out
+
+    def sample(self, n: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        rng = np.random.default_rng(seed)
+        ids = np.sort(rng.choice(len(self), size=min(n, len(self)), replace=False))
+        return ids, self.take(ids)
+
+
+def _unit(X: np.ndarray) -> np.ndarray:
+    return X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-12)
+
+
+# ---------------------------------------------------------------------------
+# NumPy IVF-PQ
+# ---------------------------------------------------------------------------
+
+def kmeans(X: np.ndarray, k: int, iters: int = 20, seed: int = 0) -> np.ndarray:
+    """L2 k-means（Lloyd），空群以隨機樣本重新播種。"""
+    rng = np.random.default_rng(seed)
+    k = min(k, len(X))
+    C = X[rng.choice(len(X), size=k, replace=False)].copy()
+    for _ in range(iters):
+        a = assign_l2(X, C)
+        sums = np.zeros_like(C)
+        np.add.at(sums, a, X)
+        cnt = np.bincount(a, minlength=k).astype(np.float32)
+        empty = cnt == 0
+        C = sums / np.maximum(cnt, 1)[:, None]
+        if empty.any():
+            C[empty] = X[rng.choice(len(X), size=int(empty.sum()), replace=False)]
+    return C.astype(np.float32)
+
+
+def assign_l2(X: np.ndarray, C: np.ndarray, block: int = 16384) -> np.ndarray:
+    cn = (C * C).sum(axis=1)
+    out = np.empty(len(X), dtype=np.int64)
+    for i in range(0, len(X), block):
+        out[i:i + block] = (cn[None, :] - 2.0 * (X[i:i + block] @ C.T)).argmin(axis=1)
+    return out
+
+
+class IVFPQIndex:
+    """
+    內積（單位向量 = cosine）IVF-PQ：
+      coarse：nlist 個 k-means 中心，查詢時只掃 nprobe 個最接近的倒排串列
+      fine  ：殘差切成 m 段，每段 256 個碼字（uint8），以查表（ADC）估計 q·x
+    另可對前 rerank 名候選用原始向量精算 cosine。
+    """
+
+    def __init__(self, dim: int, nlist: int = 1024, m: int = 64):
+        if dim % m:
+            raise ValueError(f"dim {dim} must be divisible by m {m}")
+        self.dim, self.nlist, self.m = dim, nlist, m
+        self.dsub = dim // m
+        self.coarse: Optional[np.ndarray] = None     # (nlist, dim)
+        self.codebooks: Optional[np.ndarray] = None  # (m, 256, dsub)
+        self.codes = np.zeros((0, m), dtype=np.uint8)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.list_ptr = np.zeros(nlist + 1, dtype=np.int64)
+        self._pending: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+
+    def train(self, X: np.ndarray, iters: int = 20, seed: int = 0) -> None:
+        X = _unit(np.asarray(X, dtype=np.float32))
+        self.coarse = kmeans(X, self.nlist, iters, seed)
+        self.nlist = len(self.coarse)
+        R = X - self.coarse[assign_l2(X, self.coarse)]
+        self.codebooks = np.stack([
+            kmeans(R[:, j * self.dsub:(j + 1) * self.dsub], 256, iters, seed + j + 1)
+            for j in range(self.m)
+        ])
+
+    def _encode(self, R: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(R), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = assign_l2(R[:, j * self.dsub:(j + 1) * self.dsub], self.codebooks[j])
+        return codes
+
+    def add(self, X: np.ndarray, start_id: int) -> None:
+        X = _unit(np.asarray(X, dtype=np.float32))
+        lists = assign_l2(X, self.coarse)
+        codes = self._encode(X - self.coarse[lists])
+        self._pending.append((lists, codes, np.arange(start_id, start_id + len(X), dtype=np.int64)))
+
+    def finalize(self) -> None:
+        """把 add() 累積的資料依倒排串列排序成連續陣列。"""
+        if not self._pending:
+            return
+        lists = np.concatenate([p[0] for p in self._pending])
+        codes = np.concatenate([self.codes] + [p[1] for p in self._pending])
+        ids = np.concatenate([self.ids] + [p[2] for p in self._pending])
+        old_lists = np.repeat(np.arange(self.nlist), np.diff(self.list_ptr))
+        lists = np.concatenate([old_lists, lists])
+        o = np.argsort(lists, kind="stable")
+        self.codes, self.ids = codes[o], ids[o]
+        self.list_ptr = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=self.nlist))]).astype(np.int64)
+        self._pending = []
+
+    def search(self, Q: np.ndarray, k: int, nprobe: int = 16, rerank: int = 0,
+               base: Optional[ChunkedEmbeddings] = None) -> Tuple[np.ndarray, np.ndarray]:
+        Q = _unit(np.asarray(Q, dtype=np.float32))
+        nprobe = min(nprobe, self.nlist)
+        coarse_s = Q @ self.coarse.T
+        probe = np.argpartition(-coarse_s, nprobe - 1, axis=1)[:, :nprobe]
+        D = np.full((len(Q), k), -np.inf, dtype=np.float32)
+        I = np.full((len(Q), k), -1, dtype=np.int64)
+        sub = np.arange(self.m)
+        for qi in range(len(Q)):
+            lut = np.einsum("md,mkd->mk", Q[qi].reshape(self.m, self.dsub), self.codebooks)
+            sel = [(l, self.list_ptr[l], self.list_ptr[l + 1]) for l in probe[qi]]
+            sel = [t for t in sel if t[2] > t[1]]
+            if not sel:
+                continue
+            codes = np.concatenate([self.codes[a:b] for _, a, b in sel])
+            ids = np.concatenate([self.ids[a:b] for _, a, b in sel])
+            base_s = np.concatenate([np.full(b - a, coarse_s[qi, l], dtype=np.float32) for l, a, b in sel])
+            s = base_s + lut[sub, codes].sum(axis=1)
+            keep = max(k, rerank) if (rerank and base is not None) else k
+            keep = min(keep, len(s))
+            top = np.argpartition(-s, keep - 1)[:keep]
+            cand, cs = ids[top], s[top]
+            if rerank and base is not None:
+                cs = _unit(base.take(cand)) @ Q[qi]
+            o = np.argsort(-cs, kind="stable")[:k]
+            D[qi, :len(o)], I[qi, :len(o)] = cs[o], cand[o]
+        return D, I
+
+    def save(self, d: Path) -> None:
+        d.mkdir(parents=True, exist_ok=True)
+        np.savez(d / "ivfpq.npz", coarse=self.coarse, codebooks=self.codebooks,
+                 codes=self.codes, ids=self.ids, list_ptr=self.list_ptr,
+                 meta=np.array([self.dim, self.nlist, self.m]))
+
+    @classmethod
+    def load(cls, d: Path) -> "IVFPQIndex":
+        z = np.load(d / "ivfpq.npz")
+        dim, nlist, m = (int(x) for x in z["meta"])
+        idx = cls(dim, nlist, m)
+        idx.coarse, idx.codebooks = z["coarse"], z["codebooks"]
+        idx.codes, idx.ids, idx.list_ptr = z["codes"], z["ids"], z["list_ptr"]
+        return idx
+
+
+class FaissIndex:
+    """faiss-cpu 的 IndexIVFPQ（內積）包裝，介面與 IVFPQIndex 相同。"""
+
+    def __init__(self, dim: int, nlist: int = 1024, m: int = 64, index=None):
+        import faiss
+        self.faiss = faiss
+        if index is None:
+            quant = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFPQ(quant, dim, nlist, m, 8, faiss.METRIC_INNER_PRODUCT)
+        self.index = index
+
+    def train(self, X: np.ndarray, iters: int = 20, seed: int = 0) -> None:
+        self.index.train(_unit(np.asarray(X, dtype=np.float32)))
+
+    def add(self, X: np.ndarray, start_id: int) -> None:
+        X = _unit(np.asarray(X, dtype=np.float32))
+        if self.index.ntotal != start_id:
+            raise ValueError("faiss backend expects blocks in global order")
+        self.index.add(X)
+
+    def finalize(self) -> None:
+        pass
+
+    def search(self, Q: np.ndarray, k: int, nprobe: int = 16, rerank: int = 0,
+               base: Optional[ChunkedEmbeddings] = None) -> Tuple[np.ndarray, np.ndarray]:
+        self.index.nprobe = nprobe
+        Q = _unit(np.asarray(Q, dtype=np.float32))
+        if rerank and base is not None:
+            _, cand = self.index.search(Q, max(k, rerank))
+            D = np.full((len(Q), k), -np.inf, dtype=np.float32)
+            I = np.full((len(Q), k), -1, dtype=np.int64)
+            for qi in range(len(Q)):
+                c = cand[qi][cand[qi] >= 0]
+                cs = _unit(base.take(c)) @ Q[qi]
+                o = np.argsort(-cs, kind="stable")[:k]
+                D[qi, :len(o)], I[qi, :len(o)] = cs[o], c[o]
+            return D, I
+        return self.index.search(Q, k)
+
+    def save(self, d: Path) -> None:
+        d.mkdir(parents=True, exist_ok=True)
+        self.faiss.write_index(self.index, str(d / "ivfpq.faiss"))
+
+    @classmethod
+    def load(cls, d: Path) -> "FaissIndex":
+        import faiss
+        return cls(0, index=faiss.read_index(str(d / "ivfpq.faiss")))
+
+
+def load_index(d: Path):
+    meta = json.loads((d / "meta.json").read_text(encoding="utf-8"))
+    idx = FaissIndex.load(d) if meta["backend"] == "faiss" else IVFPQIndex.load(d)
+    return idx, meta
+
+
+# ---------------------------------------------------------------------------
+# 暴力法（bench 對照組）
+# ---------------------------------------------------------------------------
+
+def brute_force_topk(Q: np.ndarray, base: ChunkedEmbeddings, k: int, block: int = 65536):
+    Q = _unit(np.asarray(Q, dtype=np.float32))
+    D = np.full((len(Q), k), -np.inf, dtype=np.float32)
+    I = np.full((len(Q), k), -1, dtype=np.int64)
+    for start, X in base.iter_blocks(block):
+        S = Q @ _unit(X).T
+        V = np.concatenate([D, S], axis=1)
+        J = np.concatenate([I, np.broadcast_to(np.arange(start, start + len(X)), S.shape)], axis=1)
+        p = np.argpartition(-V, k - 1, axis=1)[:, :k]
+        D, I = np.take_along_axis(V, p, 1), np.take_along_axis(J, p, 1)
+    o = np.argsort(-D, axis=1, kind="stable")
+    return np.take_along_axis(D, o, 1), np.take_along_axis(I, o, 1)
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def cmd_build(args) -> None:
+    base = ChunkedEmbeddings.from_laser_out(Path(args.laser_out), args.base_name)
+    n = len(base)
+    nlist = args.nlist or max(16, int(4 * np.sqrt(n)))
+    print(f"[INFO] base: {n} vectors from {len(base.paths)} chunk(s), dim={base.dim}, nlist={nlist}, m={args.m}")
+    if args.backend == "faiss":
+        index = FaissIndex(base.dim, nlist, args.m)
+    else:
+        index = IVFPQIndex(base.dim, nlist, args.m)
+
+    t0 = time.time()
+    _, train_x = base.sample(max(args.train_size, 40 * nlist) if args.backend == "faiss" else args.train_size, args.seed)
+    index.train(train_x, args.iters, args.seed)
+    t1 = time.time()
+    for start, X in base.iter_blocks(args.block):
+        index.add(X, start)
+    index.finalize()
+    t2 = time.time()
+
+    out = Path(args.index)
+    index.save(out)
+    meta = {
+        "backend": args.backend, "n": n, "dim": base.dim, "nlist": nlist, "m": args.m,
+        "base_name": args.base_name, "chunks": [str(p) for p in base.paths],
+        "offsets": base.offsets.tolist(),
+    }
+    (out / "meta.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"[BENCH] train {t1 - t0:.1f}s, add {t2 - t1:.1f}s ({n / max(t2 - t1, 1e-9):.0f} vec/s)")
+    print(f"[DONE] index saved to: {out}")
+
+
+def cmd_query(args) -> None:
+    index, meta = load_index(Path(args.index))
+    queries = ChunkedEmbeddings.from_laser_out(Path(args.laser_out), args.query_name)
+    base = ChunkedEmbeddings([Path(p) for p in meta["chunks"]]) if args.rerank else None
+    out = Path(args.out) if args.out else Path(args.laser_out) / "merged" / "nn_ann.tsv"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    t0 = time.time()
+    with out.open("w", encoding="utf-8") as f:
+        f.write("id_idx\trank\tzh_idx\tscore\n")
+        for start, Q in queries.iter_blocks(args.batch):
+            D, I = index.search(Q, args.k, args.nprobe, args.rerank, base)
+            for qi in range(len(Q)):
+                for r in range(args.k):
+                    if I[qi, r] >= 0:
+                        f.write(f"{start + qi}\t{r + 1}\t{int(I[qi, r])}\t{D[qi, r]:.6f}\n")
+    dt = time.time() - t0
+    print(f"[BENCH] {len(queries)} queries in {dt:.1f}s -> {len(queries) / max(dt, 1e-9):.1f} q/s")
+    print(f"[DONE] Saved to: {out}")
+
+
+def cmd_bench(args) -> None:
+    index, meta = load_index(Path(args.index))
+    base = ChunkedEmbeddings([Path(p) for p in meta["chunks"]])
+    queries = ChunkedEmbeddings.from_laser_out(Path(args.laser_out), args.query_name)
+    _, Q = queries.sample(args.sample, args.seed)
+
+    t0 = time.time()
+    _, I_exact = brute_force_topk(Q, base, args.k)
+    t1 = time.time()
+    _, I_ann = index.search(Q, args.k, args.nprobe, args.rerank, base if args.rerank else None)
+    t2 = time.time()
+
+    r1 = float((I_ann[:, 0] == I_exact[:, 0]).mean())
+    rk = float(np.mean([len(set(a) & set(b)) / args.k for a, b in zip(I_ann, I_exact)]))
+    print(f"[BENCH] exact : {len(Q)} queries in {t1 - t0:.2f}s -> {len(Q) / max(t1 - t0, 1e-9):.1f} q/s")
+    print(f"[BENCH] ann   : {len(Q)} queries in {t2 - t1:.2f}s -> {len(Q) / max(t2 - t1, 1e-9):.1f} q/s "
+          f"(nprobe={args.nprobe}, rerank={args.rerank})")
+    print(f"[BENCH] recall@1={r1:.4f}  recall@{args.k}={rk:.4f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Corpus-wide IVF-PQ ANN index over LASER chunk embeddings")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    def common(p):
+        p.add_argument("--laser_out", required=True, help="run_laser.sh OUT_DIR (contains chunk_XX/)")
+        p.add_argument("--index", required=True, help="Index directory")
+
+    p = sub.add_parser("build", help="Train + add all chunk base embeddings")
+    common(p)
+    p.add_argument("--base_name", default="raw.zh.emb.npy", help="Per-chunk embedding file to index")
+    p.add_argument("--backend", choices=("numpy", "faiss"), default="numpy")
+    p.add_argument("--nlist", type=int, default=0, help="Inverted lists (0 = 4*sqrt(N))")
+    p.add_argument("--m", type=int, default=64, help="PQ sub-quantizers (dim must be divisible by m)")
+    p.add_argument("--train_size", type=int, default=100000)
+    p.add_argument("--iters", type=int, default=20)
+    p.add_argument("--block", type=int, default=65536)
+    p.add_argument("--seed", type=int, default=0)
+
+    for name in ("query", "bench"):
+        p = sub.add_parser(name)
+        common(p)
+        p.add_argument("--query_name", default="raw.id.emb.npy", help="Per-chunk query embedding file")
+        p.add_argument("--k", type=int, default=4)
+        p.add_argument("--nprobe", type=int, default=16)
+        p.add_argument("--rerank", type=int, default=0, help="Re-score top R candidates with exact cosine (0 = off)")
+        if name == "query":
+            p.add_argument("--batch", type=int, default=4096)
+            p.add_argument("--out", default="", help="Output TSV (default: <laser_out>/merged/nn_ann.tsv)")
+        else:
+            p.add_argument("--sample", type=int, default=2000)
+            p.add_argument("--seed", type=int, default=0)
+
+    args = ap.parse_args()
+    if args.cmd == "build" and args.backend == "faiss":
+        try:
+            import faiss  # noqa: F401
+        except ImportError:
+            print("[ERROR] --backend faiss needs faiss-cpu (pip install faiss-cpu)")
+            sys.exit(3)
+    {"build": cmd_build, "query": cmd_query, "bench": cmd_bench}[args.cmd](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+emb_cache.py
+- LASER 句向量的持久化快取（sqlite 單檔），供 laser_run.py 跨語料 / 跨次執行共用
+- key = sha1(key 格式版本 + 編碼器識別 + lang code + 是否 L2 正規化 + 正規化後句子)，value = float32 向量 bytes
+  編碼器識別由呼叫端提供（laser_run.encoder_identity：laser_encoders 版本 + 模型檔），
+  升級 encoder 後舊向量不會再被命中；key 格式變更時開檔即清空舊資料（meta 表記錄 key_version）
+- 以總 bytes 上限做 LRU 淘汰（依最後存取時間）
+
+只用標準庫 + numpy。
+"""
+
+import re
+import time
+import sqlite3
+import hashlib
+import unicodedata
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+_WS = re.compile(r"\s+")
+
+# sentence_key 的格式版本；改變 key 的組成時遞增，舊格式的資料在開檔時清掉
+KEY_VERSION = 2
+
+# sqlite 單一語句參數上限（舊版 999）
+_SQL_CHUNK = 900
+
+
+def normalize_sentence(s: str) -> str:
+    """快取鍵用的正規化：NFC + 空白壓縮 + 去頭尾空白（不改大小寫，避免改變編碼結果）。"""
+    return _WS.sub(" ", unicodedata.normalize("NFC", s)).strip()
+
+
+def sentence_key(lang_code: str, s: str, normalized: bool = True, encoder_id: str = "") -> bytes:
+    h = hashlib.sha1()
+    h.update(bytes([KEY_VERSION]))
+    h.update(encoder_id.encode("utf-8") + b"\0")
+    h.update(lang_code.encode("utf-8"))
+    h.update(b"\0n\0" if normalized else b"\0r\0")
+    h.update(normalize_sentence(s).encode("utf-8"))
+    return h.digest()
+
+
+class EmbeddingCache:
+    """
+    sqlite 版 LRU 向量快取。
+
+    用法：
+        cache = EmbeddingCache("~/.cache/laser_emb", max_bytes=20 << 30)
+        found = cache.get_many(keys)          # {key: np.ndarray}
+        cache.put_many(zip(keys, vectors))
+        cache.close()                          # 會做一次 LRU 淘汰
+    """
+
+    def __init__(self, cache_dir, max_bytes: int = 20 << 30):
+        self.dir = Path(cache_dir).expanduser()
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.dir / "emb_cache.sqlite"
+        self.max_bytes = int(max_bytes)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS emb ("
+            " k BLOB PRIMARY KEY, dim INTEGER NOT NULL, v BLOB NOT NULL, atime REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS emb_atime ON emb(atime)")
+        # 每種語言累積的編碼耗時，全部命中時仍可估算省下的時間
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS rate (lang TEXT PRIMARY KEY, sec REAL NOT NULL, n INTEGER NOT NULL)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        row = self.db.execute("SELECT value FROM meta WHERE name='key_version'").fetchone()
+        if row is None or row[0] != str(KEY_VERSION):
+            # 舊格式的 key 永遠不會再命中，直接清掉免得佔著 LRU 容量
+            stale = self.db.execute("SELECT COUNT(*) FROM emb").fetchone()[0]
+            if stale:
+                print(f"[CACHE] key format changed (v{row[0] if row else 1} -> v{KEY_VERSION}): "
+                      f"dropping {stale} cached vectors")
+                self.db.execute("DELETE FROM emb")
+            self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('key_version', ?)", (str(KEY_VERSION),))
+        self.db.commit()
+
+    def record_rate(self, lang_code: str, sec: float, n: int) -> None:
+        if n <= 0:
+            return
+        self.db.execute(
+            "INSERT INTO rate (lang, sec, n) VALUES (?,?,?) "
+            "ON CONFLICT(lang) DO UPDATE SET sec=sec+excluded.sec, n=n+excluded.n",
+            (lang_code, float(sec), int(n)),
+        )
+        self.db.commit()
+
+    def sec_per_sentence(self, lang_code: str) -> float:
+        row = self.db.execute("SELECT sec, n FROM rate WHERE lang=?", (lang_code,)).fetchone()
+        return row[0] / row[1] if row and row[1] else 0.0
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        found: Dict[bytes, np.ndarray] = {}
+        now = time.time()
+        for i in range(0, len(keys), _SQL_CHUNK):
+            part = list(keys[i:i + _SQL_CHUNK])
+            q = "SELECT k, v FROM emb WHERE k IN (%s)" % ",".join("?" * len(part))
+            hit = []
+            for k, v in self.db.execute(q, part):
+                found[bytes(k)] = np.frombuffer(v, dtype=np.float32)
+                hit.append(k)
+            if hit:
+                self.db.executemany("UPDATE emb SET atime=? WHERE k=?", [(now, k) for k in hit])
+        self.db.commit()
+        return found
+
+    def put_many(self, items) -> None:
+        now = time.time()
+        rows: List[Tuple[bytes, int, bytes, float]] = []
+        for k, vec in items:
+            vec = np.ascontiguousarray(vec, dtype=np.float32)
+            rows.append((k, int(vec.shape[-1]), vec.tobytes(), now))
+        self.db.executemany("INSERT OR REPLACE INTO emb (k, dim, v, atime) VALUES (?,?,?,?)", rows)
+        self.db.commit()
+
+    def size_bytes(self) -> int:
+        row = self.db.execute("SELECT COALESCE(SUM(LENGTH(v)), 0) FROM emb").fetchone()
+        return int(row[0])
+
+    def evict(self) -> int:
+        """超過 max_bytes 時依 atime 由舊到新刪除，直到降到上限的 90%。回傳刪除筆數。"""
+        total = self.size_bytes()
+        if total <= self.max_bytes:
+            return 0
+        target = int(self.max_bytes * 0.9)
+        removed = 0
+        cur = self.db.execute("SELECT k, LENGTH(v) FROM emb ORDER BY atime ASC")
+        victims = []
+        for k, nbytes in cur:
+            if total <= target:
+                break
+            victims.append((k,))
+            total -= int(nbytes)
+        if victims:
+            self.db.executemany("DELETE FROM emb WHERE k=?", victims)
+            removed = len(victims)
+            self.db.commit()
+        return removed
+
+    def close(self) -> None:
+        removed = self.evict()
+        if removed:
+            print(f"[CACHE] LRU evicted {removed} vectors (limit {self.max_bytes / (1 << 30):.1f} GiB)")
+        self.db.close()
+
+
+class CacheStats:
+    """單一語言的去重 / 快取統計，用來回報命中率與省下的編碼時間。"""
+
+    def __init__(self, lang_code: str):
+        self.lang = lang_code
+        self.total = 0        # 輸入句數
+        self.unique = 0       # 去重後句數
+        self.hits = 0         # 快取命中（以 unique 計）
+        self.encoded = 0      # 實際送進 encoder 的句數
+        self.encode_sec = 0.0
+
+    def report(self, cache: Optional[EmbeddingCache] = None) -> str:
+        if self.encoded:
+            per_sent = self.encode_sec / self.encoded
+        else:
+            per_sent = cache.sec_per_sentence(self.lang) if cache is not None else 0.0
+        saved = (self.total - self.encoded) * per_sent
+        rate = self.hits / self.unique if self.unique else 0.0
+        return (f"[CACHE] {self.lang}: lines={self.total} unique={self.unique} "
+                f"(dups {self.total - self.unique}) hits={self.hits} ({rate:.1%}) "
+                f"encoded={self.encoded} in {self.encode_sec:.1f}s, saved ~{saved:.1f}s")
+
+
+def open_cache(cache_dir: Optional[str], max_gb: float) -> Optional[EmbeddingCache]:
+    if not cache_dir:
+        return None
+    return EmbeddingCache(cache_dir, max_bytes=int(max_gb * (1 << 30)))
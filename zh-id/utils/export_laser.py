@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+export_laser.py
+- 一次讀完 similarity.tsv（或 scores.npy 分數目錄），依多個門檻同時分流成 .id / .zh，
+  取代對每個門檻各跑一次 export_filtered.sh / filter_laser_by_threshold.py
+- 分桶（門檻 t1 < t2 < ... < tn，比較方式同 export_filtered.sh：score >= t 算通過）：
+    <prefix>_lt<t1>        score < t1
+    <prefix>_<ti>-<ti+1>   ti <= score < ti+1
+    <prefix>_ge<tn>        score >= tn
+  --cumulative 另外輸出 t1..t(n-1) 的 <prefix>_ge<ti>（score >= ti，檔案之間有重疊；
+  >= tn 即最後一個分桶 <prefix>_ge<tn>，不重複輸出）
+- TSV：切成約 --block_mb 的 byte 區段（對齊換行）交給 process pool，結果依區段順序寫出；
+  .gz 以 pigz -dc（若有）解壓後依相同方式分塊
+- 分數目錄：以 mmap 向量化算出每行的桶號，再各掃一次原始 raw.id / raw.zh
+
+用法：
+  python export_laser.py --sim laser_out/merged/similarity.tsv --thresholds 0.6,0.7,0.8,0.9 \
+      --out_dir data/my_corpus --prefix laser [--workers 8] [--cumulative]
+"""
+
+import os
+import sys
+import gzip
+import time
+import shutil
+import bisect
+import argparse
+import subprocess
+import multiprocessing as mp
+from pathlib import Path
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from scores_store import CLEAN_TAG_RE, ScoreStore, is_store, tsv_rounded
+
+SCORE_COLS = ("cosine", "score", "similarity")
+
+
+def thr_tag(t: float) -> str:
+    """與 export_filtered.sh 的 ${THR//./} 相同：0.75 -> 075。"""
+    return str(t).replace(".", "")
+
+
+def bucket_names(prefix: str, thresholds: Sequence[float]) -> List[str]:
+    names = [f"{prefix}_lt{thr_tag(thresholds[0])}"]
+    for lo, hi in zip(thresholds, thresholds[1:]):
+        names.append(f"{prefix}_{thr_tag(lo)}-{thr_tag(hi)}")
+    names.append(f"{prefix}_ge{thr_tag(thresholds[-1])}")
+    return names
+
+
+def parse_header(header: bytes) -> Tuple[int, int, int]:
+    """回傳 (score 欄, id_sentence 欄, zh_sentence 欄) 的 0-based 索引；規則同 export_filtered.sh。"""
+    cols = [c.strip().lower() for c in header.decode("utf-8").rstrip("\r\n").split("\t")]
+    try:
+        si = next(i for i, c in enumerate(cols) if c in SCORE_COLS)
+        ii = cols.index("id_sentence")
+        zi = cols.index("zh_sentence")
+    except (StopIteration, ValueError):
+        raise ValueError("header missing. Need columns: id_sentence, zh_sentence, and cosine/score/similarity")
+    return si, ii, zi
+
+
+def _route(lines: List[bytes], ks: Sequence[int], n_th: int, cumulative: bool) -> List[bytes]:
+    """
+    依桶號把行分到各輸出（n_th+1 個分桶，cumulative 時再加 n_th-1 個 >= t 檔；>= 最後一個門檻
+    就是最後一個分桶），各輸出內保持原順序。
+    """
+    outs: List[List[bytes]] = [[] for _ in range(n_th + 1 + (n_th - 1 if cumulative else 0))]
+    for s, k in zip(lines, ks):
+        outs[k].append(s)
+        if cumulative:
+            for j in range(min(k, n_th - 1)):  # 第 k 桶的分數 >= t_0..t_{k-1}
+                outs[n_th + 1 + j].append(s)
+    return [b"\n".join(o) + b"\n" if o else b"" for o in outs]
+
+
+def _bucket_block(task) -> Tuple[List[bytes], List[bytes], List[int]]:
+    """
+    worker：把一段 TSV（bytes，或 (path, start, end) 由 worker 自行讀取）依分數分桶。
+    回傳 (各輸出的 id 內容, 各輸出的 zh 內容, 各分桶行數)。
+    """
+    src, cols, thresholds, cumulative = task
+    if isinstance(src, tuple):
+        path, a, b = src
+        with open(path, "rb") as f:
+            f.seek(a)
+            src = f.read(b - a)
+    si, ii, zi = cols
+    need = max(cols)
+    ids, zhs, ks = [], [], []
+    for line in src.split(b"\n"):
+        if not line.replace(b"\t", b""):
+            continue  # 空行 / 全空欄位
+        parts = line.split(b"\t")
+        try:
+            sc = float(parts[si])
+        except (IndexError, ValueError):
+            continue
+        if sc != sc or sc in (float("inf"), float("-inf")):
+            continue
+        if len(parts) <= need:
+            parts += [b""] * (need + 1 - len(parts))
+        ks.append(bisect.bisect_right(thresholds, sc))
+        ids.append(parts[ii])
+        zhs.append(parts[zi])
+    n_th = len(thresholds)
+    counts = np.bincount(np.asarray(ks, dtype=np.int64), minlength=n_th + 1).tolist()
+    return _route(ids, ks, n_th, cumulative), _route(zhs, ks, n_th, cumulative), counts
+
+
+def plain_blocks(path: Path, start: int, block: int):
+    """從 start 起每約 block bytes 切一段，終點對齊到下一個換行之後。"""
+    size = path.stat().st_size
+    with path.open("rb") as f:
+        a = start
+        while a < size:
+            b = min(a + block, size)
+            if b < size:
+                f.seek(b)
+                b += len(f.readline())
+            yield (str(path), a, b)
+            a = b
+
+
+def open_text_stream(path: Path):
+    """.gz 優先用 pigz -dc（解壓與其他執行緒平行），否則退回 gzip 模組。回傳 (stream, proc)。"""
+    if path.suffix != ".gz":
+        return path.open("rb"), None
+    pigz = shutil.which("pigz")
+    if pigz:
+        proc = subprocess.Popen([pigz, "-dc", str(path)], stdout=subprocess.PIPE, bufsize=1 << 20)
+        return proc.stdout, proc
+    return gzip.open(path, "rb"), None
+
+
+def stream_blocks(f, block: int):
+    while True:
+        data = f.read(block)
+        if not data:
+            return
+        if not data.endswith(b"\n"):
+            data += f.readline()
+        yield data
+
+
+class BucketWriter:
+    """開啟所有輸出檔（分桶在前、--cumulative 的 ge 檔在後，不含與最後一桶同名的 ge<tn>）；write() 依輸出順序寫入一段結果。"""
+
+    def __init__(self, out_dir: Path, prefix: str, thresholds: Sequence[float], cumulative: bool):
+        out_dir.mkdir(parents=True, exist_ok=True)
+        self.names = bucket_names(prefix, thresholds)
+        outs = list(self.names)
+        if cumulative:
+            outs += [f"{prefix}_ge{thr_tag(t)}" for t in thresholds[:-1]]
+        self.files = [(open(out_dir / f"{n}.id", "wb"), open(out_dir / f"{n}.zh", "wb")) for n in outs]
+        self.counts = [0] * len(self.names)
+
+    def write_side(self, side: int, blobs: Sequence[bytes]) -> None:
+        for pair, blob in zip(self.files, blobs):
+            if blob:
+                pair[side].write(blob)
+
+    def write(self, res) -> None:
+        id_blobs, zh_blobs, counts = res
+        self.write_side(0, id_blobs)
+        self.write_side(1, zh_blobs)
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+
+    def close(self) -> None:
+        for fi, fz in self.files:
+            fi.close()
+            fz.close()
+
+
+def export_tsv(sim: Path, writer: BucketWriter, thresholds: Sequence[float], workers: int, block: int,
+               cumulative: bool) -> None:
+    f, proc = open_text_stream(sim)
+    try:
+        header = f.readline()
+        cols = parse_header(header)
+        if proc is None and sim.suffix != ".gz":
+            start = len(header)
+            f.close()
+            blocks = plain_blocks(sim, start, block)
+        else:
+            blocks = stream_blocks(f, block)
+        tasks = ((src, cols, tuple(thresholds), cumulative) for src in blocks)
+        if workers > 1:
+            with mp.Pool(workers) as pool:
+                for res in pool.imap(_bucket_block, tasks):  # imap 保持區段順序
+                    writer.write(res)
+        else:
+            for t in tasks:
+                writer.write(_bucket_block(t))
+    finally:
+        if not f.closed:
+            f.close()
+        if proc is not None:
+            proc.wait()
+
+
+def export_store(store: ScoreStore, writer: BucketWriter, thresholds: Sequence[float], cumulative: bool,
+                 lines_per_read: int = 65536) -> None:
+    """分數目錄：向量化算桶號，兩側各循序掃一次原檔（不需 TSV）。"""
+    bucket = np.searchsorted(np.asarray(thresholds, dtype=np.float64), tsv_rounded(store.scores), side="right")
+    writer.counts = np.bincount(bucket, minlength=len(thresholds) + 1).tolist()
+    n = store.n
+    for j, side in enumerate(("id", "zh")):
+        offs = store.offsets[side]
+        with store.source(side).open("rb") as f:
+            f.seek(int(offs[0]))
+            for a in range(0, n, lines_per_read):
+                b = min(a + lines_per_read, n)
+                # 先解碼再 strip：與 str.strip() 相同也去掉全形空白等 Unicode 空白（similarity.tsv 的內容）
+                lines = [s.decode("utf-8").strip() for s in f.read(int(offs[b] - offs[a])).split(b"\n")[:b - a]]
+                if store.remove_tags:
+                    lines = [CLEAN_TAG_RE.sub("", s).strip() for s in lines]
+                lines = [s.encode("utf-8") for s in lines]
+                writer.write_side(j, _route(lines, bucket[a:b].tolist(), len(thresholds), cumulative))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Single-pass multi-threshold export of LASER-scored pairs")
+    ap.add_argument("--sim", required=True, help="similarity.tsv[.gz], or a scores.npy store dir")
+    ap.add_argument("--thresholds", default="0.6,0.7,0.8,0.9", help="Comma-separated cut-offs (score >= t passes)")
+    ap.add_argument("--out_dir", required=True)
+    ap.add_argument("--prefix", default="filtered")
+    ap.add_argument("--cumulative", action="store_true", help="Also write <prefix>_ge<t>.{id,zh} for every threshold (the top bucket is already ge<last>)")
+    ap.add_argument("--workers", type=int, default=0, help="Worker processes for TSV parsing (0 = cpu_count)")
+    ap.add_argument("--block_mb", type=float, default=32.0, help="Bytes per work unit in MiB")
+    ap.add_argument("--from_tsv", action="store_true", help="Parse the TSV even if a scores.npy store sits next to it")
+    args = ap.parse_args()
+
+    thresholds = sorted({float(x) for x in args.thresholds.split(",") if x.strip()})
+    if not thresholds:
+        ap.error("--thresholds is empty")
+    sim = Path(args.sim)
+    store_path = sim if sim.is_dir() or sim.suffix == ".npy" else sim.parent
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+
+    store = None
+    if not args.from_tsv and is_store(store_path):
+        try:
+            store = ScoreStore(store_path)
+        except RuntimeError as e:
+            print(f"[ERROR] {e}")
+            sys.exit(2)
+        print(f"[INFO] scores.npy store: {store.dir} (n={store.n})")
+    elif not sim.is_file():
+        print(f"[ERROR] not found: {sim}")
+        sys.exit(1)
+    else:
+        print(f"[INFO] TSV: {sim} (workers={workers}, block={args.block_mb} MiB)")
+
+    writer = BucketWriter(Path(args.out_dir), args.prefix, thresholds, args.cumulative)
+    t0 = time.time()
+    try:
+        if store is not None:
+            export_store(store, writer, thresholds, args.cumulative)
+        else:
+            export_tsv(sim, writer, thresholds, workers, int(args.block_mb * (1 << 20)), args.cumulative)
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(2)
+    finally:
+        writer.close()
+
+    total = sum(writer.counts)
+    print(f"[DONE] {total} pairs in {time.time() - t0:.1f}s → {args.out_dir}")
+    for name, c in zip(writer.names, writer.counts):
+        print(f"  {name:<28} {c:>10}  ({c / max(total, 1):.2%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,17 +3,23 @@
 """
 讀取 LASER 輸出的 similarity.tsv，將 cosine 分數 > threshold 的句對
 輸出成兩個檔案（.id / .zh）。
+同目錄有 scores.npy + scores_index.json（scores_store.py）時改用 mmap 向量化篩選，
+句子依 offset 從原始 raw.* 讀取，不解析 TSV；--from_tsv 可強制走舊路徑。
 """
 
+import sys
 import argparse
 from pathlib import Path
 
+from scores_store import ScoreStore, export, is_store
+
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--sim", required=True, help="Path to similarity.tsv")
+    ap.add_argument("--sim", required=True, help="Path to similarity.tsv, or a scores.npy store dir")
     ap.add_argument("--threshold", type=float, default=0.6, help="Keep pairs with cosine > threshold (default 0.6)")
     ap.add_argument("--out_id", required=True, help="Output file path for filtered.id")
     ap.add_argument("--out_zh", required=True, help="Output file path for filtered.zh")
+    ap.add_argument("--from_tsv", action="store_true", help="Parse similarity.tsv even if a scores.npy store exists")
     args = ap.parse_args()
 
     sim_path = Path(args.sim)
@@ -22,6 +28,19 @@ def main():
     out_id.parent.mkdir(parents=True, exist_ok=True)
     out_zh.parent.mkdir(parents=True, exist_ok=True)
 
+    store_path = sim_path if sim_path.is_dir() or sim_path.suffix == ".npy" else sim_path.parent
+    if not args.from_tsv and is_store(store_path):
+        try:
+            store = ScoreStore(store_path)
+        except RuntimeError as e:
+            print(f"[ERROR] {e}")
+            sys.exit(2)
+        kept = export(store, args.threshold, out_id, out_zh, op=">")
+        print(f"[DONE] total={store.n}, kept(score>{args.threshold})={kept}  (scores.npy store)")
+        print(f"[OUT] {out_id}")
+        print(f"[OUT] {out_zh}")
+        return
+
     kept = 0
     total = 0
 
@@ -1,23 +1,245 @@
-import hanlp
+"""
+hanlp_segment.py
+- HanLP 中文斷詞：只跑多任務模型的 tok/fine（不跑 POS/NER/SRL/DEP/SDP/CON），
+  每次送 --batch_size 行進模型
+- 空白行不送進模型、原樣輸出空行，輸出行數與輸入一致
+- --workers N：依 byte offset（對齊行首）把輸入切成 N 段，N 個行程各載入一次模型
+  （限制每個行程的執行緒數），各段輸出再依序串接；每段回報進度與 lines/s
+- -if / -of 給 '-' 時讀 stdin、寫 stdout（進度與統計改印到 stderr），可接在 pipe 中間（preprocess_stream.py）
+- --cache_dir：持久化斷詞快取（seg_cache.py，key = 模型名稱 + 行 hash，LRU 容量上限，跨語料共用），
+  同一塊內重複的行只斷一次，只有快取 miss 才送進 HanLP；結束時印出命中統計
+"""
+
+import os
+import sys
+import time
+import shutil
 import argparse
+import multiprocessing as mp
+from typing import List, Tuple
+
+import hanlp
+
+from seg_cache import SegStats, line_key, open_cache
+
+DEFAULT_MODEL = 'CLOSE_TOK_POS_NER_SRL_DEP_SDP_CON_ELECTRA_SMALL_ZH'
+TOK_TASK = 'tok/fine'
+
+_PIPE = None
+
+
+def load_pipe(model: str = DEFAULT_MODEL):
+    """延遲載入 HanLP 多任務模型（import 本檔不會載入）；同一行程只載入一次。"""
+    global _PIPE
+    if _PIPE is None:
+        _PIPE = hanlp.load(getattr(hanlp.pretrained.mtl, model))
+    return _PIPE
+
+
+def segment_lines(lines: List[str], batch_size: int = 256, model: str = DEFAULT_MODEL,
+                  cache=None, stats: SegStats = None) -> List[str]:
+    """
+    把 lines（不含換行）斷詞成以空白分隔的字串；空白行回傳空字串。
+    相同的行只斷一次；有 cache 時先查快取，全部命中就不必載入模型。
+    """
+    out = [''] * len(lines)
+    groups = {}
+    for i, s in enumerate(lines):
+        if s.strip():
+            groups.setdefault(s, []).append(i)
+    uniq = list(groups)
+    done = {}
+    if cache is not None and uniq:
+        keys = [line_key(model, s) for s in uniq]
+        hit = cache.get_many(keys)
+        for s, k in zip(uniq, keys):
+            if k in hit:
+                done[s] = hit[k]
+    todo = [s for s in uniq if s not in done]
+    for b in range(0, len(todo), batch_size):
+        batch = todo[b:b + batch_size]
+        # 只跑斷詞任務
+        toks = load_pipe(model)(batch, tasks=TOK_TASK)[TOK_TASK]
+        segs = [' '.join(t) for t in toks]
+        done.update(zip(batch, segs))
+        if cache is not None:
+            cache.put_many((line_key(model, s), v) for s, v in zip(batch, segs))
+    for s, idx in groups.items():
+        for i in idx:
+            out[i] = done[s]
+    if stats is not None:
+        stats.lines += len(lines)
+        stats.blank += len(lines) - sum(len(v) for v in groups.values())
+        stats.unique += len(uniq)
+        stats.hits += len(uniq) - len(todo)
+        stats.segmented += len(todo)
+    return out
+
+
+def _segment_stream(lines, o, batch_size: int, block: int, model: str, cache=None,
+                    stats: SegStats = None, tag: str = '') -> int:
+    """lines 為逐行 iterator（不含換行）；每 block 行斷詞寫出一次，tag 非空時印進度。"""
+    n = 0
+    t0 = time.time()
+    buf = []
+    for line in lines:
+        buf.append(line)
+        if len(buf) >= block:
+            o.write(''.join(s + '\n' for s in segment_lines(buf, batch_size, model, cache, stats)))
+            n += len(buf)
+            buf = []
+            if tag:
+                dt = time.time() - t0
+                print(f'[HanLP]{tag} {n} lines, {n / dt if dt > 0 else 0:.1f} lines/s', flush=True)
+    if buf:
+        o.write(''.join(s + '\n' for s in segment_lines(buf, batch_size, model, cache, stats)))
+        n += len(buf)
+    return n
+
+
+def shard_ranges(fname: str, n: int) -> List[Tuple[int, int]]:
+    """把檔案切成至多 n 段 [a, b)，每個切點移到下一行行首（不切斷任何一行）。"""
+    size = os.path.getsize(fname)
+    cuts = [0]
+    with open(fname, 'rb') as f:
+        for k in range(1, n):
+            pos = size * k // n
+            if pos <= cuts[-1]:
+                continue
+            f.seek(pos - 1)
+            pos += len(f.readline()) - 1  # pos-1 若恰為換行，readline 只讀到它本身
+            if cuts[-1] < pos < size:
+                cuts.append(pos)
+    cuts.append(size)
+    return [(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+
+def _chomp(line: str) -> str:
+    # 只以 \n 分行（與 shard_ranges 的切點一致，單獨的 \r 不算換行），\r\n 視為一個換行
+    return line[:-2] if line.endswith('\r\n') else line.rstrip('\n')
+
+
+def _iter_range(fname: str, a: int, b: int):
+    with open(fname, 'rb') as f:
+        f.seek(a)
+        pos = a
+        while pos < b:
+            raw = f.readline()
+            if not raw:
+                break
+            pos += len(raw)
+            yield _chomp(raw.decode('utf-8'))
+
+
+def _shard_init(threads: int) -> None:
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+
+
+def _segment_shard(task) -> Tuple[int, int, float, tuple]:
+    k, fname, a, b, part, batch_size, model, block, cache_dir, cache_max_gb = task
+    t0 = time.time()
+    cache = open_cache(cache_dir, cache_max_gb)
+    stats = SegStats()
+    if cache is None:
+        load_pipe(model)  # 有快取時等到第一個 miss 才載入
+    t_load = time.time() - t0
+    with open(part, 'w', encoding='utf-8') as o:
+        n = _segment_stream(_iter_range(fname, a, b), o, batch_size, block, model, cache, stats, f'[shard {k}]')
+    if cache is not None:
+        cache.close(evict=False)  # LRU 淘汰留給主行程做一次
+    dt = time.time() - t0
+    print(f'[HanLP][shard {k}] done: {n} lines in {dt:.1f}s (model load {t_load:.1f}s, '
+          f'{n / max(dt - t_load, 1e-9):.1f} lines/s)', flush=True)
+    return k, n, dt, stats.as_tuple()
+
+
+def parse_sharded(fname: str, dest_fname: str, workers: int, batch_size: int = 256,
+                  model: str = DEFAULT_MODEL, threads: int = 0, read_lines: int = 0,
+                  cache_dir: str = '', cache_max_gb: float = 2.0):
+    """--workers：N 段平行斷詞，輸出依段落順序串接成 dest_fname（行序與輸入相同）。"""
+    ranges = shard_ranges(fname, workers)
+    if not ranges:  # 空檔案：沒有可切的段落，直接走單行程
+        return parse(fname, dest_fname, batch_size, model, read_lines, cache_dir, cache_max_gb)
+    threads = threads or max(1, (os.cpu_count() or 1) // len(ranges))
+    # 子行程在 import torch 前就要看到執行緒上限
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(threads)
+    block = read_lines or batch_size * 16
+    parts = [f'{dest_fname}.part{k:03d}' for k in range(len(ranges))]
+    tasks = [(k, fname, a, b, parts[k], batch_size, model, block, cache_dir, cache_max_gb)
+             for k, (a, b) in enumerate(ranges)]
+    print(f'[HanLP] {len(ranges)} shards x {threads} threads')
+    t0 = time.time()
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(len(ranges), initializer=_shard_init, initargs=(threads,)) as pool:
+        done = pool.map(_segment_shard, tasks)
+    with open(dest_fname, 'wb') as o:
+        for p in parts:
+            with open(p, 'rb') as f:
+                shutil.copyfileobj(f, o, 1 << 20)
+            os.remove(p)
+    n = sum(d[1] for d in done)
+    dt = time.time() - t0
+    print(f'[HanLP] {n} lines in {dt:.1f}s ({n / dt if dt > 0 else 0:.1f} lines/s, {len(ranges)} shards) -> {dest_fname}')
+    if cache_dir:
+        stats = SegStats()
+        for d in done:
+            stats.add(d[3])
+        print(stats.report())
+        open_cache(cache_dir, cache_max_gb).close()
+
+
+def _open_text(fname: str, mode: str):
+    """'-' 為 stdin / stdout（不關閉）。newline='\n'：只以 \n 分行，與 --workers 的位元組切段相同。"""
+    if fname == '-':
+        fd = (sys.stdin if 'r' in mode else sys.stdout).fileno()
+        return open(fd, mode, encoding='utf-8', newline='\n', closefd=False)
+    return open(fname, mode, encoding='utf-8', newline='\n')
+
 
-# 加載 HanLP 的多任務模型
-pipe = hanlp.load(hanlp.pretrained.mtl.CLOSE_TOK_POS_NER_SRL_DEP_SDP_CON_ELECTRA_SMALL_ZH)
+def parse(fname: str = 'norm.zh', dest_fname: str = 'norm.seg.zh', batch_size: int = 256,
+          model: str = DEFAULT_MODEL, read_lines: int = 0, cache_dir: str = '', cache_max_gb: float = 2.0):
+    """
+    逐塊讀入（每塊 read_lines 行，預設 batch_size × 16）、批次斷詞後寫出。
+    """
+    block = read_lines or batch_size * 16
+    cache = open_cache(cache_dir, cache_max_gb)
+    stats = SegStats()
+    log = sys.stderr if dest_fname == '-' else sys.stdout
+    t0 = time.time()
+    with _open_text(fname, 'r') as f, _open_text(dest_fname, 'w') as o:
+        n = _segment_stream((_chomp(line) for line in f), o, batch_size, block, model, cache, stats)
+    dt = time.time() - t0
+    print(f'[HanLP] {n} lines in {dt:.1f}s ({n / dt if dt > 0 else 0:.1f} lines/s) -> {dest_fname}', file=log)
+    if cache is not None:
+        print(stats.report(), file=log)
+        cache.close(log=log)
 
-def parse(fname: str = 'norm.zh', dest_fname: str = 'norm.seg.zh'):
-    with open(fname, 'r', encoding='utf-8') as f, open(dest_fname, 'w', encoding='utf-8') as o:
-        for line in f:
-            # 使用 HanLP 進行分詞
-            seg = pipe(line)
-            # 將分詞結果寫入輸出文件
-            o.write(' '.join(seg['tok/fine']) + '\n')
 
 if __name__ == '__main__':
     # 設置命令行參數
     parser = argparse.ArgumentParser()
     parser.add_argument('-if', '--inputfile', required=True, help="Input file path")
     parser.add_argument('-of', '--outputfile', required=True, help="Output file path")
+    parser.add_argument('-bs', '--batch_size', type=int, default=256, help="Lines per HanLP call")
+    parser.add_argument('--model', default=DEFAULT_MODEL, help="Name under hanlp.pretrained.mtl (tok/fine task only)")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="Segmenter processes over byte-offset shards")
+    parser.add_argument('--threads', type=int, default=0, help="Torch threads per worker (0 = cpu_count // workers)")
+    parser.add_argument('--cache_dir', default='', help="Persistent segmentation cache dir shared across corpora/runs")
+    parser.add_argument('--cache_max_gb', type=float, default=2.0, help="LRU size bound of --cache_dir in GiB")
     args = parser.parse_args()
 
     # 調用 parse 函數進行文件處理
-    parse(args.inputfile, args.outputfile)
+    if args.workers > 1 and '-' in (args.inputfile, args.outputfile):
+        parser.error("--workers > 1 needs seekable files, not '-'")
+    if args.workers > 1:
+        parse_sharded(args.inputfile, args.outputfile, args.workers, args.batch_size, args.model, args.threads,
+                      cache_dir=args.cache_dir, cache_max_gb=args.cache_max_gb)
+    else:
+        parse(args.inputfile, args.outputfile, args.batch_size, args.model,
+              cache_dir=args.cache_dir, cache_max_gb=args.cache_max_gb)
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+laser_driver.py
+- run_laser.sh 分片流程的 Python 版：不 head / split 複製語料，不每片重開 python 行程
+- 對 raw.id / raw.zh 各建一次 byte-offset 行索引（快取於 OUT_DIR/index/），分片直接依 offset 讀取
+- 模型（或 --workers encoder 行程）在整個執行期間常駐，各分片共用
+- 三段管線：讀取執行緒預讀 chunk k+1、主執行緒編碼 chunk k、寫出執行緒寫 chunk k-1 的
+  分數 / TSV / 嵌入，佇列長度 1，記憶體上限約三個分片
+- 輸出目錄結構與 run_laser.sh 相同（chunk_XX/、merged/），.done 標記的 hash 算法也相同，
+  兩者可互相接續；merged/*.tsv 於每片完成時依序追加，merged/scores_summary.json 由各片
+  ScoreSketch 累加，每片完成即更新（執行中也能看到全語料目前的統計）
+- 分數目錄（scores.npy + offsets，見 scores_store.py）的 offsets 直接指向原始 raw.id / raw.zh，
+  merged/ 為全語料的分數目錄
+
+用法：
+  python laser_driver.py --id raw.id --zh raw.zh --out_dir laser_out --chunk_size 1000000 [laser_run.py 的編碼選項...]
+
+需求套件：laser-encoders, numpy, tqdm
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import hashlib
+import argparse
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+from laser_run import (
+    add_encode_args, cosine_diag, encode_sentences, open_cache, open_pool, report_quant_deviation,
+    save_emb, write_json_atomic, write_nn,
+)
+from scores_store import (
+    CLEAN_TAG_RE, SCORES_NAME, SKETCH_NAME, ScoreSketch, line_offsets, write_store, write_summary,
+)
+
+_DONE = object()  # 佇列結束標記
+
+
+def load_line_index(fp: Path, index_dir: Path) -> np.ndarray:
+    """取得 fp 的行 offset；以 (大小, mtime) 判斷 index_dir 內的快取是否仍有效。"""
+    st = fp.stat()
+    sig = {"path": str(fp.resolve()), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    npy = index_dir / f"{fp.name}.offsets.npy"
+    meta = index_dir / f"{fp.name}.offsets.json"
+    if npy.exists() and meta.exists():
+        try:
+            if json.loads(meta.read_text(encoding="utf-8")) == sig:
+                return np.load(npy)
+        except (OSError, ValueError):
+            pass
+    t0 = time.time()
+    offs = line_offsets(fp)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    np.save(npy, offs)
+    write_json_atomic(meta, sig)
+    print(f"[INDEX] {fp.name}: {len(offs) - 1} lines indexed in {time.time() - t0:.1f}s")
+    return offs
+
+
+def read_range(f, offs: np.ndarray, a: int, b: int) -> bytes:
+    f.seek(int(offs[a]))
+    return f.read(int(offs[b] - offs[a]))
+
+
+def split_lines(data: bytes, remove_tags: bool) -> List[str]:
+    """與 laser_run.read_lines + maybe_clean 相同的逐行結果（兩者都只以 \\n 分行，對得上 line_offsets）。"""
+    lines = data.decode("utf-8").split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    if remove_tags:
+        return [CLEAN_TAG_RE.sub("", s.strip()).strip() for s in lines]
+    return [s.strip() for s in lines]
+
+
+def chunk_hash(id_bytes: bytes, zh_bytes: bytes, args) -> str:
+    """
+    與 run_laser.sh 的 CHUNK_HASH 相同：md5(id 分片 + zh 分片 + 參數行)。
+    參數行涵蓋所有會改變分片輸出的選項（檔案格式、正規化、是否保留嵌入檔等）；
+    batch / 分桶 / 快取 / worker 數只影響速度，不列入。
+    """
+    params = "|".join([args.id_lang, args.zh_lang, str(int(args.remove_tags)), str(int(args.write_nn)),
+                       str(args.nn_k), args.thresholds, args.emb_dtype, "0", args.sim_format,
+                       str(int(args.no_norm)), str(int(args.keep_emb))])
+    h = hashlib.md5()
+    h.update(id_bytes)
+    h.update(zh_bytes)
+    h.update((params + "\n").encode("utf-8"))
+    return h.hexdigest()
+
+
+def read_done(chunk_dir: Path) -> str:
+    try:
+        return (chunk_dir / ".done").read_text(encoding="utf-8").strip()
+    except OSError:
+        return ""
+
+
+def write_done(chunk_dir: Path, digest: str) -> None:
+    tmp = chunk_dir / ".done.tmp"
+    tmp.write_text(digest + "\n", encoding="utf-8")
+    os.replace(tmp, chunk_dir / ".done")
+
+
+class _Stage(threading.Thread):
+    """背景執行緒；例外保留到 join 時在主執行緒重新拋出。"""
+
+    def __init__(self, target, name: str):
+        super().__init__(name=name, daemon=True)
+        self._target_fn = target
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        try:
+            self._target_fn()
+        except BaseException as e:  # noqa: BLE001 - 交給主執行緒處理
+            self.error = e
+
+    def check(self) -> None:
+        if self.error is not None:
+            raise self.error
+
+
+def _get(q: "queue.Queue", stages):
+    """阻塞取值，但每秒檢查背景執行緒是否已失敗，避免死等。"""
+    while True:
+        try:
+            return q.get(timeout=1.0)
+        except queue.Empty:
+            for st in stages:
+                st.check()
+
+
+def _put(q: "queue.Queue", item, stages) -> None:
+    while True:
+        try:
+            return q.put(item, timeout=1.0)
+        except queue.Full:
+            for st in stages:
+                st.check()
+
+
+class MergedWriter:
+    """chunk 完成時依序把 chunk_XX/*.tsv|*.csv 追加到 merged/（同表頭只保留第一份）。"""
+
+    def __init__(self, merged_dir: Path):
+        self.dir = merged_dir
+        self.dir.mkdir(parents=True, exist_ok=True)
+        for p in list(self.dir.glob("*.tsv")) + list(self.dir.glob("*.csv")):
+            p.unlink()
+        self.headers = {}
+
+    def append_chunk(self, chunk_dir: Path) -> None:
+        for src in sorted(list(chunk_dir.glob("*.tsv")) + list(chunk_dir.glob("*.csv"))):
+            dst = self.dir / src.name
+            with src.open("rb") as fi, dst.open("ab") as fo:
+                head = fi.readline()
+                ref = self.headers.setdefault(src.name, head)
+                if not (ref == head and fo.tell() > 0):
+                    fo.write(head)
+                shutil.copyfileobj(fi, fo, 1 << 20)
+
+
+def read_chunk_scores(chunk_dir: Path) -> np.ndarray:
+    """略過的分片取回分數供全域統計使用（優先讀 scores.npy，舊輸出才解析 similarity.tsv）。"""
+    if (chunk_dir / SCORES_NAME).is_file():
+        return np.load(chunk_dir / SCORES_NAME)
+    with (chunk_dir / "similarity.tsv").open("r", encoding="utf-8", newline="\n") as f:
+        next(f, None)
+        return np.array([float(ln.split("\t", 2)[1]) for ln in f], dtype=np.float32)
+
+
+def write_chunk(chunk_dir: Path, id_lines, zh_lines, id_vecs, zh_vecs, args, normalize: bool,
+                thresholds, id_offs: np.ndarray, zh_offs: np.ndarray):
+    """
+    單一分片的輸出，內容與 laser_run.py 對同一分片的輸出相同；
+    分數目錄的 offsets 為原始 raw.* 中的區段（id_offs / zh_offs，長度 = 行數 + 1）。
+    回傳 (逐行分數, 本片 ScoreSketch)。
+    """
+    diag_scores = cosine_diag(id_vecs, zh_vecs, assume_normalized=normalize)
+    if args.keep_emb:
+        save_emb(chunk_dir / "raw.id.emb.npy", id_vecs, args.emb_dtype)
+        save_emb(chunk_dir / "raw.zh.emb.npy", zh_vecs, args.emb_dtype)
+        if args.emb_dtype != "float32":
+            report_quant_deviation(chunk_dir, diag_scores, normalize)
+    if args.sim_format in ("both", "npy"):
+        write_store(chunk_dir, diag_scores, Path(args.id), Path(args.zh), args.remove_tags, id_offs, zh_offs)
+    if args.sim_format in ("both", "tsv"):
+        with (chunk_dir / "similarity.tsv").open("w", encoding="utf-8") as f:
+            f.write("idx\tcosine\tid_sentence\tzh_sentence\n")
+            for i, (c, si, sz) in enumerate(zip(diag_scores, id_lines, zh_lines)):
+                f.write(f"{i}\t{c:.6f}\t{si}\t{sz}\n")
+    sketch = ScoreSketch(thresholds).update(diag_scores)
+    write_summary(chunk_dir, sketch)
+    if args.write_nn:
+        write_nn(chunk_dir, id_vecs, zh_vecs, id_lines, zh_lines, normalize, args.nn_chunk, args.nn_k)
+    return diag_scores, sketch
+
+
+def run(args) -> None:
+    id_path = Path(args.id)
+    zh_path = Path(args.zh)
+    out_dir = Path(args.out_dir)
+    if args.overwrite and out_dir.exists():
+        shutil.rmtree(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    id_offs = load_line_index(id_path, out_dir / "index")
+    zh_offs = load_line_index(zh_path, out_dir / "index")
+    n_id, n_zh = len(id_offs) - 1, len(zh_offs) - 1
+    if args.max_lines and args.max_lines > 0:
+        n_id, n_zh = min(n_id, args.max_lines), min(n_zh, args.max_lines)
+    if n_id != n_zh:
+        print(f"[ERROR] 行數不一致：id={n_id}, zh={n_zh}")
+        sys.exit(1)
+    n = n_id
+    if n == 0:
+        print("[ERROR] No lines to process. Check your input files.")
+        sys.exit(2)
+
+    chunk_size = args.chunk_size
+    num_chunks = (n + chunk_size - 1) // chunk_size
+    width = max(2, len(str(num_chunks)))
+    normalize = (not args.no_norm)
+    thresholds = tuple(float(x) for x in args.thresholds.split(",") if x.strip())
+    print(f"[INFO] 總行數：{n}，每片 {chunk_size} 行，共 {num_chunks} 片")
+
+    read_q: "queue.Queue" = queue.Queue(maxsize=1)
+    write_q: "queue.Queue" = queue.Queue(maxsize=1)
+    merged = None if args.eta_only else MergedWriter(out_dir / "merged")
+    all_scores: List[np.ndarray] = []
+    total = ScoreSketch(thresholds)
+
+    def reader() -> None:
+        with id_path.open("rb") as fi, zh_path.open("rb") as fz:
+            for k in range(num_chunks):
+                a, b = k * chunk_size, min((k + 1) * chunk_size, n)
+                id_bytes = read_range(fi, id_offs, a, b)
+                zh_bytes = read_range(fz, zh_offs, a, b)
+                chunk_dir = out_dir / f"chunk_{k:0{width}d}"
+                digest = chunk_hash(id_bytes, zh_bytes, args)
+                if not args.eta_only and read_done(chunk_dir) == digest:
+                    read_q.put((k, chunk_dir, digest, None, None))
+                    continue
+                read_q.put((k, chunk_dir, digest,
+                            split_lines(id_bytes, args.remove_tags), split_lines(zh_bytes, args.remove_tags)))
+        read_q.put(_DONE)
+
+    def writer() -> None:
+        while True:
+            item = write_q.get()
+            if item is _DONE:
+                return
+            k, chunk_dir, digest, id_lines, zh_lines, id_vecs, zh_vecs = item
+            if id_lines is None:
+                scores = read_chunk_scores(chunk_dir)
+                if (chunk_dir / SKETCH_NAME).is_file():
+                    sketch = ScoreSketch.load(chunk_dir / SKETCH_NAME)
+                else:
+                    sketch = ScoreSketch(thresholds).update(scores)
+            else:
+                a, b = k * chunk_size, k * chunk_size + len(id_lines)
+                scores, sketch = write_chunk(chunk_dir, id_lines, zh_lines, id_vecs, zh_vecs, args, normalize, thresholds,
+                                     id_offs[a:b + 1], zh_offs[a:b + 1])
+                write_done(chunk_dir, digest)
+            merged.append_chunk(chunk_dir)
+            all_scores.append(scores)
+            total.merge(sketch)
+            write_summary(merged.dir, total)
+            print(f"[INFO] chunk_{k:0{width}d} 已寫出並併入 merged/")
+
+    stages = [_Stage(reader, "laser-reader")]
+    if not args.eta_only:
+        stages.append(_Stage(writer, "laser-writer"))
+    for st in stages:
+        st.start()
+
+    pool = open_pool(args)
+    cache = open_cache(args.cache_dir, args.cache_max_gb)
+    t_start = time.time()
+    enc_sec = 0.0
+    encoded = 0
+    try:
+        while True:
+            item = _get(read_q, stages)
+            if item is _DONE:
+                break
+            k, chunk_dir, digest, id_lines, zh_lines = item
+            tag = f"chunk_{k:0{width}d}"
+            if id_lines is None:
+                print(f"[INFO] === {tag} ({k + 1}/{num_chunks}) 已完成（hash 相符），略過 ===")
+                _put(write_q, (k, chunk_dir, digest, None, None, None, None), stages)
+                continue
+            if chunk_dir.exists() and not args.eta_only:
+                if (chunk_dir / ".done").exists():
+                    print(f"[INFO] {tag} 的輸入或參數已變更，清除舊輸出重做")
+                shutil.rmtree(chunk_dir)
+            print(f"[INFO] === 處理 {tag} ({k + 1}/{num_chunks}), lines={len(id_lines)} ===")
+            t0 = time.time()
+            id_vecs = encode_sentences(id_lines, args.id_lang, args.batch_size, normalize, args.device,
+                                       args.token_budget, args.length_mode, args.dedup, cache, pool)
+            zh_vecs = encode_sentences(zh_lines, args.zh_lang, args.batch_size, normalize, args.device,
+                                       args.token_budget, args.length_mode, args.dedup, cache, pool)
+            dt = time.time() - t0
+            enc_sec += dt
+            encoded += len(id_lines)
+            print(f"[BENCH] {tag}: encoded {len(id_lines)} pairs in {dt:.2f}s  ->  "
+                  f"{len(id_lines) / dt if dt > 0 else float('inf'):.2f} pairs/sec")
+            if args.eta_only:
+                rate = encoded / enc_sec if enc_sec > 0 else 0.0
+                if rate > 0:
+                    print(f"[ETA] Projected time for all {n} pairs: ~{n / rate:.1f}s")
+                else:
+                    print("[ETA] Rate is 0? Check device/batch size.")
+                return
+            chunk_dir.mkdir(parents=True, exist_ok=True)
+            _put(write_q, (k, chunk_dir, digest, id_lines, zh_lines, id_vecs, zh_vecs), stages)
+        if not args.eta_only:
+            _put(write_q, _DONE, stages)
+        for st in stages:
+            st.join()
+            st.check()
+    finally:
+        if cache is not None:
+            cache.close()
+        if pool is not None:
+            pool.close()
+
+    if args.eta_only:
+        return
+    merged_scores = np.concatenate(all_scores)
+    if args.sim_format in ("both", "npy"):
+        write_store(out_dir / "merged", merged_scores, id_path, zh_path, args.remove_tags,
+                    id_offs[:n + 1], zh_offs[:n + 1])
+    summary = total.summary()
+
+    wall = time.time() - t_start
+    print(f"[BENCH] Encoded {encoded} pairs in {enc_sec:.1f}s (wall {wall:.1f}s incl. overlapped read/write)")
+    print(f"[DONE] chunk 個別輸出：{out_dir}/chunk_XX/，合併輸出：{out_dir / 'merged'}/")
+    print(f"[INFO] Summary: {summary}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Split-free, pipelined LASER2 chunk driver for raw.id/raw.zh")
+    ap.add_argument("--id", required=True, help="Path to raw.id")
+    ap.add_argument("--zh", required=True, help="Path to raw.zh")
+    ap.add_argument("--out_dir", default="laser_out", help="Output directory (chunk_XX/, merged/, index/)")
+    ap.add_argument("--chunk_size", type=int, default=1000000, help="Lines per chunk")
+    ap.add_argument("--keep_emb", action="store_true", help="Keep chunk_XX/*.emb.npy (default: never written)")
+    ap.add_argument("--overwrite", action="store_true", help="Remove --out_dir before running")
+    add_encode_args(ap)
+    args = ap.parse_args()
+    if args.chunk_size <= 0:
+        ap.error("--chunk_size must be > 0")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
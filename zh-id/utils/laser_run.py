@@ -5,20 +5,38 @@ laser_run.py
 - 用 LASER2 (laser_encoders) 對 raw.id / raw.zh 批量編碼
 - 產出：
   - raw.id.emb.npy / raw.zh.emb.npy
-  - similarity.tsv   : 逐行 cosine 分數
+  - scores.npy + raw.*.offsets.npy + scores_index.json : 逐行 cosine 分數（float32）與原檔行 offset
+    （scores_store.py：mmap 門檻篩選 / sweep）
+  - similarity.tsv   : 逐行 cosine 分數 + 兩側句子（可選檢視，--sim_format tsv|npy|both）
   - scores_summary.json : 統計 (mean/median/p90/max/min, >=threshold 計數)
-  - nn_top1.tsv (可選 --write_nn): 最近鄰對齊（大資料會吃記憶體，謹慎使用）
+  - scores_sketch.npz : 可合併的分數摘要（固定 bin 直方圖 + 精確門檻計數），分片結果以 O(chunks) 合併
+  - nn_top1.tsv / nn_topk.tsv (可選 --write_nn): 分塊 top-k 最近鄰 + ratio margin / 互為最佳標記，
+    記憶體 O(N·k)，不產生 N×N 矩陣
+- --stream：兩側同步逐行惰性讀取、逐批編碼，直接寫入預先配置的 np.memmap (.npy)，
+  每批編碼完就算分數並更新摘要；峰值記憶體與輸入大小無關，大語料不必先在 shell 端切片
+- --token_budget：依句長（字元或 SentencePiece）排序分桶，每批 padding 後 token 數不超過預算，
+  編碼後依原始索引寫回，similarity.tsv 的 idx 不變；--bench_bucketing 比較有無分桶的速度
+- --workers N：N 個常駐 CPU encoder 行程（各自只載入一次模型、限制 intra-op 執行緒），
+  batch 分散給各行程後依序重組
+- --dedup / --cache_dir：相同句子只編碼一次；另可查詢持久化向量快取（emb_cache.py，
+  key=(編碼器版本 + 模型檔, lang code, 正規化句子 hash)，LRU 容量上限），只有 miss 才送進 LaserEncoderPipeline
+- --emb_dtype float16/int8：嵌入以緊湊格式存檔（int8 逐向量縮放，scale 存 *.emb.scale.npy），
+  逐行分數與 NN 直接分塊讀緊湊格式計算，並回報與 float32 的分數偏差
+- --store_id / --store_zh (+ --store_*_base)：輸入是原檔切出的一段時，分數目錄的 offsets 直接指向原檔
+- --stream --resume：定期 flush memmap 並寫 *.progress.json，中斷後重跑會從上次進度接續
+  （只有 --stream 有片內 checkpoint；非串流模式整份在記憶體編碼，中斷後該次呼叫重新開始，
+  續跑粒度是 run_laser.sh / laser_driver.py 的分片 .done 標記）
 
 需求套件：laser-encoders, numpy, tqdm
 （本檔自帶 cosine 計算，不依賴 scikit-learn）
 """
 
-import re
 import sys
 import json
+import itertools
 import argparse
 from pathlib import Path
-from typing import List, Iterable, Tuple
+from typing import Callable, List, Iterable, Iterator, Optional, Tuple
 
 import numpy as np
 from tqdm import tqdm
@@ -29,14 +47,39 @@ DEVICE_HARD = "cuda"
 # LASER2 pipeline
 from laser_encoders import LaserEncoderPipeline
 
-CLEAN_TAG_RE = re.compile(r"<[^>\n]{1,64}>")  # 移除 <NER> / <POS> 之類標記
+from emb_cache import CacheStats, open_cache, sentence_key
+from scores_store import CLEAN_TAG_RE, ScoreSketch, line_offsets, write_store, write_summary
 
 
 def read_lines(fp: Path) -> List[str]:
-    with fp.open("r", encoding="utf-8") as f:
+    # newline="\n"：只以 \n 分行（不把單獨的 \r 當換行），與 count_lines / line_offsets / LineReader 的行號一致
+    with fp.open("r", encoding="utf-8", newline="\n") as f:
         return [ln.strip() for ln in f]
 
 
+def iter_lines(fp: Path, remove_tags: bool = False, limit: int = 0) -> Iterator[str]:
+    """惰性逐行讀取（與 read_lines + maybe_clean 結果一致），limit>0 時只讀前 N 行。"""
+    with fp.open("r", encoding="utf-8", newline="\n") as f:
+        for i, ln in enumerate(f):
+            if limit and i >= limit:
+                break
+            s = ln.strip()
+            if remove_tags:
+                s = CLEAN_TAG_RE.sub("", s).strip()
+            yield s
+
+
+def count_lines(fp: Path) -> int:
+    """以二進位區塊計數行數（最後一行無換行也算一行），不把檔案讀進記憶體。"""
+    n = 0
+    last = b"\n"
+    with fp.open("rb") as f:
+        for buf in iter(lambda: f.read(1 << 20), b""):
+            n += buf.count(b"\n")
+            last = buf[-1:]
+    return n + (0 if last == b"\n" else 1)
+
+
 def maybe_clean(lines: Iterable[str], remove_tags: bool) -> List[str]:
     if not remove_tags:
         return list(lines)
@@ -52,37 +95,526 @@ def batched(xs: List[str], batch_size: int):
         yield xs[i:i+batch_size], i, min(i+batch_size, len(xs))
 
 
+def iter_batched(xs: Iterable[str], batch_size: int, start: int = 0):
+    """batched() 的串流版：輸入可為任意 iterator，回傳 (batch, start, end)；start 為第一筆的全域索引。"""
+    batch: List[str] = []
+    for x in xs:
+        batch.append(x)
+        if len(batch) >= batch_size:
+            yield batch, start, start + len(batch)
+            start += len(batch)
+            batch = []
+    if batch:
+        yield batch, start, start + len(batch)
+
+
+_PIPES = {}
+
+
+def get_pipeline(lang_code: str):
+    """同一行程內每種語言只建立一次 LaserEncoderPipeline（模型載入很慢）。"""
+    pipe = _PIPES.get(lang_code)
+    if pipe is None:
+        # 不在 constructor 帶 device，避免舊版 laser_encoders 報 TypeError
+        pipe = _PIPES[lang_code] = LaserEncoderPipeline(lang=lang_code)
+    return pipe
+
+
+_TOKENIZERS = {}
+
+
+def get_tokenizer(lang_code: str):
+    """
+    只載入 SentencePiece 分詞器（不載 encoder）。--workers 時模型在子行程，
+    父行程規劃 --length_mode spm 的批次仍要算 piece 數，用這個取得與 pipeline 相同的分詞。
+    """
+    tok = _TOKENIZERS.get(lang_code)
+    if tok is None:
+        try:
+            from laser_encoders import initialize_tokenizer
+        except ImportError:
+            raise RuntimeError("laser_encoders has no initialize_tokenizer; "
+                               "--workers with --length_mode spm needs a newer laser-encoders (or use --length_mode char)")
+        tok = _TOKENIZERS[lang_code] = initialize_tokenizer(lang=lang_code)
+    return tok
+
+
+_ENCODER_IDS = {}
+
+
+def encoder_identity(lang_code: str) -> str:
+    """
+    持久快取 key 用的編碼器識別：laser_encoders 版本 + 本語言模型檔（預設目錄下的 laser2.* / laser3-<lang>.*）
+    的名稱、大小與 mtime。升級套件或重新下載模型後識別就不同，--cache_dir 不會拿舊模型的向量。
+    模型尚未下載（第一次執行）時不快取結果，編碼後再取一次。
+    """
+    ident = _ENCODER_IDS.get(lang_code)
+    if ident is not None:
+        return ident
+    from importlib import metadata
+    try:
+        version = metadata.version("laser_encoders")
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+    model_dir = Path("~/.cache/laser_encoders").expanduser()
+    files = sorted(set(model_dir.glob("laser2.*")) | set(model_dir.glob(f"laser3-{lang_code}.*")))
+    parts = [f"laser_encoders=={version}"]
+    for fp in files:
+        st = fp.stat()
+        parts.append(f"{fp.name}:{st.st_size}:{st.st_mtime_ns}")
+    ident = "|".join(parts)
+    if files:
+        _ENCODER_IDS[lang_code] = ident
+    return ident
+
+
+def _pool_init(threads: int) -> None:
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+
+
+def _pool_encode(task) -> np.ndarray:
+    # 模型在第一批時才載入（get_pipeline 於行程內快取）：不放在 initializer，
+    # 下載 / 載入失敗或語言代碼錯誤時例外會經 imap 傳回父行程，而不是讓 Pool 不斷重開 worker
+    lang_code, batch, normalize = task
+    return _encode_batch(get_pipeline(lang_code), batch, normalize, "cpu")
+
+
+class EncoderPool:
+    """
+    N 個常駐的 CPU encoder 行程（spawn），各自在第一批時載入一次模型並限制 intra-op 執行緒數。
+    batch 以 imap 分派，結果依送出順序取回，呼叫端再 scatter 回原索引。
+    """
+
+    def __init__(self, workers: int, threads: int = 0):
+        import os
+        import multiprocessing as mp
+        self.workers = workers
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        # 子行程在 import torch 前就讀到這些環境變數，避免每個行程都開滿核心的 OpenMP 執行緒
+        saved = {k: os.environ.get(k) for k in ("OMP_NUM_THREADS", "MKL_NUM_THREADS")}
+        for k in saved:
+            os.environ[k] = str(self.threads)
+        try:
+            self.pool = mp.get_context("spawn").Pool(
+                workers, initializer=_pool_init, initargs=(self.threads,)
+            )
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+        print(f"[INFO] EncoderPool: {workers} workers x {self.threads} threads (cpu)")
+
+    def for_lang(self, lang_code: str) -> "_PoolLang":
+        return _PoolLang(self, lang_code)
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+
+class _PoolLang:
+    """EncoderPool 綁定單一語言的 handle，可當作 pipe 傳給 _encode_list。"""
+
+    def __init__(self, pool: EncoderPool, lang_code: str):
+        self.pool = pool
+        self.lang = lang_code
+
+    @property
+    def tokenizer(self):
+        # 父行程自己的分詞器，讓 sentence_lengths 的 spm 模式不會因為沒有 pipeline 而退回 char
+        return get_tokenizer(self.lang)
+
+    def imap(self, sentences: List[str], plan: List[np.ndarray], normalize: bool):
+        tasks = ((self.lang, [sentences[i] for i in idx], normalize) for idx in plan)
+        return self.pool.pool.imap(_pool_encode, tasks, chunksize=1)
+
+
+def _encode_batch(pipe, batch: List[str], normalize: bool, device: str) -> np.ndarray:
+    # 優先嘗試在 encode_sentences() 傳 device；不支援則退回不帶
+    try:
+        X = pipe.encode_sentences(batch, normalize_embeddings=normalize, device=device)
+    except TypeError:
+        X = pipe.encode_sentences(batch, normalize_embeddings=normalize)
+    return np.asarray(X, dtype=np.float32)
+
+
+def sentence_lengths(sentences: List[str], length_mode: str = "char", pipe=None) -> np.ndarray:
+    """
+    句長估計：char=字元數（免費）；spm=LASER 內建 SentencePiece 的 piece 數（較準，但多做一次分詞）。
+    pipe 沒有 tokenizer 屬性時退回 char。
+    """
+    tok = getattr(pipe, "tokenizer", None) if length_mode == "spm" else None
+    if tok is None:
+        return np.fromiter((len(x) for x in sentences), dtype=np.int64, count=len(sentences))
+    return np.fromiter((len(tok.tokenize(x).split()) for x in sentences), dtype=np.int64, count=len(sentences))
+
+
+def length_bucketed_batches(lengths: np.ndarray, token_budget: int, max_batch: int) -> List[np.ndarray]:
+    """
+    依長度排序後貪婪裝箱：每批「最長句長 × 句數」（= padding 後 token 數）不超過 token_budget，
+    句數不超過 max_batch。回傳每批的原始索引；單句超過預算時自成一批。
+    """
+    order = np.argsort(lengths, kind="stable")
+    batches: List[np.ndarray] = []
+    start = 0
+    for k in range(len(order)):
+        cur = max(int(lengths[order[k]]), 1)  # 已排序：目前這句即為本批最長
+        size = k - start + 1
+        if size > 1 and (cur * size > token_budget or size > max_batch):
+            batches.append(order[start:k])
+            start = k
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+def padded_tokens(lengths: np.ndarray, batches: List[np.ndarray]) -> int:
+    """各批 padding 後的 token 總數（最長句長 × 句數），用來衡量 padding 浪費。"""
+    return int(sum(int(lengths[b].max()) * len(b) for b in batches if len(b)))
+
+
+def plan_batches(sentences: List[str], batch_size: int, token_budget: int = 0,
+                 length_mode: str = "char", pipe=None) -> List[np.ndarray]:
+    """批次計畫（每批的原始索引）：token_budget>0 走長度分桶，否則依檔案順序每 batch_size 句一批。"""
+    n = len(sentences)
+    if token_budget > 0:
+        return length_bucketed_batches(sentence_lengths(sentences, length_mode, pipe), token_budget, batch_size)
+    return [np.arange(i, min(i + batch_size, n)) for i in range(0, n, batch_size)]
+
+
+def _encode_list(pipe, sentences: List[str], normalize: bool, device: str, batch_size: int,
+                 token_budget: int = 0, length_mode: str = "char", desc: Optional[str] = None) -> np.ndarray:
+    """
+    一組句子 → (len, dim)。依 plan_batches 的計畫逐批編碼，再依原始索引 scatter 回輸入順序。
+    pipe 為 EncoderPool 的語言 handle 時，各批分散到常駐 worker 行程並依序取回。
+    """
+    plan = plan_batches(sentences, batch_size, token_budget, length_mode, pipe)
+    if isinstance(pipe, _PoolLang):
+        results = pipe.imap(sentences, plan, normalize)
+    else:
+        results = (_encode_batch(pipe, [sentences[i] for i in idx], normalize, device) for idx in plan)
+    if desc:
+        results = tqdm(results, total=len(plan), desc=desc)
+    out = None
+    for idx, X in zip(plan, results):
+        if out is None:
+            out = np.empty((len(sentences), X.shape[1]), dtype=np.float32)
+        out[idx] = X
+    return out if out is not None else np.zeros((0, 1024), dtype=np.float32)
+
+
+def _encode_dedup(pipe, sentences: List[str], lang_code: str, normalize: bool, device: str,
+                  batch_size: int, token_budget: int, length_mode: str,
+                  cache=None, stats: Optional[CacheStats] = None, desc: Optional[str] = None) -> np.ndarray:
+    """
+    先去除完全相同的句子，再查持久快取，只把 miss 送進 encoder；最後依 inverse 索引展開回原順序。
+    """
+    import time
+    pos = {}
+    inv = np.fromiter((pos.setdefault(x, len(pos)) for x in sentences), dtype=np.int64, count=len(sentences))
+    uniq = list(pos)
+    U = None
+    miss = list(range(len(uniq)))
+    keys = None
+    if cache is not None:
+        ident = encoder_identity(lang_code)
+        keys = [sentence_key(lang_code, x, normalize, ident) for x in uniq]
+        found = cache.get_many(keys)
+        miss = [i for i, k in enumerate(keys) if k not in found]
+        if found:
+            dim = len(next(iter(found.values())))
+            U = np.empty((len(uniq), dim), dtype=np.float32)
+            for i, k in enumerate(keys):
+                v = found.get(k)
+                if v is not None:
+                    U[i] = v
+    t0 = time.time()
+    X = _encode_list(pipe, [uniq[i] for i in miss], normalize, device, batch_size,
+                     token_budget, length_mode, desc) if miss else None
+    dt = time.time() - t0
+    if X is not None:
+        if U is None:
+            U = np.empty((len(uniq), X.shape[1]), dtype=np.float32)
+        U[miss] = X
+        if cache is not None:
+            if encoder_identity(lang_code) != ident:  # 模型是這次才下載的：以下載後的識別寫入
+                ident = encoder_identity(lang_code)
+                for i in miss:
+                    keys[i] = sentence_key(lang_code, uniq[i], normalize, ident)
+            cache.put_many((keys[i], X[j]) for j, i in enumerate(miss))
+            cache.record_rate(lang_code, dt, len(miss))
+    if stats is not None:
+        stats.total += len(sentences)
+        stats.unique += len(uniq)
+        stats.hits += len(uniq) - len(miss)
+        stats.encoded += len(miss)
+        stats.encode_sec += dt
+    if U is None:
+        return np.zeros((0, 1024), dtype=np.float32)
+    return U[inv]
+
+
 def encode_sentences(
     sentences: List[str],
     lang_code: str,
     batch_size: int = 256,
     normalize: bool = True,
     device_ignored: str = "auto",  # 已忽略，為相容舊參數
+    token_budget: int = 0,
+    length_mode: str = "char",
+    dedup: bool = False,
+    cache=None,
+    pool: Optional[EncoderPool] = None,
 ) -> np.ndarray:
     """
     使用 LASER2 直接吃原文；內建 SentencePiece 分詞。
-    注意：本版本裝置寫死為 DEVICE_HARD。
-    """
-    # 不在 constructor 帶 device，避免舊版 laser_encoders 報 TypeError
-    pipe = LaserEncoderPipeline(lang=lang_code)
-
-    device_eff = DEVICE_HARD
-    embs = []
-    total = (len(sentences) + batch_size - 1) // batch_size
-    for batch, s, e in tqdm(
-        batched(sentences, batch_size),
-        total=total,
-        desc=f"Encoding {lang_code} on {device_eff}",
-    ):
-        # 優先嘗試在 encode_sentences() 傳 device；不支援則退回不帶
-        try:
-            X = pipe.encode_sentences(
-                batch, normalize_embeddings=normalize, device=device_eff
+    token_budget>0 時改用長度分桶（batch_size 變成每批句數上限），輸出順序與輸入相同。
+    dedup / cache：相同句子只編碼一次，並查詢 / 寫入持久快取（emb_cache.EmbeddingCache）。
+    pool：batch 分散到 EncoderPool 的常駐 CPU 行程。
+    注意：單行程時裝置寫死為 DEVICE_HARD。
+    """
+    pipe = pool.for_lang(lang_code) if pool is not None else get_pipeline(lang_code)
+
+    device_eff = "cpu" if pool is not None else DEVICE_HARD
+    desc = f"Encoding {lang_code} on {device_eff}"
+    if token_budget > 0:
+        print(f"[INFO] {desc} (length-bucketed, token_budget={token_budget})")
+    if dedup or cache is not None:
+        stats = CacheStats(lang_code)
+        out = _encode_dedup(pipe, sentences, lang_code, normalize, device_eff, batch_size,
+                            token_budget, length_mode, cache, stats, desc)
+        print(stats.report(cache))
+        return out
+    return _encode_list(pipe, sentences, normalize, device_eff, batch_size, token_budget, length_mode, desc)
+
+
+class MemmapSide:
+    """
+    串流編碼的單側狀態：預先配置的 (n, dim) np.memmap (.npy)、--resume 進度檔與去重統計。
+    emb_dtype 為 float16 / int8 時逐批量化後寫入（int8 另寫 .scale.npy）。
+    out_path=None 時只編碼不落地（--eta_only 用）。dim 由第一個 batch 決定（LASER2 為 1024）。
+    resume_sig 不為 None 時，簽章相同的 <out>.progress.json 記錄的行數（done）之前都已落地。
+    """
+
+    def __init__(self, n: int, lang_code: str, out_path: Optional[Path], batch_size: int = 256,
+                 normalize: bool = True, token_budget: int = 0, length_mode: str = "char",
+                 dedup: bool = False, cache=None, pool: Optional[EncoderPool] = None,
+                 emb_dtype: str = "float32", resume_sig: Optional[dict] = None):
+        self.n = n
+        self.lang = lang_code
+        self.out_path = out_path
+        self.batch_size = batch_size
+        self.normalize = normalize
+        self.token_budget = token_budget
+        self.length_mode = length_mode
+        self.cache = cache
+        self.pool = pool
+        self.emb_dtype = emb_dtype
+        self.resume_sig = resume_sig
+        self.M = self.SC = None
+        self.done = 0
+        self.prog_path = progress_path(out_path) if (out_path is not None and resume_sig is not None) else None
+        if self.prog_path is not None and self.prog_path.is_file() and out_path.is_file():
+            prog = json.loads(self.prog_path.read_text(encoding="utf-8"))
+            if prog.get("sig") == resume_sig and 0 < prog.get("done", 0) <= n:
+                self.M = np.lib.format.open_memmap(str(out_path), mode="r+")
+                if emb_dtype == "int8":
+                    self.SC = np.lib.format.open_memmap(str(scale_path(out_path)), mode="r+")
+                self.done = int(prog["done"])
+        self.pipe = pool.for_lang(lang_code) if pool is not None else get_pipeline(lang_code)
+        self.device = "cpu" if pool is not None else DEVICE_HARD
+        self.use_dedup = dedup or cache is not None
+        self.stats = CacheStats(lang_code) if self.use_dedup else None
+        self.q_sum, self.q_min, self.q_n = 0.0, 1.0, 0
+
+    def encode(self, batch: List[str]) -> np.ndarray:
+        if self.use_dedup:
+            return _encode_dedup(self.pipe, batch, self.lang, self.normalize, self.device, self.batch_size,
+                                 self.token_budget, self.length_mode, self.cache, self.stats)
+        if self.token_budget > 0 or self.pool is not None:
+            return _encode_list(self.pipe, batch, self.normalize, self.device, self.batch_size,
+                                self.token_budget, self.length_mode)
+        return _encode_batch(self.pipe, batch, self.normalize, self.device)
+
+    def write(self, s: int, e: int, X: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """量化後寫入 [s, e)，回傳落地的 (data, scale)；out_path=None 時原樣回傳 X。"""
+        if self.out_path is None:
+            return X, None
+        if self.M is None:
+            self.M = np.lib.format.open_memmap(
+                str(self.out_path), mode="w+", dtype=EMB_DTYPES[self.emb_dtype], shape=(self.n, X.shape[1])
             )
-        except TypeError:
-            X = pipe.encode_sentences(batch, normalize_embeddings=normalize)
-        embs.append(X)
-    return np.vstack(embs) if embs else np.zeros((0, 1024), dtype=np.float32)
+            if self.emb_dtype == "int8":
+                self.SC = np.lib.format.open_memmap(
+                    str(scale_path(self.out_path)), mode="w+", dtype=np.float32, shape=(self.n,)
+                )
+        Q, sc = quantize(X, self.emb_dtype)
+        self.M[s:e] = Q
+        if sc is not None:
+            self.SC[s:e] = sc
+        if self.emb_dtype != "float32":
+            rc = cosine_diag(X, dequantize(Q, sc), assume_normalized=False)
+            self.q_sum += float(rc.sum())
+            self.q_min = min(self.q_min, float(rc.min()))
+            self.q_n += len(rc)
+        return Q, sc
+
+    def checkpoint(self, pos: int) -> None:
+        if self.prog_path is not None and self.M is not None:
+            _checkpoint(self.M, self.SC, self.prog_path, self.resume_sig, pos, self.n)
+
+    def finish(self, pos: int) -> None:
+        if self.stats is not None:
+            print(self.stats.report(self.cache))
+        if self.q_n:
+            print(f"[QUANT] {self.lang} {self.emb_dtype}: reconstruction cosine "
+                  f"mean={self.q_sum / self.q_n:.6f} min={self.q_min:.6f}")
+        if self.prog_path is not None and self.M is not None:
+            _checkpoint(self.M, self.SC, self.prog_path, self.resume_sig, pos, self.n)
+        else:
+            if self.M is not None:
+                self.M.flush()
+            if self.SC is not None:
+                self.SC.flush()
+
+
+def encode_pair_to_memmap(
+    id_sentences: Iterable[str],
+    zh_sentences: Iterable[str],
+    id_side: MemmapSide,
+    zh_side: MemmapSide,
+    n: int,
+    step: int,
+    checkpoint_sec: float = 300.0,
+    on_window: Optional[Callable] = None,
+) -> int:
+    """
+    兩側同步串流編碼：每次讀入兩側同一段 [s, e)（step 行），各自編碼寫入 memmap 後呼叫
+    on_window(s, e, (Xi, Xz), (Qi, si), (Qz, sz))（float32 向量與落地的緊湊格式），
+    讓呼叫端在兩側向量都還在記憶體時就算好這段的分數。記憶體只保留一個視窗，與 n 無關。
+    續跑時兩側都從較早的 checkpoint 接續（較快的一側重編一小段），每 checkpoint_sec 秒同時 checkpoint。
+    回傳接續的起點：[0, 起點) 不會再經過 on_window，呼叫端需自行從 memmap 補算。
+    """
+    import time
+    start = min(id_side.done, zh_side.done)
+    if start >= n:
+        print(f"[RESUME] {id_side.lang}/{zh_side.lang}: embeddings already complete, skip encoding")
+        return start
+    if start > 0:
+        print(f"[RESUME] {id_side.lang}/{zh_side.lang}: continue from line {start}/{n}")
+    windows = zip(iter_batched(itertools.islice(id_sentences, start, None), step, start),
+                  iter_batched(itertools.islice(zh_sentences, start, None), step, start))
+    pos = start
+    last_ckpt = time.time()
+    for (bi, s, e), (bz, _, _) in tqdm(
+        windows,
+        total=(n - start + step - 1) // step,
+        desc=f"Streaming {id_side.lang}+{zh_side.lang} on {id_side.device}",
+    ):
+        if e > n:
+            bi, bz = bi[: n - s], bz[: n - s]
+            e = n
+        if not bi:
+            break
+        Xi = id_side.encode(bi)
+        Xz = zh_side.encode(bz)
+        qi = id_side.write(s, e, Xi)
+        qz = zh_side.write(s, e, Xz)
+        if on_window is not None:
+            on_window(s, e, (Xi, Xz), qi, qz)
+        pos = e
+        if time.time() - last_ckpt >= checkpoint_sec:
+            id_side.checkpoint(pos)
+            zh_side.checkpoint(pos)
+            last_ckpt = time.time()
+    if pos != n:
+        raise RuntimeError(f"[ERROR] {id_side.lang}/{zh_side.lang}: expected {n} lines, encoded {pos}")
+    id_side.finish(pos)
+    zh_side.finish(pos)
+    return start
+
+
+def progress_path(emb_path: Path) -> Path:
+    return emb_path.with_name(emb_path.name + ".progress.json")
+
+
+def write_json_atomic(path: Path, obj: dict) -> None:
+    """先寫暫存檔再 os.replace，當機時不會留下半寫的 JSON。"""
+    import os
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _checkpoint(M, SC, prog_path: Path, sig: dict, done: int, n: int) -> None:
+    # 先把 memmap 寫回磁碟，再更新進度，確保進度檔記錄的行數一定已落地
+    M.flush()
+    if SC is not None:
+        SC.flush()
+    write_json_atomic(prog_path, {"sig": sig, "done": int(done), "n": int(n)})
+
+
+def input_signature(fp: Path, n: int, lang_code: str, args) -> dict:
+    """續跑用的輸入簽章：來源檔大小 / mtime 與所有會影響嵌入內容的參數。"""
+    st = fp.stat()
+    return {
+        "src": str(fp.resolve()), "size": st.st_size, "mtime_ns": st.st_mtime_ns, "n": n,
+        "lang": lang_code, "normalize": not args.no_norm, "remove_tags": bool(args.remove_tags),
+        "emb_dtype": args.emb_dtype,
+    }
+
+
+EMB_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def quantize(X: np.ndarray, emb_dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    float32 → 緊湊儲存格式。int8 為逐向量縮放：scale = max|x| / 127，q = round(x / scale)，
+    回傳 (q, scale)；float16 / float32 的 scale 為 None。
+    """
+    X = np.asarray(X, dtype=np.float32)
+    if emb_dtype == "int8":
+        scale = np.abs(X).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        return np.rint(X / scale[:, None]).astype(np.int8), scale.astype(np.float32)
+    return X.astype(EMB_DTYPES[emb_dtype]), None
+
+
+def dequantize(Q: np.ndarray, scale: Optional[np.ndarray] = None) -> np.ndarray:
+    X = np.asarray(Q, dtype=np.float32)
+    if scale is not None:
+        X = X * np.asarray(scale, dtype=np.float32)[:, None]
+    return X
+
+
+def scale_path(emb_path: Path) -> Path:
+    """int8 嵌入的逐向量 scale 檔：raw.id.emb.npy → raw.id.emb.scale.npy"""
+    return emb_path.with_name(emb_path.name[:-len(".npy")] + ".scale.npy")
+
+
+def save_emb(emb_path: Path, X: np.ndarray, emb_dtype: str = "float32") -> None:
+    Q, scale = quantize(X, emb_dtype)
+    np.save(emb_path, Q)
+    if scale is not None:
+        np.save(scale_path(emb_path), scale)
+
+
+def load_emb(emb_path: Path, mmap: bool = True) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """讀回 (data, scale)；float32 / float16 時 scale 為 None。data 以 memmap 開啟。"""
+    mode = "r" if mmap else None
+    sp = scale_path(emb_path)
+    scale = np.load(sp, mmap_mode=mode) if sp.is_file() else None
+    return np.load(emb_path, mmap_mode=mode), scale
 
 
 def cosine_diag(A: np.ndarray, B: np.ndarray, assume_normalized: bool) -> np.ndarray:
@@ -102,6 +634,22 @@ def cosine_diag(A: np.ndarray, B: np.ndarray, assume_normalized: bool) -> np.nda
     return dot / (na * nb)
 
 
+def cosine_diag_blocked(A: np.ndarray, B: np.ndarray, assume_normalized: bool, block: int = 65536,
+                        scale_a: Optional[np.ndarray] = None, scale_b: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    cosine_diag 的分塊版：A/B 可為 memmap，也可為 float16 / int8 緊湊格式（int8 需給 scale），
+    每次只把 block 行轉成 float32，結果只佔 O(N) float32。
+    """
+    n = min(len(A), len(B))
+    out = np.empty(n, dtype=np.float32)
+    for i in range(0, n, block):
+        i2 = min(i + block, n)
+        a = dequantize(A[i:i2], None if scale_a is None else scale_a[i:i2])
+        b = dequantize(B[i:i2], None if scale_b is None else scale_b[i:i2])
+        out[i:i2] = cosine_diag(a, b, assume_normalized)
+    return out
+
+
 def cosine_matrix(A: np.ndarray, B: np.ndarray, assume_normalized: bool, chunk: int = 0) -> np.ndarray:
     """
     回傳整個 cosine 相似度矩陣（可能很大）。可選擇分塊以節省記憶體。
@@ -131,42 +679,277 @@ def cosine_matrix(A: np.ndarray, B: np.ndarray, assume_normalized: bool, chunk:
 
 
 def summarize_scores(scores: np.ndarray, thresholds: Tuple[float, ...]) -> dict:
-    scores = np.asarray(scores, dtype=np.float32)
-    if scores.size == 0:
-        return {
-            "count": 0, "mean": None, "median": None, "p90": None, "max": None, "min": None,
-            "threshold_counts": {str(t): 0 for t in thresholds}
-        }
-    return {
-        "count": int(scores.size),
-        "mean": float(scores.mean()),
-        "median": float(np.median(scores)),
-        "p90": float(np.percentile(scores, 90)),
-        "max": float(scores.max()),
-        "min": float(scores.min()),
-        "threshold_counts": {str(t): int((scores >= t).sum()) for t in thresholds}
-    }
+    """單次摘要（ScoreSketch：直方圖分位數 + 精確門檻計數）；需要合併時改用 ScoreSketch / write_summary。"""
+    return ScoreSketch(thresholds).update(scores).summary()
 
 
-def main():
+def _unit_rows(X: np.ndarray) -> np.ndarray:
+    X = np.asarray(X, dtype=np.float32)
+    return X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-12)
+
+
+def _merge_topk(vals: np.ndarray, idx: np.ndarray, new_vals: np.ndarray, new_idx: np.ndarray, k: int):
+    """把新 tile 的分數併進每列的 running top-k（未排序）。"""
+    V = np.concatenate([vals, new_vals], axis=1)
+    I = np.concatenate([idx, new_idx], axis=1)
+    if V.shape[1] > k:
+        p = np.argpartition(-V, k - 1, axis=1)[:, :k]
+        V = np.take_along_axis(V, p, axis=1)
+        I = np.take_along_axis(I, p, axis=1)
+    return V, I
+
+
+def _sort_topk(vals: np.ndarray, idx: np.ndarray):
+    # 分數遞減，同分時索引小者在前（與 argmax 一致）
+    o = np.lexsort((idx, -vals), axis=1)
+    return np.take_along_axis(vals, o, axis=1), np.take_along_axis(idx, o, axis=1)
+
+
+def blocked_topk(A: np.ndarray, B: np.ndarray, k: int, assume_normalized: bool, block: int = 4096,
+                 scale_a: Optional[np.ndarray] = None, scale_b: Optional[np.ndarray] = None):
+    """
+    分塊計算 A@B.T，每次只有一個 (block, block) tile 在記憶體中；
+    同時維護 A→B 與 B→A 兩個方向每列的 running top-k，不會產生 N×N 矩陣。
+    A/B 可為 memmap 或 float16 / int8 緊湊格式（int8 需給 scale）。
+    回傳 (vals_ab, idx_ab, vals_ba, idx_ba)，每列依分數遞減排序，記憶體 O(N·k)。
+    """
+    nA, nB = len(A), len(B)
+    kA, kB = min(k, nB), min(k, nA)
+    vals_ab = np.full((nA, kA), -np.inf, dtype=np.float32)
+    idx_ab = np.full((nA, kA), -1, dtype=np.int64)
+    vals_ba = np.full((nB, kB), -np.inf, dtype=np.float32)
+    idx_ba = np.full((nB, kB), -1, dtype=np.int64)
+    def prep(X, scale, a, b):
+        X = dequantize(X[a:b], None if scale is None else scale[a:b])
+        return X if assume_normalized else _unit_rows(X)
+
+    for i in tqdm(range(0, nA, block), total=(nA + block - 1) // block, desc="NN tiles"):
+        i2 = min(i + block, nA)
+        Ai = prep(A, scale_a, i, i2)
+        for j in range(0, nB, block):
+            j2 = min(j + block, nB)
+            S = Ai @ prep(B, scale_b, j, j2).T
+            cols = np.broadcast_to(np.arange(j, j2, dtype=np.int64), S.shape)
+            vals_ab[i:i2], idx_ab[i:i2] = _merge_topk(vals_ab[i:i2], idx_ab[i:i2], S, cols, kA)
+            rows = np.broadcast_to(np.arange(i, i2, dtype=np.int64), S.T.shape)
+            vals_ba[j:j2], idx_ba[j:j2] = _merge_topk(vals_ba[j:j2], idx_ba[j:j2], S.T, rows, kB)
+    vals_ab, idx_ab = _sort_topk(vals_ab, idx_ab)
+    vals_ba, idx_ba = _sort_topk(vals_ba, idx_ba)
+    return vals_ab, idx_ab, vals_ba, idx_ba
+
+
+def ratio_margin(vals_ab: np.ndarray, idx_ab: np.ndarray, vals_ba: np.ndarray, idx_ba: np.ndarray):
+    """
+    LASER 式 ratio margin：margin(x, y) = cos(x, y) / ((mean_kNN(x) + mean_kNN(y)) / 2)。
+    回傳 (margin_ab, margin_ba)，形狀同 vals_ab / vals_ba。
+    """
+    mean_a = vals_ab.mean(axis=1)
+    mean_b = vals_ba.mean(axis=1)
+    margin_ab = vals_ab / ((mean_a[:, None] + mean_b[idx_ab]) / 2 + 1e-12)
+    margin_ba = vals_ba / ((mean_b[:, None] + mean_a[idx_ba]) / 2 + 1e-12)
+    return margin_ab, margin_ba
+
+
+class LineReader:
+    """以 byte offset 隨機讀取第 i 行（只存 O(N) 個 int64，不存句子本身）。"""
+
+    def __init__(self, fp: Path, remove_tags: bool = False, limit: int = 0):
+        self.fp = Path(fp)
+        self.remove_tags = remove_tags
+        self.offsets = line_offsets(self.fp, limit)
+        self.f = self.fp.open("rb")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        self.f.seek(int(self.offsets[i]))
+        s = self.f.read(int(self.offsets[i + 1] - self.offsets[i])).decode("utf-8").strip()
+        if self.remove_tags:
+            s = CLEAN_TAG_RE.sub("", s).strip()
+        return s
+
+    def close(self) -> None:
+        self.f.close()
+
+
+def write_nn(out_dir: Path, A: np.ndarray, B: np.ndarray, id_lines, zh_lines,
+             normalize: bool, nn_chunk: int, k: int = 4,
+             scale_a: Optional[np.ndarray] = None, scale_b: Optional[np.ndarray] = None) -> None:
+    """
+    區塊式 bitext mining：nn_top1.tsv（cosine 最近鄰，格式同舊版）與 nn_topk.tsv
+    （每個 id 句的 k 個候選，依 ratio margin 排序，並標記 margin 最佳配對是否互為最佳）。
+    id_lines / zh_lines 只需支援 [i]（list 或 LineReader）。
+    """
+    block = nn_chunk if nn_chunk and nn_chunk > 0 else 4096
+    print(f"[INFO] Blocked top-{k} mining (tile {block}x{block}, no N x N matrix)")
+    vals_ab, idx_ab, vals_ba, idx_ba = blocked_topk(A, B, k, normalize, block, scale_a, scale_b)
+    margin_ab, margin_ba = ratio_margin(vals_ab, idx_ab, vals_ba, idx_ba)
+
+    # 以 margin 重新排序候選；最佳 = 第 0 欄
+    o = np.argsort(-margin_ab, axis=1, kind="stable")
+    margin_ab = np.take_along_axis(margin_ab, o, axis=1)
+    cos_ab = np.take_along_axis(vals_ab, o, axis=1)
+    cand_ab = np.take_along_axis(idx_ab, o, axis=1)
+    best_ab = cand_ab[:, 0]
+    best_ba = idx_ba[np.arange(len(idx_ba)), margin_ba.argmax(axis=1)]
+    mutual = best_ba[best_ab] == np.arange(len(best_ab))
+
+    with (out_dir / "nn_top1.tsv").open("w", encoding="utf-8") as f:
+        f.write("id_idx\tzh_idx\tcosine\tid_sentence\tzh_sentence\n")
+        for i in range(len(idx_ab)):
+            j = int(idx_ab[i, 0])
+            f.write(f"{i}\t{j}\t{vals_ab[i, 0]:.6f}\t{id_lines[i]}\t{zh_lines[j]}\n")
+
+    with (out_dir / "nn_topk.tsv").open("w", encoding="utf-8") as f:
+        f.write("id_idx\trank\tzh_idx\tcosine\tmargin\tmutual\tid_sentence\tzh_sentence\n")
+        for i in range(len(cand_ab)):
+            si = id_lines[i]
+            for r in range(cand_ab.shape[1]):
+                j = int(cand_ab[i, r])
+                mu = int(r == 0 and mutual[i])
+                f.write(f"{i}\t{r + 1}\t{j}\t{cos_ab[i, r]:.6f}\t{margin_ab[i, r]:.6f}\t{mu}\t{si}\t{zh_lines[j]}\n")
+    print(f"[INFO] NN: mutual best (margin) pairs = {int(mutual.sum())}/{len(mutual)}")
+
+
+def report_quant_deviation(out_dir: Path, ref_scores: np.ndarray, normalize: bool) -> None:
+    """從剛寫出的緊湊嵌入重算逐行分數，回報與 float32 分數的偏差。"""
+    A, sa = load_emb(out_dir / "raw.id.emb.npy")
+    B, sb = load_emb(out_dir / "raw.zh.emb.npy")
+    q_scores = cosine_diag_blocked(A, B, normalize, scale_a=sa, scale_b=sb)
+    dev = np.abs(q_scores - ref_scores)
+    print(f"[QUANT] {A.dtype} score deviation vs float32: mean={dev.mean():.6f} "
+          f"p99={np.percentile(dev, 99):.6f} max={dev.max():.6f}")
+
+
+def store_sources(args, id_path: Path, zh_path: Path, n: int):
+    """
+    分數目錄要指向的來源檔與 offsets。預設就是 --id / --zh（offsets 由 write_store 掃描）；
+    給了 --store_id / --store_zh 時，本次輸入是從該原檔切出的一段（run_laser.sh 的 chunks_src/*.partXX，
+    每次執行都會重新產生），改指向原檔：offsets = 本檔 offsets + 本段在原檔的起始 byte（--store_*_base），
+    之後重切片也不會讓這一片的分數目錄被判為過期。
+    回傳 (id 來源, zh 來源, id offsets 或 None, zh offsets 或 None)。
+    """
+    if not (args.store_id and args.store_zh):
+        return id_path, zh_path, None, None
+    out = []
+    for part, src, base in ((id_path, Path(args.store_id), args.store_id_base),
+                            (zh_path, Path(args.store_zh), args.store_zh_base)):
+        offs = line_offsets(part, n) + int(base)
+        # 確認這段確實是原檔在 base 處的內容（比對長度與第一行），避免 offset 指到別的行
+        with part.open("rb") as f:
+            first = f.readline()
+        with src.open("rb") as f:
+            f.seek(int(base))
+            same = f.readline() == first
+        if not same or offs[-1] > src.stat().st_size:
+            raise ValueError(f"{part} is not the byte range starting at {base} of {src}")
+        out.append(offs)
+    return Path(args.store_id), Path(args.store_zh), out[0], out[1]
+
+
+def open_pool(args) -> Optional[EncoderPool]:
+    if args.workers and args.workers > 0:
+        if args.length_mode == "spm":
+            # 先在父行程載入分詞器：載不到就直接拒絕，不要默默改用字元長度分桶
+            try:
+                for lang in (args.id_lang, args.zh_lang):
+                    get_tokenizer(lang)
+            except (RuntimeError, ValueError) as e:
+                print(f"[ERROR] --workers with --length_mode spm: {e}")
+                sys.exit(2)
+        return EncoderPool(args.workers, args.worker_threads)
+    return None
+
+
+def bench_bucketing(id_lines: List[str], zh_lines: List[str], args, normalize: bool) -> None:
+    """
+    同一批句子分別用固定 batch 與長度分桶編碼，輸出 [BENCH] pairs/sec 與 padding 浪費。
+    --token_budget 未指定時取 batch_size × 平均句長，讓兩者每批 token 數大致相當。
+    """
     import time
-    ap = argparse.ArgumentParser(description="LASER2 encode & score for raw.id/raw.zh")
-    ap.add_argument("--id", required=True, help="Path to raw.id")
-    ap.add_argument("--zh", required=True, help="Path to raw.zh")
+    n = len(id_lines)
+    id_len = sentence_lengths(id_lines)
+    zh_len = sentence_lengths(zh_lines)
+    budget = args.token_budget or max(1, int(args.batch_size * np.concatenate([id_len, zh_len]).mean()))
+
+    for name, lens in (("id", id_len), ("zh", zh_len)):
+        real = int(lens.sum())
+        fixed = padded_tokens(lens, [np.arange(i, min(i + args.batch_size, n)) for i in range(0, n, args.batch_size)])
+        bucket = padded_tokens(lens, length_bucketed_batches(lens, budget, args.batch_size))
+        print(f"[BENCH] {name} padded chars: fixed={fixed} ({real / max(fixed, 1):.1%} useful)  "
+              f"bucketed={bucket} ({real / max(bucket, 1):.1%} useful)")
+
+    pool = open_pool(args)
+    rates = {}
+    try:
+        for label, tb in (("fixed", 0), ("bucketed", budget)):
+            t0 = time.time()
+            encode_sentences(id_lines, args.id_lang, args.batch_size, normalize, args.device, tb, args.length_mode,
+                             pool=pool)
+            encode_sentences(zh_lines, args.zh_lang, args.batch_size, normalize, args.device, tb, args.length_mode,
+                             pool=pool)
+            elapsed = time.time() - t0
+            rates[label] = n / elapsed if elapsed > 0 else float("inf")
+            print(f"[BENCH] {label:<8} Encoded {n} pairs in {elapsed:.2f}s  ->  {rates[label]:.2f} pairs/sec")
+    finally:
+        if pool is not None:
+            pool.close()
+    print(f"[BENCH] bucketing speedup: x{rates['bucketed'] / rates['fixed']:.2f} (token_budget={budget})")
+
+
+def add_encode_args(ap: argparse.ArgumentParser) -> None:
+    """laser_run.py 與 laser_driver.py 共用的編碼 / 評分選項。"""
     ap.add_argument("--id_lang", default="ind_Latn", help="FLORES200 code for Indonesian (default: ind_Latn)")
     ap.add_argument("--zh_lang", default="zho_Hant", help="FLORES200 code for Chinese (zho_Hant or zho_Hans)")
-    ap.add_argument("--out_dir", default="laser_out", help="Output directory")
     ap.add_argument("--batch_size", type=int, default=512)
     ap.add_argument("--no_norm", action="store_true", help="Disable L2 normalization (預設有做正規化)")
     ap.add_argument("--device", default="auto", help='(ignored) kept for CLI compatibility')
     ap.add_argument("--remove_tags", action="store_true", help="Remove <TAG> like tokens before encoding")
-    ap.add_argument("--write_nn", action="store_true", help="Also write top-1 nearest neighbor alignments (O(N^2) memory)")
-    ap.add_argument("--nn_chunk", type=int, default=0, help="Block size for cosine matrix (0=naive all-at-once). Use when --write_nn with big data.")
+    ap.add_argument("--write_nn", action="store_true", help="Also write nn_top1.tsv / nn_topk.tsv via blocked top-k mining (O(N*k) memory)")
+    ap.add_argument("--nn_chunk", type=int, default=0, help="Tile size for blocked NN mining (0 = 4096)")
+    ap.add_argument("--nn_k", type=int, default=4, help="Neighbours kept per row for ratio-margin scoring")
     ap.add_argument("--thresholds", default="0.6,0.7,0.8,0.9", help="Comma-separated thresholds for summary counts")
+    ap.add_argument("--sim_format", choices=("both", "npy", "tsv"), default="both",
+                    help="Per-line scores as scores.npy store (+ raw.* offsets), similarity.tsv view, or both")
     ap.add_argument("--max_lines", type=int, default=0, help="Only process first N lines (0 = all)")
     ap.add_argument("--eta_only", action="store_true", help="Benchmark on --max_lines and print ETA for full data without saving files")
+    ap.add_argument("--token_budget", type=int, default=0, help="Length-bucketed batching: max padded tokens per batch (0 = fixed --batch_size in file order)")
+    ap.add_argument("--length_mode", choices=("char", "spm"), default="char", help="Sentence length used for bucketing: characters or SentencePiece pieces")
+    ap.add_argument("--dedup", action="store_true", help="Encode each distinct sentence only once per run")
+    ap.add_argument("--cache_dir", default="", help="Persistent embedding cache dir shared across runs (implies --dedup)")
+    ap.add_argument("--cache_max_gb", type=float, default=20.0, help="LRU size bound of --cache_dir in GiB")
+    ap.add_argument("--emb_dtype", choices=tuple(EMB_DTYPES), default="float32",
+                    help="Storage dtype of *.emb.npy (int8 = per-vector scaled, scales in *.emb.scale.npy)")
+    ap.add_argument("--workers", type=int, default=0, help="CPU encoder processes (0 = single in-process pipeline on DEVICE_HARD)")
+    ap.add_argument("--worker_threads", type=int, default=0, help="Intra-op threads per worker (0 = cpu_count // workers)")
+
+
+def main():
+    import time
+    ap = argparse.ArgumentParser(description="LASER2 encode & score for raw.id/raw.zh")
+    ap.add_argument("--id", required=True, help="Path to raw.id")
+    ap.add_argument("--zh", required=True, help="Path to raw.zh")
+    ap.add_argument("--out_dir", default="laser_out", help="Output directory")
+    ap.add_argument("--stream", action="store_true", help="Lazy read + batch-wise encode into preallocated .npy memmaps (constant RSS, no shell splitting needed)")
+    ap.add_argument("--bucket_window", type=int, default=100000, help="With --stream --token_budget: lines read per bucketing window")
+    ap.add_argument("--resume", action="store_true", help="With --stream: checkpoint encoding progress and resume from it on restart. "
+                         "Without --stream there is no mid-run checkpoint (a restart re-encodes this input; "
+                         "run_laser.sh / laser_driver.py resume per finished chunk)")
+    ap.add_argument("--checkpoint_sec", type=float, default=300.0, help="Seconds between --resume checkpoints")
+    ap.add_argument("--store_id", default="", help="Point the score store at this file (the un-split raw.id --id was cut from)")
+    ap.add_argument("--store_zh", default="", help="Point the score store at this file (the un-split raw.zh --zh was cut from)")
+    ap.add_argument("--store_id_base", type=int, default=0, help="Byte offset of --id's first line inside --store_id")
+    ap.add_argument("--store_zh_base", type=int, default=0, help="Byte offset of --zh's first line inside --store_zh")
+    ap.add_argument("--bench_bucketing", action="store_true", help="Benchmark fixed vs length-bucketed batching on --max_lines and exit")
+    add_encode_args(ap)
     args = ap.parse_args()
 
+    if args.stream:
+        return main_stream(args)
+    if args.resume:
+        print("[WARN] --resume only checkpoints with --stream; this in-memory run restarts from scratch if interrupted")
+
     id_path = Path(args.id)
     zh_path = Path(args.zh)
     out_dir = Path(args.out_dir)
@@ -189,10 +972,25 @@ def main():
 
     normalize = (not args.no_norm)
 
-    t0 = time.time()
-    id_vecs = encode_sentences(id_lines, args.id_lang, args.batch_size, normalize, args.device)
-    zh_vecs = encode_sentences(zh_lines, args.zh_lang, args.batch_size, normalize, args.device)
-    t1 = time.time()
+    if args.bench_bucketing:
+        bench_bucketing(id_lines, zh_lines, args, normalize)
+        return
+
+    cache = open_cache(args.cache_dir, args.cache_max_gb)
+    pool = None
+    try:
+        pool = open_pool(args)
+        t0 = time.time()
+        id_vecs = encode_sentences(id_lines, args.id_lang, args.batch_size, normalize, args.device,
+                                   args.token_budget, args.length_mode, args.dedup, cache, pool)
+        zh_vecs = encode_sentences(zh_lines, args.zh_lang, args.batch_size, normalize, args.device,
+                                   args.token_budget, args.length_mode, args.dedup, cache, pool)
+        t1 = time.time()
+    finally:
+        if cache is not None:
+            cache.close()
+        if pool is not None:
+            pool.close()
 
     elapsed = t1 - t0
     rate = n / elapsed if elapsed > 0 else float("inf")
@@ -206,36 +1004,146 @@ def main():
             print("[ETA] Rate is 0? Check device/batch size.")
         return
 
-    # 儲存 embeddings
-    np.save(out_dir / "raw.id.emb.npy", id_vecs)
-    np.save(out_dir / "raw.zh.emb.npy", zh_vecs)
+    # 儲存 embeddings（可選 float16 / int8 緊湊格式）
+    save_emb(out_dir / "raw.id.emb.npy", id_vecs, args.emb_dtype)
+    save_emb(out_dir / "raw.zh.emb.npy", zh_vecs, args.emb_dtype)
 
     # 逐行 cosine（同索引）
     diag_scores = cosine_diag(id_vecs, zh_vecs, assume_normalized=normalize)
+    if args.emb_dtype != "float32":
+        report_quant_deviation(out_dir, diag_scores, normalize)
 
-    # 輸出每行分數
-    sim_tsv = out_dir / "similarity.tsv"
-    with sim_tsv.open("w", encoding="utf-8") as f:
-        f.write("idx\tcosine\tid_sentence\tzh_sentence\n")
-        for i, (c, si, sz) in enumerate(zip(diag_scores, id_lines, zh_lines)):
-            f.write(f"{i}\t{c:.6f}\t{si}\t{sz}\n")
+    # 輸出每行分數：緊湊 scores.npy（+ 原檔 offset）與 / 或 similarity.tsv 檢視
+    if args.sim_format in ("both", "npy"):
+        id_src, zh_src, id_offs, zh_offs = store_sources(args, id_path, zh_path, n)
+        write_store(out_dir, diag_scores, id_src, zh_src, args.remove_tags, id_offs, zh_offs)
+    if args.sim_format in ("both", "tsv"):
+        sim_tsv = out_dir / "similarity.tsv"
+        with sim_tsv.open("w", encoding="utf-8") as f:
+            f.write("idx\tcosine\tid_sentence\tzh_sentence\n")
+            for i, (c, si, sz) in enumerate(zip(diag_scores, id_lines, zh_lines)):
+                f.write(f"{i}\t{c:.6f}\t{si}\t{sz}\n")
 
     # 統計
     thresholds = tuple(float(x) for x in args.thresholds.split(",") if x.strip())
-    summary = summarize_scores(diag_scores, thresholds)
-    with (out_dir / "scores_summary.json").open("w", encoding="utf-8") as f:
-        json.dump(summary, f, ensure_ascii=False, indent=2)
+    summary = write_summary(out_dir, ScoreSketch(thresholds).update(diag_scores))
 
     # （可選）最近鄰對齊
     if args.write_nn:
-        print("[INFO] Building cosine matrix for nearest neighbors... (may be large)")
-        S = cosine_matrix(id_vecs, zh_vecs, assume_normalized=normalize, chunk=args.nn_chunk)
-        nn_idx = S.argmax(axis=1)
-        nn_val = S.max(axis=1)
-        with (out_dir / "nn_top1.tsv").open("w", encoding="utf-8") as f:
-            f.write("id_idx\tzh_idx\tcosine\tid_sentence\tzh_sentence\n")
-            for i, (j, c) in enumerate(zip(nn_idx, nn_val)):
-                f.write(f"{i}\t{int(j)}\t{c:.6f}\t{id_lines[i]}\t{zh_lines[int(j)]}\n")
+        write_nn(out_dir, id_vecs, zh_vecs, id_lines, zh_lines, normalize, args.nn_chunk, args.nn_k)
+
+    print(f"[DONE] Saved to: {out_dir}")
+    print(f"[INFO] Summary: {summary}")
+
+
+def main_stream(args):
+    """
+    --stream 模式：兩側同步「惰性讀取 → 逐視窗編碼 → 寫入 memmap」，每個視窗編碼完就算分數並累積
+    ScoreSketch；similarity.tsv 逐行產生，不會同時持有整份句子或嵌入。
+    """
+    import time
+    id_path = Path(args.id)
+    zh_path = Path(args.zh)
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    total_pairs = min(count_lines(id_path), count_lines(zh_path))
+    n = min(args.max_lines, total_pairs) if args.max_lines and args.max_lines > 0 else total_pairs
+    if n == 0:
+        print("[ERROR] No lines to process. Check your input files.")
+        sys.exit(2)
+
+    normalize = (not args.no_norm)
+    id_emb_path = None if args.eta_only else out_dir / "raw.id.emb.npy"
+    zh_emb_path = None if args.eta_only else out_dir / "raw.zh.emb.npy"
+    id_sig = input_signature(id_path, n, args.id_lang, args) if args.resume else None
+    zh_sig = input_signature(zh_path, n, args.zh_lang, args) if args.resume else None
+
+    thresholds = tuple(float(x) for x in args.thresholds.split(",") if x.strip())
+    diag_scores = None if args.eta_only else np.empty(n, dtype=np.float32)
+    sketch = ScoreSketch(thresholds)
+
+    dev = {"sum": 0.0, "max": 0.0, "n": 0}
+
+    def on_window(s, e, X, qi, qz):
+        # 兩側這段都剛編碼完：與記憶體模式相同以 float32 算分數，摘要邊編碼邊累積；
+        # 緊湊格式時另以落地的 float16 / int8 重算，累積與 float32 分數的偏差
+        sc = cosine_diag_blocked(X[0], X[1], normalize)
+        diag_scores[s:e] = sc
+        sketch.update(sc)
+        if args.emb_dtype != "float32":
+            d = np.abs(cosine_diag_blocked(qi[0], qz[0], normalize, scale_a=qi[1], scale_b=qz[1]) - sc)
+            dev["sum"] += float(d.sum(dtype=np.float64))
+            dev["max"] = max(dev["max"], float(d.max()))
+            dev["n"] += len(d)
+
+    cache = open_cache(args.cache_dir, args.cache_max_gb)
+    pool = None
+    try:
+        pool = open_pool(args)
+        t0 = time.time()
+        side_args = (args.batch_size, normalize, args.token_budget, args.length_mode, args.dedup, cache, pool,
+                     args.emb_dtype)
+        id_side = MemmapSide(n, args.id_lang, id_emb_path, *side_args, resume_sig=id_sig)
+        zh_side = MemmapSide(n, args.zh_lang, zh_emb_path, *side_args, resume_sig=zh_sig)
+        step = args.bucket_window if (args.token_budget > 0 or id_side.use_dedup or pool is not None) else args.batch_size
+        start = encode_pair_to_memmap(iter_lines(id_path, args.remove_tags, n),
+                                      iter_lines(zh_path, args.remove_tags, n),
+                                      id_side, zh_side, n, step, args.checkpoint_sec,
+                                      None if args.eta_only else on_window)
+        t1 = time.time()
+    finally:
+        if cache is not None:
+            cache.close()
+        if pool is not None:
+            pool.close()
+
+    elapsed = t1 - t0
+    rate = (n - start) / elapsed if elapsed > 0 else float("inf")
+    print(f"[BENCH] Encoded {n - start} pairs in {elapsed:.2f}s  ->  {rate:.2f} pairs/sec (stream)")
+
+    if args.eta_only:
+        if rate > 0:
+            eta_sec = total_pairs / rate
+            print(f"[ETA] Projected time for all {total_pairs} pairs: ~{eta_sec:.1f}s")
+        else:
+            print("[ETA] Rate is 0? Check device/batch size.")
+        return
+
+    if dev["n"]:
+        print(f"[QUANT] {args.emb_dtype} score deviation vs float32: mean={dev['sum'] / dev['n']:.6f} "
+              f"max={dev['max']:.6f} ({dev['n']} pairs encoded this run)")
+
+    id_vecs, id_scale, zh_vecs, zh_scale = id_side.M, id_side.SC, zh_side.M, zh_side.SC
+    if start > 0:
+        # 續跑前已落地的部分不會經過 on_window，只能從 memmap（緊湊格式）補算
+        diag_scores[:start] = cosine_diag_blocked(
+            id_vecs[:start], zh_vecs[:start], assume_normalized=normalize,
+            scale_a=None if id_scale is None else id_scale[:start],
+            scale_b=None if zh_scale is None else zh_scale[:start],
+        )
+        sketch.update(diag_scores[:start])
+
+    if args.sim_format in ("both", "npy"):
+        id_src, zh_src, id_offs, zh_offs = store_sources(args, id_path, zh_path, n)
+        write_store(out_dir, diag_scores, id_src, zh_src, args.remove_tags, id_offs, zh_offs)
+    if args.sim_format in ("both", "tsv"):
+        sim_tsv = out_dir / "similarity.tsv"
+        with sim_tsv.open("w", encoding="utf-8") as f:
+            f.write("idx\tcosine\tid_sentence\tzh_sentence\n")
+            lines = zip(iter_lines(id_path, args.remove_tags, n), iter_lines(zh_path, args.remove_tags, n))
+            for i, (c, (si, sz)) in enumerate(zip(diag_scores, lines)):
+                f.write(f"{i}\t{c:.6f}\t{si}\t{sz}\n")
+
+    summary = write_summary(out_dir, sketch)
+
+    if args.write_nn:
+        id_lines = LineReader(id_path, args.remove_tags, n)
+        zh_lines = LineReader(zh_path, args.remove_tags, n)
+        write_nn(out_dir, id_vecs, zh_vecs, id_lines, zh_lines, normalize, args.nn_chunk, args.nn_k,
+                 id_scale, zh_scale)
+        id_lines.close()
+        zh_lines.close()
 
     print(f"[DONE] Saved to: {out_dir}")
     print(f"[INFO] Summary: {summary}")
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+scores_store.py
+- LASER 逐行分數的緊湊格式（取代重複整句的 similarity.tsv）：
+  - scores.npy            : float32 (N,)，第 i 個 = 第 i 行句對的 cosine
+  - raw.id.offsets.npy / raw.zh.offsets.npy : int64 (N+1,)，原始 raw.* 檔中各行起始 byte offset
+  - scores_index.json     : 原始檔路徑 / 大小 / mtime、N、是否 --remove_tags
+- 門檻篩選以 mmap + 向量化 mask 完成，只對選中的行依 offset 回原檔讀句子（連續行合併成一次讀取）
+- similarity.tsv 變成可選的「檢視」格式（laser_run.py --sim_format）
+- ScoreSketch：可合併的分數摘要（[-1, 1] 固定 bin 直方圖 + 精確的各門檻計數 / count / sum / min / max），
+  每個 chunk 存 scores_sketch.npz，全語料 scores_summary.json 以 O(chunks) 合併得到，不必重讀 TSV
+
+子命令：
+  python scores_store.py sweep  --store laser_out/merged --thresholds 0.5,0.6,0.7,0.8,0.9
+  python scores_store.py export --store laser_out/merged --threshold 0.7 --out_id f.id --out_zh f.zh [--lt_id .. --lt_zh ..]
+  python scores_store.py merge  --laser_out laser_out --id raw.id --zh raw.zh   # run_laser.sh 分片 → merged/（缺 scores.npy 的片退回讀 similarity.tsv）
+  python scores_store.py summary --laser_out laser_out                          # 合併 chunk_*/scores_sketch.npz
+
+只用標準庫 + numpy。
+"""
+
+import re
+import sys
+import json
+import argparse
+from pathlib import Path
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+
+CLEAN_TAG_RE = re.compile(r"<[^>\n]{1,64}>")  # 移除 <NER> / <POS> 之類標記
+
+SCORES_NAME = "scores.npy"
+INDEX_NAME = "scores_index.json"
+SKETCH_NAME = "scores_sketch.npz"
+SUMMARY_NAME = "scores_summary.json"
+
+# 直方圖 bin 數：[-1, 1] 切 20000 格（bin 寬 1e-4），分位數誤差 <= 半個 bin = 5e-5
+SKETCH_BINS = 20000
+
+# 一次從原檔讀取的最多連續行數（限制單次 read 的記憶體）
+_RUN_LINES = 65536
+
+
+def line_offsets(fp: Path, limit: int = 0) -> np.ndarray:
+    """
+    各行起始 byte offset（長度 N+1，最後一個為檔尾；最後一行無換行也算一行）。
+    以 1 MiB 區塊向量化找換行，不逐行迭代；limit>0 時只索引前 N 行。
+    """
+    parts = [np.zeros(1, dtype=np.int64)]
+    pos = n = 0
+    with fp.open("rb") as f:
+        for buf in iter(lambda: f.read(1 << 20), b""):
+            nl = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10).astype(np.int64) + (pos + 1)
+            parts.append(nl)
+            pos += len(buf)
+            n += len(nl)
+            if limit and n >= limit:
+                break
+    offs = np.concatenate(parts)
+    if offs[-1] != pos:
+        offs = np.append(offs, pos)
+    return offs[:limit + 1] if limit else offs
+
+
+def _file_sig(fp: Path) -> dict:
+    st = fp.stat()
+    return {"path": str(fp.resolve()), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def tsv_rounded(scores: np.ndarray) -> np.ndarray:
+    """similarity.tsv 以 %.6f 輸出；比較門檻前先同樣四捨五入，篩選結果與讀 TSV 一致。"""
+    return np.round(np.asarray(scores, dtype=np.float64), 6)
+
+
+class ScoreSketch:
+    """
+    可合併的分數摘要：count / sum / min / max 與各門檻（>= t）計數為精確值，
+    median / p90 由固定 bin 直方圖求得：每個順序統計量取其所在 bin 的中點（夾在 [min, max] 內，
+    第一 / 最後一個直接用 min / max），再依 np.percentile（linear）的排名在相鄰兩個順序統計量間內插。
+    因此不論資料多稀疏，與精確分位數的誤差都不超過半個 bin 寬（[-1, 1] 以外的值會被歸到兩端的 bin）。
+    update() 可逐批呼叫（串流時邊算邊累積），merge() 合併兩份相同門檻的摘要。
+    """
+
+    def __init__(self, thresholds: Sequence[float] = (), bins: int = SKETCH_BINS):
+        self.thresholds = tuple(float(t) for t in thresholds)
+        self.bins = int(bins)
+        self.hist = np.zeros(self.bins, dtype=np.int64)
+        self.th_counts = np.zeros(len(self.thresholds), dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def update(self, scores: np.ndarray) -> "ScoreSketch":
+        s = np.asarray(scores, dtype=np.float32).ravel()
+        if s.size == 0:
+            return self
+        b = np.floor((s.astype(np.float64) + 1.0) * (self.bins / 2.0)).astype(np.int64)
+        self.hist += np.bincount(np.clip(b, 0, self.bins - 1), minlength=self.bins)
+        for j, t in enumerate(self.thresholds):
+            self.th_counts[j] += int(np.count_nonzero(s >= t))
+        self.count += int(s.size)
+        self.sum += float(s.sum(dtype=np.float64))
+        self.min = min(self.min, float(s.min()))
+        self.max = max(self.max, float(s.max()))
+        return self
+
+    def merge(self, other: "ScoreSketch") -> "ScoreSketch":
+        if other.bins != self.bins or other.thresholds != self.thresholds:
+            raise ValueError(f"cannot merge sketches with different bins/thresholds: "
+                             f"{self.bins}/{self.thresholds} vs {other.bins}/{other.thresholds}")
+        self.hist += other.hist
+        self.th_counts += other.th_counts
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def _order_stat(self, k: int, cum: np.ndarray) -> float:
+        """第 k 小（0 起算）的值的估計：所在 bin 的中點，夾在 [min, max] 內。"""
+        if k <= 0:
+            return self.min
+        if k >= self.count - 1:
+            return self.max
+        i = min(int(np.searchsorted(cum, k, side="right")), self.bins - 1)
+        v = -1.0 + (i + 0.5) * (2.0 / self.bins)
+        return min(max(v, self.min), self.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """與 np.percentile（linear）同定義：在第 floor / ceil(rank) 個順序統計量之間線性內插。"""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        lo = int(np.floor(rank))
+        cum = np.cumsum(self.hist)
+        a = self._order_stat(lo, cum)
+        b = self._order_stat(min(lo + 1, self.count - 1), cum)
+        return float(a + (b - a) * (rank - lo))
+
+    def summary(self) -> dict:
+        if self.count == 0:
+            return {
+                "count": 0, "mean": None, "median": None, "p90": None, "max": None, "min": None,
+                "threshold_counts": {str(t): 0 for t in self.thresholds}
+            }
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count,
+            "median": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "max": self.max,
+            "min": self.min,
+            "threshold_counts": {str(t): int(c) for t, c in zip(self.thresholds, self.th_counts)},
+            "quantile_bin_width": 2.0 / self.bins,
+            "quantile_max_error": 1.0 / self.bins,
+        }
+
+    def save(self, path: Path) -> None:
+        np.savez(path, hist=self.hist, thresholds=np.asarray(self.thresholds, dtype=np.float64),
+                 th_counts=self.th_counts, stats=np.asarray([self.count, self.sum, self.min, self.max]))
+
+    @classmethod
+    def load(cls, path: Path) -> "ScoreSketch":
+        with np.load(path) as z:
+            sk = cls(tuple(z["thresholds"].tolist()), bins=len(z["hist"]))
+            sk.hist = z["hist"].astype(np.int64)
+            sk.th_counts = z["th_counts"].astype(np.int64)
+            count, total, lo, hi = z["stats"].tolist()
+        sk.count, sk.sum, sk.min, sk.max = int(count), float(total), float(lo), float(hi)
+        return sk
+
+
+def write_summary(out_dir: Path, sketch: ScoreSketch) -> dict:
+    """寫出 scores_sketch.npz（供之後合併）與 scores_summary.json，回傳 summary。"""
+    out_dir = Path(out_dir)
+    sketch.save(out_dir / SKETCH_NAME)
+    summary = sketch.summary()
+    tmp = out_dir / (SUMMARY_NAME + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    tmp.replace(out_dir / SUMMARY_NAME)
+    return summary
+
+
+def merge_sketches(laser_out: Path, out_dir: Optional[Path] = None) -> dict:
+    """
+    合併 chunk_*/scores_sketch.npz → merged/ 的全語料摘要（只讀 O(chunks) 個小檔）。
+    每個 chunk_* 都要算進去：缺 sketch 的片以其逐行分數（chunk_scores）依相同 bins / 門檻重建，
+    分數也沒有就報錯，不會默默少算那一片。
+    """
+    laser_out = Path(laser_out)
+    out_dir = Path(out_dir) if out_dir else laser_out / "merged"
+    chunks = sorted(p for p in laser_out.glob("chunk_*") if p.is_dir())
+    if not chunks:
+        raise FileNotFoundError(f"no chunk_* directories under {laser_out}")
+    have = [p for p in chunks if (p / SKETCH_NAME).is_file()]
+    if not have:
+        raise FileNotFoundError(f"no chunk_*/{SKETCH_NAME} under {laser_out} (thresholds unknown)")
+    ref = ScoreSketch.load(have[0] / SKETCH_NAME)
+    total = ScoreSketch(ref.thresholds, ref.bins)
+    for p in chunks:
+        if (p / SKETCH_NAME).is_file():
+            total.merge(ScoreSketch.load(p / SKETCH_NAME))
+        else:
+            print(f"[WARN] {p / SKETCH_NAME} missing; rebuilding it from the chunk's scores")
+            total.merge(ScoreSketch(ref.thresholds, ref.bins).update(chunk_scores(p)))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    return write_summary(out_dir, total)
+
+
+def write_store(out_dir: Path, scores: np.ndarray, id_path: Path, zh_path: Path,
+                remove_tags: bool, id_offs: Optional[np.ndarray] = None,
+                zh_offs: Optional[np.ndarray] = None) -> None:
+    """寫出 scores.npy + 兩側 offset 索引；offsets 未給時掃描原檔前 N 行。"""
+    out_dir = Path(out_dir)
+    n = int(len(scores))
+    if id_offs is None:
+        id_offs = line_offsets(Path(id_path), n)
+    if zh_offs is None:
+        zh_offs = line_offsets(Path(zh_path), n)
+    if len(id_offs) != n + 1 or len(zh_offs) != n + 1:
+        raise ValueError(f"offset index length mismatch: scores={n} id={len(id_offs) - 1} zh={len(zh_offs) - 1}")
+    np.save(out_dir / SCORES_NAME, np.asarray(scores, dtype=np.float32))
+    np.save(out_dir / "raw.id.offsets.npy", np.asarray(id_offs, dtype=np.int64))
+    np.save(out_dir / "raw.zh.offsets.npy", np.asarray(zh_offs, dtype=np.int64))
+    meta = {
+        "n": n,
+        "remove_tags": bool(remove_tags),
+        "id": dict(_file_sig(Path(id_path)), offsets="raw.id.offsets.npy"),
+        "zh": dict(_file_sig(Path(zh_path)), offsets="raw.zh.offsets.npy"),
+    }
+    with (out_dir / INDEX_NAME).open("w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+def is_store(path: Path) -> bool:
+    path = Path(path)
+    return (path / INDEX_NAME).is_file() or (path.suffix == ".npy" and (path.parent / INDEX_NAME).is_file())
+
+
+class ScoreStore:
+    """唯讀開啟一個分數目錄；scores 為 mmap，句子依 offset 從原檔讀。"""
+
+    def __init__(self, path):
+        path = Path(path)
+        self.dir = path.parent if path.suffix == ".npy" else path
+        with (self.dir / INDEX_NAME).open("r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.n = int(self.meta["n"])
+        self.remove_tags = bool(self.meta.get("remove_tags", False))
+        self.scores = np.load(self.dir / SCORES_NAME, mmap_mode="r")
+        self.offsets = {side: np.load(self.dir / self.meta[side]["offsets"], mmap_mode="r") for side in ("id", "zh")}
+        for side in ("id", "zh"):
+            want = self.meta[side]
+            got = _file_sig(Path(want["path"]))
+            if (got["size"], got["mtime_ns"]) != (want["size"], want["mtime_ns"]):
+                raise RuntimeError(f"{want['path']} changed since {self.dir / INDEX_NAME} was written; "
+                                   f"re-run laser_run.py (or scores_store.py merge)")
+
+    def source(self, side: str) -> Path:
+        return Path(self.meta[side]["path"])
+
+    def mask(self, threshold: float, op: str = ">=") -> np.ndarray:
+        s = tsv_rounded(self.scores)
+        return s >= threshold if op == ">=" else s > threshold
+
+    def iter_lines(self, side: str, idx: np.ndarray) -> Iterator[str]:
+        """依遞增索引 idx 產生原檔中對應的行（strip，必要時移除標記，與 similarity.tsv 內容相同）。"""
+        offs = self.offsets[side]
+        idx = np.asarray(idx, dtype=np.int64)
+        if idx.size == 0:
+            return
+        # 連續索引合併成 run，每個 run 一次 seek + read
+        breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+        with self.source(side).open("rb") as f:
+            for run in np.split(idx, breaks):
+                for a in range(0, len(run), _RUN_LINES):
+                    lo = int(run[a])
+                    hi = int(run[min(a + _RUN_LINES, len(run)) - 1]) + 1
+                    f.seek(int(offs[lo]))
+                    data = f.read(int(offs[hi] - offs[lo]))
+                    for raw in data.split(b"\n")[:hi - lo]:
+                        s = raw.decode("utf-8").strip()
+                        if self.remove_tags:
+                            s = CLEAN_TAG_RE.sub("", s).strip()
+                        yield s
+
+    def write_lines(self, side: str, idx: np.ndarray, out_path: Path) -> None:
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        with out_path.open("w", encoding="utf-8") as f:
+            for s in self.iter_lines(side, idx):
+                f.write(s + "\n")
+
+    def write_tsv(self, out_path: Path) -> None:
+        """還原成 similarity.tsv 檢視（與 laser_run.py 直接寫出的內容相同）。"""
+        idx = np.arange(self.n)
+        with out_path.open("w", encoding="utf-8") as f:
+            f.write("idx\tcosine\tid_sentence\tzh_sentence\n")
+            for i, c, si, sz in zip(idx, self.scores, self.iter_lines("id", idx), self.iter_lines("zh", idx)):
+                f.write(f"{i}\t{c:.6f}\t{si}\t{sz}\n")
+
+
+def export(store: ScoreStore, threshold: float, out_id: Path, out_zh: Path, op: str = ">=",
+           lt_id: Optional[Path] = None, lt_zh: Optional[Path] = None) -> int:
+    """依門檻輸出句對；lt_* 給定時另外輸出未通過的部分。回傳通過筆數。"""
+    keep = store.mask(threshold, op)
+    sel = np.flatnonzero(keep)
+    store.write_lines("id", sel, out_id)
+    store.write_lines("zh", sel, out_zh)
+    if lt_id is not None and lt_zh is not None:
+        rest = np.flatnonzero(~keep)
+        store.write_lines("id", rest, lt_id)
+        store.write_lines("zh", rest, lt_zh)
+    return int(sel.size)
+
+
+def sweep(store: ScoreStore, thresholds: Sequence[float]) -> dict:
+    s = np.sort(tsv_rounded(store.scores))
+    return {str(t): int(s.size - np.searchsorted(s, t, side="left")) for t in thresholds}
+
+
+def read_tsv_scores(tsv_path: Path) -> np.ndarray:
+    """從 similarity.tsv 取回 cosine 欄（%.6f 精度；門檻比較本來就先四捨五入到 6 位）。"""
+    vals = []
+    with Path(tsv_path).open("r", encoding="utf-8", newline="\n") as f:
+        next(f, None)  # header
+        for line in f:
+            vals.append(float(line.split("\t", 2)[1]))
+    return np.asarray(vals, dtype=np.float32)
+
+
+def chunk_scores(chunk_dir: Path) -> np.ndarray:
+    """一片的逐行分數：優先 scores.npy，沒有時退回 similarity.tsv；兩者皆無則明確報錯。"""
+    chunk_dir = Path(chunk_dir)
+    if (chunk_dir / SCORES_NAME).is_file():
+        return np.load(chunk_dir / SCORES_NAME)
+    if (chunk_dir / "similarity.tsv").is_file():
+        print(f"[WARN] {chunk_dir / SCORES_NAME} missing; falling back to {chunk_dir / 'similarity.tsv'}")
+        return read_tsv_scores(chunk_dir / "similarity.tsv")
+    raise FileNotFoundError(f"{chunk_dir} has neither {SCORES_NAME} nor similarity.tsv; "
+                            f"re-run that chunk (delete its .done marker) before merging")
+
+
+def merge_chunks(laser_out: Path, id_path: Path, zh_path: Path, out_dir: Optional[Path] = None) -> int:
+    """
+    run_laser.sh 的分片結果 → merged/ 全域分數目錄：依 chunk 順序串接 chunk_XX/scores.npy，
+    offsets 重新指向完整的原始 raw.id / raw.zh。回傳總行數。
+    """
+    laser_out = Path(laser_out)
+    out_dir = Path(out_dir) if out_dir else laser_out / "merged"
+    chunks = sorted(p for p in laser_out.glob("chunk_*") if p.is_dir())
+    if not chunks:
+        raise FileNotFoundError(f"no chunk_* directories under {laser_out}")
+    # 任一片缺分數都不能略過，否則後面所有行的 offset 都會錯位
+    scores = np.concatenate([chunk_scores(p) for p in chunks])
+    remove_tags = any(json.loads((p / INDEX_NAME).read_text(encoding="utf-8")).get("remove_tags", False)
+                      for p in chunks if (p / INDEX_NAME).is_file())
+    out_dir.mkdir(parents=True, exist_ok=True)
+    write_store(out_dir, scores, id_path, zh_path, remove_tags)
+    return int(scores.size)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Compact LASER score store: sweep / export / merge")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("sweep", help="Count pairs >= each threshold")
+    p.add_argument("--store", required=True, help="Dir with scores.npy + scores_index.json")
+    p.add_argument("--thresholds", default="0.5,0.6,0.7,0.75,0.8,0.85,0.9")
+
+    p = sub.add_parser("export", help="Write pairs passing a threshold as .id/.zh")
+    p.add_argument("--store", required=True)
+    p.add_argument("--threshold", type=float, required=True)
+    p.add_argument("--op", choices=(">=", ">"), default=">=")
+    p.add_argument("--out_id", required=True)
+    p.add_argument("--out_zh", required=True)
+    p.add_argument("--lt_id", default="", help="Optional output for pairs below the threshold (.id)")
+    p.add_argument("--lt_zh", default="", help="Optional output for pairs below the threshold (.zh)")
+
+    p = sub.add_parser("tsv", help="Render the store as similarity.tsv")
+    p.add_argument("--store", required=True)
+    p.add_argument("--out", required=True)
+
+    p = sub.add_parser("summary", help="Merge chunk_*/scores_sketch.npz into a corpus-wide scores_summary.json")
+    p.add_argument("--laser_out", required=True)
+    p.add_argument("--out_dir", default="", help="Default: <laser_out>/merged")
+
+    p = sub.add_parser("merge", help="Concatenate chunk_*/scores.npy into a corpus-wide store")
+    p.add_argument("--laser_out", required=True)
+    p.add_argument("--id", required=True, help="Original (un-split) raw.id")
+    p.add_argument("--zh", required=True, help="Original (un-split) raw.zh")
+    p.add_argument("--out_dir", default="", help="Default: <laser_out>/merged")
+
+    args = ap.parse_args()
+    if args.cmd == "summary":
+        try:
+            summary = merge_sketches(Path(args.laser_out), Path(args.out_dir) if args.out_dir else None)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"[ERROR] {e}")
+            sys.exit(2)
+        print(f"[INFO] Summary: {summary}")
+        return
+    if args.cmd == "merge":
+        try:
+            n = merge_chunks(Path(args.laser_out), Path(args.id), Path(args.zh),
+                             Path(args.out_dir) if args.out_dir else None)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"[ERROR] {e}")
+            sys.exit(2)
+        print(f"[DONE] merged scores for {n} lines → {args.out_dir or Path(args.laser_out) / 'merged'}")
+        return
+
+    try:
+        store = ScoreStore(args.store)
+    except RuntimeError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(2)
+
+    if args.cmd == "sweep":
+        thresholds = [float(x) for x in args.thresholds.split(",") if x.strip()]
+        for t, c in sweep(store, thresholds).items():
+            print(f"{t}\t{c}\t{c / max(store.n, 1):.2%}")
+    elif args.cmd == "export":
+        kept = export(store, args.threshold, Path(args.out_id), Path(args.out_zh), args.op,
+                      Path(args.lt_id) if args.lt_id else None, Path(args.lt_zh) if args.lt_zh else None)
+        print(f"[DONE] total={store.n}, kept(score{args.op}{args.threshold})={kept}")
+    elif args.cmd == "tsv":
+        store.write_tsv(Path(args.out))
+        print(f"[DONE] {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+seg_cache.py
+- HanLP 斷詞結果的持久化快取（sqlite 單檔），供 hanlp_segment.py 跨語料 / 跨次執行共用
+- key = sha1(模型名稱 + 原始行)，value = 斷詞後以空白分隔的字串
+- 以總 bytes 上限做 LRU 淘汰（依最後存取時間）
+
+只用標準庫。
+"""
+
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# sqlite 單一語句參數上限（舊版 999）
+_SQL_CHUNK = 900
+
+
+def line_key(model: str, line: str) -> bytes:
+    h = hashlib.sha1()
+    h.update(model.encode('utf-8'))
+    h.update(b'\0')
+    h.update(line.encode('utf-8'))
+    return h.digest()
+
+
+class SegCache:
+    """
+    sqlite 版 LRU 斷詞快取。
+
+    用法：
+        cache = SegCache('~/.cache/hanlp_seg', max_bytes=2 << 30)
+        found = cache.get_many(keys)          # {key: str}
+        cache.put_many(zip(keys, segmented))
+        cache.close()                          # 預設會做一次 LRU 淘汰
+    """
+
+    def __init__(self, cache_dir, max_bytes: int = 2 << 30):
+        self.dir = Path(cache_dir).expanduser()
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.dir / 'seg_cache.sqlite'
+        self.max_bytes = int(max_bytes)
+        # 多個斷詞行程可同時開啟同一個快取
+        self.db = sqlite3.connect(str(self.path), timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS seg ('
+            ' k BLOB PRIMARY KEY, v TEXT NOT NULL, atime REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS seg_atime ON seg(atime)')
+        self.db.commit()
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, str]:
+        found: Dict[bytes, str] = {}
+        now = time.time()
+        for i in range(0, len(keys), _SQL_CHUNK):
+            part = list(keys[i:i + _SQL_CHUNK])
+            q = 'SELECT k, v FROM seg WHERE k IN (%s)' % ','.join('?' * len(part))
+            hit = []
+            for k, v in self.db.execute(q, part):
+                found[bytes(k)] = v
+                hit.append(k)
+            if hit:
+                self.db.executemany('UPDATE seg SET atime=? WHERE k=?', [(now, k) for k in hit])
+        self.db.commit()
+        return found
+
+    def put_many(self, items) -> None:
+        now = time.time()
+        rows: List[Tuple[bytes, str, float]] = [(k, v, now) for k, v in items]
+        self.db.executemany('INSERT OR REPLACE INTO seg (k, v, atime) VALUES (?,?,?)', rows)
+        self.db.commit()
+
+    def size_bytes(self) -> int:
+        row = self.db.execute('SELECT COALESCE(SUM(LENGTH(CAST(v AS BLOB)) + 20), 0) FROM seg').fetchone()
+        return int(row[0])
+
+    def evict(self) -> int:
+        """超過 max_bytes 時依 atime 由舊到新刪除，直到降到上限的 90%。回傳刪除筆數。"""
+        total = self.size_bytes()
+        if total <= self.max_bytes:
+            return 0
+        target = int(self.max_bytes * 0.9)
+        victims = []
+        cur = self.db.execute('SELECT k, LENGTH(CAST(v AS BLOB)) + 20 FROM seg ORDER BY atime ASC')
+        for k, nbytes in cur:
+            if total <= target:
+                break
+            victims.append((k,))
+            total -= int(nbytes)
+        if victims:
+            self.db.executemany('DELETE FROM seg WHERE k=?', victims)
+            self.db.commit()
+        return len(victims)
+
+    def close(self, evict: bool = True, log=None) -> None:
+        removed = self.evict() if evict else 0
+        if removed:
+            print(f'[SEGCACHE] LRU evicted {removed} lines (limit {self.max_bytes / (1 << 30):.1f} GiB)', file=log)
+        self.db.close()
+
+
+class SegStats:
+    """斷詞快取統計：行數、空行、去重後句數、快取命中、實際送進 HanLP 的句數。"""
+
+    FIELDS = ('lines', 'blank', 'unique', 'hits', 'segmented')
+
+    def __init__(self):
+        for f in self.FIELDS:
+            setattr(self, f, 0)
+
+    def as_tuple(self) -> Tuple[int, ...]:
+        return tuple(getattr(self, f) for f in self.FIELDS)
+
+    def add(self, other) -> None:
+        vals = other.as_tuple() if isinstance(other, SegStats) else tuple(other)
+        for f, v in zip(self.FIELDS, vals):
+            setattr(self, f, getattr(self, f) + v)
+
+    def report(self) -> str:
+        looked = self.unique
+        rate = self.hits / looked if looked else 0.0
+        return (f'[SEGCACHE] lines={self.lines} blank={self.blank} unique={self.unique} '
+                f'hits={self.hits} ({rate:.1%}) misses={self.unique - self.hits} '
+                f'-> sent to HanLP: {self.segmented}')
+
+
+def open_cache(cache_dir: Optional[str], max_gb: float) -> Optional[SegCache]:
+    if not cache_dir:
+        return None
+    return SegCache(cache_dir, max_bytes=int(max_gb * (1 << 30)))
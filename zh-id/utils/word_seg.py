@@ -1,126 +1,736 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""
+word_seg.py
+- /preprocess 服务：normalize → HanLP 断词 → Moses tokenize → truecase → BPE
+- 常驻 worker，不再每个请求起一串子进程：
+    HanLP：进程内载入一次常驻内存（hanlp_segment.load_pipe / segment_lines）
+    Moses normalize-punctuation / tokenizer：默认进程内执行（moses_text.py，与 perl 输出逐行一致）；
+      --moses perl 时与 truecase 一样，加 -b 以常驻子进程运行，一行进一行出
+    BPE：进程内 bpe_apply.BPEApplier（与 subword-nmt apply_bpe.py 输出逐字节一致，常用词的切分结果有 LRU 缓存）
+- 模型 registry：每个 model_name 的 truecaser / BPE 合并表 / 词表只载入一次，
+  LRU 保留 --max_models 个、估计内存不超过 --max_model_mb，文件 mtime 变动时重新载入；
+  GET /models 回传 hits / misses / 载入时间等统计
+- GET /metrics：各步骤与整个请求的延迟直方图、请求数（依 status）、队列深度（Prometheus 文字格式）
+- --server async：aiohttp + worker 线程池，同时处理中的请求超过 --max_inflight 回 429，关闭时 graceful drain
+- 启动时预热（--warmup 可指定要先载入 truecaser / BPE 的模型）
+- 批量接口：POST 带 "sentences": [...]，每步所有句子合成一次调用，回传 {"results": [每句的 dict]}
+- 单句请求经 micro-batching 队列（--max_wait_ms / --max_batch）与同时进来的请求合并处理
+"""
 
 from flask import Flask, request, jsonify, Response
 import subprocess
+import threading
+import argparse
+import bisect
+import queue
+import time
+import sys
 import os
 import json
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import moses_text
+from bpe_apply import BPEApplier
+from hanlp_segment import load_pipe, segment_lines
 
 app = Flask(__name__)
 
+SRC = "zh"
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.abspath(os.path.join(BASE_DIR, '..'))
+MOSES_SCRIPTS = os.path.join(REPO, '../mosesdecoder/scripts')
 
-def run(cmd, input_str):
-    """Run a subprocess with stdin=input_str and return stdout"""
-    p = subprocess.Popen(cmd,
-                         stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         text=True)
-    out, err = p.communicate(input_str)
-    if p.returncode != 0:
-        raise RuntimeError(f"Command failed: {' '.join(cmd)}\n{err}")
-    return out.strip()
+# 各工具路径
+NORM_PUNC = os.path.join(MOSES_SCRIPTS, 'tokenizer/normalize-punctuation.perl')
+TOKENIZER = os.path.join(MOSES_SCRIPTS, 'tokenizer/tokenizer.perl')
+TRUECASE_TOOL = os.path.join(MOSES_SCRIPTS, 'recaser/truecase.perl')
 
+# 一次写入超过这个大小时改由另一个线程写，避免两端管道都塞满而互相等待
+_FEED_INLINE = 16 << 10
 
-def preprocess_all(model_name: str,
-                   text: str,
-                   do_normalize: bool = True,
-                   do_hanlp: bool = True,
-                   do_tokenize: bool = True,
-                   do_truecase: bool = True,
-                   do_bpe: bool = True) -> dict:
+
+class LineCoprocess:
     """
-    按步骤预处理：
-      normalize → HanLP segmentation → Moses tokenization → optional truecase → BPE
-    各步骤可通过参数开关控制是否执行。
+    常驻的逐行子进程（Moses 脚本加 -b，每行输出后立即 flush）：写入 n 行、读回 n 行。
+    同一时间只允许一个调用者使用；子进程意外结束时下次调用自动重启。
     """
-    src = "zh"
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    repo = os.path.abspath(os.path.join(base_dir, '..'))
-    moses_scripts = os.path.join(repo, '../mosesdecoder/scripts')
-    bpe_root = os.path.join(repo, '../subword-nmt')
-    utils_dir = os.path.join(repo, 'utils')
-    model_dir = os.path.join(repo, 'models', model_name)
-
-    # 各工具路径
-    norm_punc    = os.path.join(moses_scripts, 'tokenizer/normalize-punctuation.perl')
-    hanlp_seg    = os.path.join(utils_dir, 'hanlp_segment.py')
-    tokenizer    = os.path.join(moses_scripts, 'tokenizer/tokenizer.perl')
-    truecase_tool= os.path.join(moses_scripts, 'recaser/truecase.perl')
-    apply_bpe    = os.path.join(bpe_root, 'apply_bpe.py')
-
-    # 各模型文件
-    truecase_model = os.path.join(model_dir, f'truecase-model.{src}')
-    bpe_code       = os.path.join(model_dir, f'bpecode.{src}')
-    vocab_file     = os.path.join(model_dir, f'voc.{src}')
-
-    result = {}
-    current = text
+
+    def __init__(self, cmd):
+        self.cmd = list(cmd)
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def _ensure(self):
+        if self.proc is None or self.proc.poll() is not None:
+            self.proc = subprocess.Popen(self.cmd,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL)
+        return self.proc
+
+    @staticmethod
+    def _feed(p, data):
+        try:
+            p.stdin.write(data)
+            p.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass  # 由读取端报错
+
+    def process(self, lines):
+        if not lines:
+            return []
+        data = ''.join(s + '\n' for s in lines).encode('utf-8')
+        with self.lock:
+            p = self._ensure()
+            feeder = None
+            if len(data) > _FEED_INLINE:
+                feeder = threading.Thread(target=self._feed, args=(p, data), daemon=True)
+                feeder.start()
+            else:
+                self._feed(p, data)
+            out = []
+            for _ in lines:
+                raw = p.stdout.readline()
+                if not raw:
+                    self._shutdown()
+                    raise RuntimeError(f"Command failed: {' '.join(self.cmd)}")
+                out.append(raw.decode('utf-8').rstrip('\n'))
+            if feeder is not None:
+                feeder.join()
+            return out
+
+    def _shutdown(self):
+        p, self.proc = self.proc, None
+        if p is None:
+            return
+        try:
+            p.stdin.close()
+            p.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            p.kill()
+
+    def close(self):
+        """等进行中的调用结束后关闭子进程（之后再调用 process 会重新启动）。"""
+        with self.lock:
+            self._shutdown()
+
+    def __del__(self):
+        p = self.proc
+        if p is not None and p.poll() is None:
+            p.kill()
+
+
+class InProcessLines:
+    """与 LineCoprocess 相同接口的进程内版本；make() 回传逐句函数，第一次使用时才建立。"""
+
+    def __init__(self, make):
+        self.make = make
+        self.fn = None
+
+    def process(self, lines):
+        if self.fn is None:
+            self.fn = self.make()
+        return [self.fn(s) for s in lines]
+
+    def close(self):
+        pass
+
+
+class ModelNotFound(LookupError):
+    """model_name 不合法、models/<model_name>/ 下没有任何 truecase / BPE 文件，或缺少请求步骤所需的文件（回 404）。"""
+
+
+def model_files(model_name: str) -> dict:
+    model_dir = os.path.join(REPO, 'models', model_name)
+    return {
+        'truecase': os.path.join(model_dir, f'truecase-model.{SRC}'),
+        'bpecode': os.path.join(model_dir, f'bpecode.{SRC}'),
+        'vocab': os.path.join(model_dir, f'voc.{SRC}'),
+    }
+
+
+def _files_signature(files: dict) -> tuple:
+    """各模型文件的 (mtime_ns, size)；不存在的文件记为 None。"""
+    sig = []
+    for k in sorted(files):
+        try:
+            st = os.stat(files[k])
+            sig.append((k, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            sig.append((k, None))
+    return tuple(sig)
+
+
+def _sizeof_table(d) -> int:
+    """粗估 dict / set 及其中字符串（或字符串 tuple）占用的内存。"""
+    n = sys.getsizeof(d)
+    items = d.items() if isinstance(d, dict) else ((x, None) for x in d)
+    for k, v in items:
+        for x in (k, v):
+            if isinstance(x, tuple):
+                n += sys.getsizeof(x) + sum(sys.getsizeof(y) for y in x)
+            elif x is not None:
+                n += sys.getsizeof(x)
+    return n
+
+
+# perl truecaser 以 hash 载入模型，常驻内存约为模型文件的数倍（粗估）
+_TRUECASE_MEM_FACTOR = 4
+# 每个模型的 BPE 词缓存上限（词数）与每笔缓存的粗估内存
+BPE_CACHE_WORDS = 1 << 16
+_BPE_CACHE_ENTRY_BYTES = 300
+
+
+class ModelArtifacts:
+    """单一 model_name 已载入的资源：truecaser 子进程（有 truecase 模型时）与 BPE 合并表 + 词表。"""
+
+    def __init__(self, name: str, files: dict, signature: tuple):
+        t0 = time.time()
+        self.name = name
+        self.files = files
+        self.signature = signature
+        self.truecaser = None
+        self.bpe = None
+        self.nbytes = 0
+        if os.path.isfile(files['truecase']):
+            self.truecaser = LineCoprocess(['perl', TRUECASE_TOOL, '-b', '--model', files['truecase']])
+            self.truecaser.process(['warm up'])  # 让 perl 先把模型读进内存
+            self.nbytes += os.path.getsize(files['truecase']) * _TRUECASE_MEM_FACTOR
+        if os.path.isfile(files['bpecode']):
+            # 与 apply_bpe.py -c ... --vocabulary ... 相同的参数
+            vocab = files['vocab'] if os.path.isfile(files['vocab']) else None
+            self.bpe = BPEApplier(files['bpecode'], vocab, cache_words=BPE_CACHE_WORDS)
+            self.nbytes += _sizeof_table(self.bpe.ranks) + _sizeof_table(self.bpe.reverse)
+            self.nbytes += BPE_CACHE_WORDS * _BPE_CACHE_ENTRY_BYTES
+            if self.bpe.vocab is not None:
+                self.nbytes += _sizeof_table(self.bpe.vocab)
+        self.load_seconds = time.time() - t0
+        self.loaded_at = time.time()
+
+    def require_bpe(self):
+        if self.bpe is None:
+            raise ModelNotFound(f"BPE codes not found: {self.files['bpecode']}")
+        if not os.path.isfile(self.files['vocab']):
+            raise ModelNotFound(f"BPE vocabulary not found: {self.files['vocab']}")
+        return self.bpe
+
+    def bpe_cache_stats(self):
+        info = self.bpe.cache_info() if self.bpe is not None else None
+        if info is None:
+            return None
+        return {'hits': info.hits, 'misses': info.misses, 'words': info.currsize}
+
+    def close(self):
+        if self.truecaser is not None:
+            self.truecaser.close()
+
+
+class ModelRegistry:
+    """
+    各 model_name 的 truecaser / BPE 合并表 / 词表只载入一次并常驻：
+    - 最多保留 max_models 个模型，且估计内存合计不超过 max_bytes，超过时按 LRU 淘汰（至少保留刚用到的一个）
+    - 每次取用都比对文件 mtime / size，变动时重新载入
+    - 不存在的 model_name（没有任何模型文件）直接抛 ModelNotFound，不占 LRU 位置、不会挤掉已载入的模型
+    - 统计 hits / misses / reloads / evictions 与累计载入秒数
+    """
+
+    def __init__(self, max_models: int = 8, max_bytes: int = 4 << 30):
+        self.max_models = max(1, max_models)
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = {}  # model_name -> Lock，同一模型不并发重复载入
+        self.counters = {'hits': 0, 'misses': 0, 'reloads': 0, 'evictions': 0, 'load_seconds': 0.0}
+
+    def _lookup(self, name: str, sig: tuple):
+        art = self.models.get(name)
+        if art is not None and art.signature == sig:
+            self.models.move_to_end(name)
+            self.counters['hits'] += 1
+            return art
+        return None
+
+    def get(self, model_name: str) -> ModelArtifacts:
+        if not isinstance(model_name, str) or model_name in ('', '.', '..') \
+                or os.sep in model_name or (os.altsep and os.altsep in model_name):
+            raise ModelNotFound(f"invalid model_name: {model_name!r}")
+        files = model_files(model_name)
+        sig = _files_signature(files)
+        if all(len(entry) == 2 for entry in sig):  # 每个文件都是 (key, None)：不存在
+            with self.lock:
+                stale = self.models.pop(model_name, None)
+            if stale is not None:
+                stale.close()
+            raise ModelNotFound(f"unknown model_name {model_name!r}: no truecase / BPE files under "
+                                f"{os.path.dirname(files['bpecode'])}")
+        with self.lock:
+            art = self._lookup(model_name, sig)
+            if art is not None:
+                return art
+            load_lock = self.loading.setdefault(model_name, threading.Lock())
+        with load_lock:
+            with self.lock:
+                art = self._lookup(model_name, sig)  # 其他线程可能刚载入完成
+                if art is not None:
+                    return art
+            art = ModelArtifacts(model_name, files, sig)
+            with self.lock:
+                old = self.models.pop(model_name, None)
+                self.counters['reloads' if old is not None else 'misses'] += 1
+                self.counters['load_seconds'] += art.load_seconds
+                self.models[model_name] = art
+                victims = [old] if old is not None else []
+                victims += self._evict()
+        for v in victims:
+            v.close()
+        return art
+
+    def _evict(self) -> list:
+        victims = []
+        while len(self.models) > 1 and (len(self.models) > self.max_models
+                                        or sum(a.nbytes for a in self.models.values()) > self.max_bytes):
+            _, v = self.models.popitem(last=False)
+            self.counters['evictions'] += 1
+            victims.append(v)
+        return victims
+
+    def stats(self) -> dict:
+        with self.lock:
+            out = dict(self.counters)
+            out['models'] = [{'model_name': a.name, 'approx_mb': round(a.nbytes / (1 << 20), 2),
+                              'load_seconds': round(a.load_seconds, 3), 'loaded_at': a.loaded_at,
+                              'bpe_cache': a.bpe_cache_stats()}
+                             for a in self.models.values()]
+        looked = out['hits'] + out['misses'] + out['reloads']
+        out['hit_rate'] = out['hits'] / looked if looked else 0.0
+        out['approx_mb'] = round(sum(m['approx_mb'] for m in out['models']), 2)
+        return out
+
+    def close(self):
+        with self.lock:
+            arts = list(self.models.values())
+            self.models.clear()
+        for a in arts:
+            a.close()
+
+
+class Preprocessor:
+    """持有所有常驻 worker；各模型的 truecaser / BPE 由 ModelRegistry 管理。"""
+
+    def __init__(self, max_models: int = 8, max_bytes: int = 4 << 30, moses: str = 'python'):
+        if moses == 'perl':
+            self.normalizer = LineCoprocess(['perl', NORM_PUNC, '-b', '-l', SRC])
+            self.tokenizer = LineCoprocess(['perl', TOKENIZER, '-b', '-l', SRC])
+        else:
+            self.normalizer = InProcessLines(lambda: moses_text.MosesNormalizer(SRC).normalize)
+            self.tokenizer = InProcessLines(
+                lambda: moses_text.MosesTokenizer(SRC, moses_scripts=MOSES_SCRIPTS).tokenize)
+        self.models = ModelRegistry(max_models, max_bytes)
+        self.hanlp_lock = threading.Lock()
+
+    def segment(self, lines):
+        with self.hanlp_lock:
+            return segment_lines(lines)
+
+    def warmup(self, model_names=()):
+        """启动时预热：载入 HanLP、拉起 Moses 子进程，并载入指定模型的 truecaser / BPE。"""
+        load_pipe()
+        self.segment(['预热'])
+        self.normalizer.process(['warm up'])
+        self.tokenizer.process(['warm up'])
+        for name in model_names:
+            self.models.get(name)
+
+    def close(self):
+        self.normalizer.close()
+        self.tokenizer.close()
+        self.models.close()
+
+
+PIPELINE = Preprocessor()
+
+
+STEPS = ('normalize', 'hanlp', 'tokenize', 'truecase', 'bpe')
+
+# 输出 dict 的 key -> 步骤名
+STEP_OF_KEY = dict(zip(('normalized', 'hanlp_segmented', 'moses_tokenized', 'truecased', 'bpe'), STEPS))
+
+# 延迟直方图的上界（秒），Prometheus 风格累计 bucket
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    """各步骤 / 整个请求的延迟直方图、计数器与队列深度 gauge，GET /metrics 以 Prometheus 文字格式输出。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hist = {}      # name -> [各 bucket 次数..., +Inf 次数, 总秒数]
+        self.counters = {}  # (name, label) -> n
+        self.gauges = {}    # name -> 无参数函数
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            h = self.hist.get(name)
+            if h is None:
+                h = self.hist[name] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            h[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            h[-1] += seconds
+
+    def inc(self, name: str, label: str = '', n: int = 1) -> None:
+        with self.lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + n
+
+    def render(self) -> str:
+        out = ['# TYPE preprocess_latency_seconds histogram']
+        with self.lock:
+            hist = {k: list(v) for k, v in self.hist.items()}
+            counters = dict(self.counters)
+        for name, h in sorted(hist.items()):
+            acc = 0
+            for le, c in zip(LATENCY_BUCKETS, h):
+                acc += c
+                out.append(f'preprocess_latency_seconds_bucket{{stage="{name}",le="{le}"}} {acc}')
+            acc += h[len(LATENCY_BUCKETS)]
+            out.append(f'preprocess_latency_seconds_bucket{{stage="{name}",le="+Inf"}} {acc}')
+            out.append(f'preprocess_latency_seconds_sum{{stage="{name}"}} {h[-1]:.6f}')
+            out.append(f'preprocess_latency_seconds_count{{stage="{name}"}} {acc}')
+        for (name, label), n in sorted(counters.items()):
+            lab = f'{{status="{label}"}}' if label else ''
+            out.append(f'preprocess_{name}_total{lab} {n}')
+        for name, fn in sorted(self.gauges.items()):
+            out.append(f'preprocess_{name} {fn()}')
+        reg = PIPELINE.models.stats()
+        for k in ('hits', 'misses', 'reloads', 'evictions'):
+            out.append(f'preprocess_model_registry_{k}_total {reg[k]}')
+        out.append(f'preprocess_model_registry_load_seconds_total {reg["load_seconds"]:.6f}')
+        out.append(f'preprocess_model_registry_models {len(reg["models"])}')
+        return '\n'.join(out) + '\n'
+
+
+METRICS = Metrics()
+
+
+def preprocess_batch(model_name: str,
+                     texts,
+                     do_normalize: bool = True,
+                     do_hanlp: bool = True,
+                     do_tokenize: bool = True,
+                     do_truecase: bool = True,
+                     do_bpe: bool = True) -> list:
+    """
+    一次处理多段文字，每步把所有文字的行合在一起送进 worker（HanLP / BPE 各只调用一次），
+    回传与 preprocess_all 相同格式的 dict 列表（顺序与 texts 相同）。
+    只有要做 truecase / BPE 时才向 registry 取模型；模型不存在时抛 ModelNotFound。
+    """
+    art = PIPELINE.models.get(model_name) if (do_truecase or do_bpe) else None
+
+    results = [{} for _ in texts]
+    current = list(texts)
+
+    def step(key, fn):
+        t0 = time.perf_counter()
+        split = [t.split('\n') for t in current]
+        flat = fn([s for lines in split for s in lines])
+        METRICS.observe(STEP_OF_KEY[key], time.perf_counter() - t0)
+        pos = 0
+        for i, lines in enumerate(split):
+            current[i] = '\n'.join(flat[pos:pos + len(lines)]).strip()
+            pos += len(lines)
+            results[i][key] = current[i]
 
     # 1. normalize punctuation
     if do_normalize:
-        current = run(['perl', norm_punc, '-l', src], current)
-        result['normalized'] = current
+        step('normalized', PIPELINE.normalizer.process)
 
     # 2. HanLP segmentation
     if do_hanlp:
-        current = run(['python3', hanlp_seg, '-if', '/dev/stdin', '-of', '/dev/stdout'], current)
-        result['hanlp_segmented'] = current
+        step('hanlp_segmented', PIPELINE.segment)
 
     # 3. Moses tokenization
     if do_tokenize:
-        current = run([tokenizer, '-l', src], current)
-        result['moses_tokenized'] = current
+        step('moses_tokenized', PIPELINE.tokenizer.process)
 
     # 4. truecase （若模型文件存在且开关开启）
-    if do_truecase and os.path.isfile(truecase_model):
-        current = run(['perl', truecase_tool, '--model', truecase_model], current)
-        result['truecased'] = current
+    if do_truecase and art.truecaser is not None:
+        step('truecased', art.truecaser.process)
 
     # 5. apply BPE
     if do_bpe:
-        current = run(['python3', apply_bpe, '-c', bpe_code, '--vocabulary', vocab_file], current)
-        result['bpe'] = current
+        bpe = art.require_bpe()
+        step('bpe', lambda lines: [bpe.process_line(s) for s in lines])
 
     # 如果没有任何步骤，返回原句
-    if not result:
-        result['sentence'] = text
+    for r, t in zip(results, texts):
+        if not r:
+            r['sentence'] = t
 
-    return result
+    return results
 
 
-@app.route('/preprocess', methods=['POST'])
-def api_preprocess():
-    data = request.get_json(force=True)
+def preprocess_all(model_name: str,
+                   text: str,
+                   do_normalize: bool = True,
+                   do_hanlp: bool = True,
+                   do_tokenize: bool = True,
+                   do_truecase: bool = True,
+                   do_bpe: bool = True) -> dict:
+    """
+    按步骤预处理：
+      normalize → HanLP segmentation → Moses tokenization → optional truecase → BPE
+    各步骤可通过参数开关控制是否执行。
+    每步输出与原先逐步起子进程时相同：整段文字逐行处理，结果去掉首尾空白后交给下一步。
+    """
+    return preprocess_batch(model_name, [text], do_normalize, do_hanlp, do_tokenize, do_truecase, do_bpe)[0]
+
+
+class MicroBatcher:
+    """
+    动态 micro-batching：并发进来的单句请求先排队，第一句进队后最多等 max_wait 秒
+    （或凑满 max_batch 句）就一起处理；同一 (model_name, 步骤开关) 的句子合成一次 preprocess_batch。
+    """
+
+    def __init__(self, max_batch: int = 64, max_wait_ms: float = 5.0):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.0
+        self.q = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit_future(self, model_name: str, text: str, flags: tuple) -> Future:
+        fut = Future()
+        self.q.put(((model_name, flags), text, fut))
+        return fut
+
+    def submit(self, model_name: str, text: str, flags: tuple) -> dict:
+        return self.submit_future(model_name, text, flags).result()
+
+    def depth(self) -> int:
+        return self.q.qsize()
+
+    def _collect(self):
+        items = [self.q.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch:
+            left = deadline - time.monotonic()
+            try:
+                items.append(self.q.get(timeout=left) if left > 0 else self.q.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _loop(self):
+        while True:
+            groups = {}
+            for key, text, fut in self._collect():
+                groups.setdefault(key, []).append((text, fut))
+            for (model_name, flags), items in groups.items():
+                try:
+                    res = preprocess_batch(model_name, [t for t, _ in items], *flags)
+                except Exception as e:
+                    for _, fut in items:
+                        fut.set_exception(e)
+                    continue
+                for (_, fut), r in zip(items, res):
+                    fut.set_result(r)
+
+
+BATCHER = None
+
+
+@app.route('/models', methods=['GET'])
+def api_models():
+    """模型 registry 统计：hits / misses / reloads / evictions / 载入秒数与目前常驻的模型。"""
+    return jsonify(PIPELINE.models.stats())
+
+
+def parse_request(data):
+    """
+    校验 /preprocess 请求。
+    单句：{"model_name", "sentence", 各步骤开关}；批量：{"model_name", "sentences": [...], 各步骤开关}
+    回传 (错误信息或 None, model_name, sentence 或 sentences, 是否批量, 步骤开关)。
+    """
+    if not isinstance(data, dict):
+        return 'request body must be a JSON object', None, None, False, None
     model_name = data.get('model_name')
     sentence   = data.get('sentence')
+    sentences  = data.get('sentences')
 
-    if not model_name or not sentence:
-        return jsonify({'error': 'model_name and sentence are required'}), 400
+    # 类型不对（数字、列表、对象……）一律回 400，不要让它在分词时才抛异常变成 500
+    if sentences is not None:
+        if not model_name or not isinstance(model_name, str) or not isinstance(sentences, list) or not sentences \
+                or not all(isinstance(s, str) for s in sentences):
+            return 'model_name and a non-empty list of sentences are required', None, None, True, None
+    elif not model_name or not isinstance(model_name, str) or not sentence or not isinstance(sentence, str):
+        return 'model_name and sentence (string) are required', None, None, False, None
 
     # 读取各步骤开关，默认都执行
-    do_normalize = data.get('normalize', True)
-    do_hanlp     = data.get('hanlp', True)
-    do_tokenize  = data.get('tokenize', True)
-    do_truecase  = data.get('truecase', True)
-    do_bpe       = data.get('bpe', True)
+    flags = tuple(bool(data.get(k, True)) for k in STEPS)
+    if sentences is not None:
+        return None, model_name, sentences, True, flags
+    return None, model_name, sentence, False, flags
+
+
+def handle_request(model_name, payload, is_batch: bool, flags: tuple) -> dict:
+    if is_batch:
+        return {'results': preprocess_batch(model_name, payload, *flags)}
+    if BATCHER is not None:
+        return BATCHER.submit(model_name, payload, flags)
+    return preprocess_all(model_name, payload, *flags)
+
+
+def _json_body(result) -> str:
+    return json.dumps(result, ensure_ascii=False)
+
+
+@app.route('/preprocess', methods=['POST'])
+def api_preprocess():
+    t0 = time.perf_counter()
+    err, model_name, payload, is_batch, flags = parse_request(request.get_json(force=True))
+    if err:
+        METRICS.inc('requests', '400')
+        return jsonify({'error': err}), 400
 
     try:
-        result = preprocess_all(
-            model_name, sentence,
-            do_normalize=do_normalize,
-            do_hanlp=do_hanlp,
-            do_tokenize=do_tokenize,
-            do_truecase=do_truecase,
-            do_bpe=do_bpe
-        )
-        return Response(
-            json.dumps(result, ensure_ascii=False),
-            mimetype='application/json; charset=utf-8'
-        )
+        result = handle_request(model_name, payload, is_batch, flags)
+    except ModelNotFound as e:
+        METRICS.inc('requests', '404')
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
+        METRICS.inc('requests', '500')
         return jsonify({'error': str(e)}), 500
+    METRICS.inc('requests', '200')
+    METRICS.observe('request', time.perf_counter() - t0)
+    return Response(
+        _json_body(result),
+        mimetype='application/json; charset=utf-8'
+    )
+
+
+@app.route('/metrics', methods=['GET'])
+def api_metrics():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+
+def run_async_server(host: str, port: int, max_inflight: int, workers: int, drain_seconds: float):
+    """
+    asyncio 服务模式（aiohttp），与 Flask 版相同的 /preprocess、/models、/metrics：
+    - 预处理（HanLP / Moses / BPE）在 worker 线程池执行，不阻塞 event loop；
+      HanLP 推理与 Moses 子进程都不占 GIL，线程池即可并行
+    - 同时处理中的请求达 max_inflight 时直接回 429
+    - 收到 SIGINT / SIGTERM 后不再接新请求（503），等进行中的请求做完（最多 drain_seconds）再关闭
+    """
+    try:
+        from aiohttp import web
+    except ImportError:
+        raise SystemExit('--server async requires aiohttp (pip install aiohttp)')
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preprocess')
+    state = {'inflight': 0, 'draining': False}
+    METRICS.gauges['inflight_requests'] = lambda: state['inflight']
+    METRICS.gauges['inflight_limit'] = lambda: max_inflight
+
+    def reply(result, status=200):
+        return web.Response(text=_json_body(result), status=status, content_type='application/json', charset='utf-8')
+
+    async def preprocess(req):
+        if state['draining']:
+            METRICS.inc('requests', '503')
+            return reply({'error': 'server is shutting down'}, 503)
+        if state['inflight'] >= max_inflight:
+            METRICS.inc('requests', '429')
+            return reply({'error': f'too many requests in flight (limit {max_inflight})'}, 429)
+        state['inflight'] += 1
+        t0 = time.perf_counter()
+        try:
+            try:
+                data = await req.json(loads=json.loads)
+            except ValueError:
+                data = None
+            err, model_name, payload, is_batch, flags = parse_request(data)
+            if err:
+                METRICS.inc('requests', '400')
+                return reply({'error': err}, 400)
+            try:
+                if not is_batch and BATCHER is not None:
+                    result = await asyncio.wrap_future(BATCHER.submit_future(model_name, payload, flags))
+                else:
+                    result = await asyncio.get_running_loop().run_in_executor(
+                        executor, handle_request, model_name, payload, is_batch, flags)
+            except ModelNotFound as e:
+                METRICS.inc('requests', '404')
+                return reply({'error': str(e)}, 404)
+            except Exception as e:
+                METRICS.inc('requests', '500')
+                return reply({'error': str(e)}, 500)
+            METRICS.inc('requests', '200')
+            METRICS.observe('request', time.perf_counter() - t0)
+            return reply(result)
+        finally:
+            state['inflight'] -= 1
+
+    async def models(req):
+        return reply(PIPELINE.models.stats())
+
+    async def metrics(req):
+        return web.Response(text=METRICS.render(), content_type='text/plain', charset='utf-8')
+
+    async def drain(app_):
+        state['draining'] = True
+        deadline = time.monotonic() + drain_seconds
+        while state['inflight'] and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if state['inflight']:
+            print(f"[WARN] shutdown with {state['inflight']} requests still in flight")
+
+    async def cleanup(app_):
+        executor.shutdown(wait=True)
+        PIPELINE.close()
+
+    aio = web.Application(client_max_size=64 << 20)
+    aio.router.add_post('/preprocess', preprocess)
+    aio.router.add_get('/models', models)
+    aio.router.add_get('/metrics', metrics)
+    aio.on_shutdown.append(drain)
+    aio.on_cleanup.append(cleanup)
+    web.run_app(aio, host=host, port=port, shutdown_timeout=drain_seconds)
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=6000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=6000)
+    parser.add_argument('--warmup', default='', help="Comma-separated model_names to preload at startup")
+    parser.add_argument('--max_batch', type=int, default=64, help="Max sentences merged into one micro-batch")
+    parser.add_argument('--max_wait_ms', type=float, default=5.0,
+                        help="Max time a single-sentence request waits for others (0 = no micro-batching)")
+    parser.add_argument('--max_models', type=int, default=8, help="Models kept loaded (LRU)")
+    parser.add_argument('--max_model_mb', type=float, default=4096, help="Approx. memory budget of loaded models")
+    parser.add_argument('--moses', choices=['python', 'perl'], default='python',
+                        help="normalize/tokenize in-process (moses_text.py) or as perl coprocesses")
+    parser.add_argument('--server', choices=['flask', 'async'], default='flask',
+                        help="flask: Flask dev server; async: aiohttp with a worker pool and backpressure")
+    parser.add_argument('--workers', type=int, default=4, help="Worker threads for preprocessing (async mode)")
+    parser.add_argument('--max_inflight', type=int, default=256, help="Requests in flight before 429 (async mode)")
+    parser.add_argument('--drain_seconds', type=float, default=30.0, help="Graceful drain time on shutdown (async mode)")
+    args = parser.parse_args()
+
+    PIPELINE = Preprocessor(args.max_models, int(args.max_model_mb * (1 << 20)), args.moses)
+    try:
+        PIPELINE.warmup([m for m in args.warmup.split(',') if m])
+    except ModelNotFound as e:
+        PIPELINE.close()
+        raise SystemExit(f'[ERROR] --warmup: {e}')
+    if args.max_wait_ms > 0:
+        BATCHER = MicroBatcher(args.max_batch, args.max_wait_ms)
+        METRICS.gauges['microbatch_queue_depth'] = BATCHER.depth
+    if args.server == 'async':
+        run_async_server(args.host, args.port, args.max_inflight, args.workers, args.drain_seconds)
+    else:
+        try:
+            app.run(host=args.host, port=args.port)
+        finally:
+            PIPELINE.close()